@@ -20,6 +20,9 @@ import math
 import platform
 from datetime import datetime
 import psutil
+import posixpath
+from callback_store import CallbackStore
+from aria2_supervisor import Aria2Supervisor
 
 
 # Simple logging setup
@@ -39,6 +42,8 @@ DOWNLOAD_DIR.mkdir(exist_ok=True)
 RCLONE_CONFIGS_DIR = Path("UserConfigs")
 RCLONE_CONFIGS_DIR.mkdir(exist_ok=True)
 
+callback_store = CallbackStore()  # State behind remote_/upload_ buttons
+
 app = Client(
     "my_bot",
     api_id="2",
@@ -197,7 +202,7 @@ async def handle_document(client, message):
                 for remote in remotes:
                     buttons.append([InlineKeyboardButton(
                         f"📁 {remote}", 
-                        callback_data=f"remote_{remote}_"
+                        callback_data=callback_store.data('remote', remote=remote, path="")
                     )])
                 buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel")])
                 
@@ -845,7 +850,7 @@ async def handle_rclone_selection(client, callback_query: CallbackQuery):
         for remote in remotes:
             buttons.append([InlineKeyboardButton(
                 f"📁 {remote}", 
-                callback_data=f"remote_{remote}_"
+                callback_data=callback_store.data('remote', remote=remote, path="")
             )])
         buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel")])
         
@@ -862,9 +867,11 @@ async def handle_rclone_selection(client, callback_query: CallbackQuery):
 async def handle_remote_navigation(client, callback_query: CallbackQuery):
     try:
         user_id = callback_query.from_user.id
-        data = callback_query.data.split('_')
-        remote = data[1]
-        current_path = data[2] if len(data) > 2 else ""
+        state = callback_store.get(callback_query.data)
+        if not state:
+            await callback_query.message.edit_text("⌛ This menu has expired, please choose the destination again.")
+            return
+        remote, current_path = state['remote'], state['path']
         
         folders = list_folder_contents(user_id, remote, current_path)
         buttons = []
@@ -872,25 +879,26 @@ async def handle_remote_navigation(client, callback_query: CallbackQuery):
         # Add folder buttons
         for folder in folders:
             folder_name = os.path.basename(folder.rstrip('/'))
-            folder_path = folder.rstrip('/')
+            # lsf lists paths relative to the folder being browsed
+            folder_path = posixpath.join(current_path, folder.rstrip('/'))
             buttons.append([InlineKeyboardButton(
                 f"📁 {folder_name}",
-                callback_data=f"remote_{remote}_{folder_path}"
+                callback_data=callback_store.data('remote', remote=remote, path=folder_path)
             )])
         
         # Add upload here button
         buttons.append([InlineKeyboardButton(
             "📤 Upload Here",
-            callback_data=f"upload_{remote}_{current_path}"
+            callback_data=callback_store.data('upload', remote=remote, path=current_path)
         )])
         
         # Add navigation buttons
         nav_buttons = []
         if current_path:  # Add back button if not in root
-            parent_path = str(Path(current_path).parent)
+            parent_path = os.path.dirname(current_path)
             nav_buttons.append(InlineKeyboardButton(
                 "⬅️ Back",
-                callback_data=f"remote_{remote}_{parent_path}"
+                callback_data=callback_store.data('remote', remote=remote, path=parent_path)
             ))
         nav_buttons.append(InlineKeyboardButton("❌ Cancel", callback_data="cancel"))
         buttons.append(nav_buttons)
@@ -908,9 +916,11 @@ async def handle_remote_navigation(client, callback_query: CallbackQuery):
 async def handle_rclone_upload(client, callback_query: CallbackQuery):
     try:
         # Extract callback data
-        data = callback_query.data.split('_')
-        remote = data[1]
-        path = data[2] if len(data) > 2 else ""
+        state = callback_store.get(callback_query.data)
+        if not state:
+            await callback_query.message.edit_text("⌛ This menu has expired, please choose the destination again.")
+            return
+        remote, path = state['remote'], state['path']
         user_id = callback_query.from_user.id
         message = callback_query.message
 
@@ -1036,14 +1046,7 @@ async def handle_cancel(client, callback_query: CallbackQuery):
 
 if __name__ == "__main__":
     logging.info("Bot starting...")
-    # Start aria2
-    subprocess.Popen([
-        "aria2c",
-        "--enable-rpc",
-        "--rpc-listen-all=true",
-        "--rpc-allow-origin-all",
-        "--rpc-listen-port=6800",
-        "--disable-ipv6"
-    ])
+    # Start aria2 with the tuned profile and wait until it answers RPC
+    Aria2Supervisor(port=6800).start()
     # Start bot
     app.run()
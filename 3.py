@@ -1,13 +1,13 @@
 # bot.py
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import logging
 from pathlib import Path
-import subprocess
-import time
+from aria2_supervisor import Aria2Supervisor
 from download_manager import DownloadManager
 from upload_manager import UploadManager
 from progress_tracker import ProgressTracker
+from edit_scheduler import EditScheduler
 
 # Setup logging
 logging.basicConfig(
@@ -28,32 +28,23 @@ class TelegramBot:
         # Start aria2c
         self._start_aria2()
         
-        # Initialize managers
-        self.download_manager = DownloadManager()
-        self.upload_manager = UploadManager()
+        # Initialize managers; progress edits share one rate-limited scheduler
+        self.edit_scheduler = EditScheduler()
+        self.download_manager = DownloadManager(self.edit_scheduler)
+        self.upload_manager = UploadManager(self.edit_scheduler)
         self.progress_tracker = ProgressTracker()
         
         # Setup handlers
         self._setup_handlers()
     
     def _start_aria2(self):
-        """Start aria2c RPC server"""
+        """Start aria2c RPC server, resuming the previous session"""
         try:
-            # Kill any existing aria2c processes
-            subprocess.run(['pkill', 'aria2c'], stderr=subprocess.DEVNULL)
-            
-            # Start new aria2c process
-            self.aria_process = subprocess.Popen([
-                "aria2c",
-                "--enable-rpc",
-                "--rpc-listen-all=true",
-                "--rpc-allow-origin-all",
-                "--rpc-listen-port=6800",
-                "--disable-ipv6"
-            ])
-            
-            # Give aria2c time to start
-            time.sleep(2)
+            # An aria2c that is already running is adopted with its transfers;
+            # otherwise one is launched with the tuned profile. Either way this
+            # returns as soon as aria2c answers getVersion.
+            self.aria2 = Aria2Supervisor(port=6800, session_file=Path("aria2.session"))
+            self.aria2.start()
             logging.info("aria2c started successfully")
             
         except Exception as e:
@@ -80,16 +71,21 @@ class TelegramBot:
         async def handle_upload_cancel(client, callback_query):
             await self.upload_manager.cancel_upload(callback_query)
 
-    def run(self):
+    async def _serve(self):
+        await self.app.start()
+        # Relaunch aria2c if it crashes while the bot runs
+        self.aria2.watch()
         try:
-            logging.info("Bot starting...")
-            self.app.run()
+            await idle()
         finally:
-            # Cleanup aria2c on exit
-            if hasattr(self, 'aria_process'):
-                self.aria_process.terminate()
-                self.aria_process.wait()
-                logging.info("aria2c terminated")
+            # Cleanup aria2c on exit; it saves its session first
+            await self.aria2.stop(shutdown=True)
+            logging.info("aria2c terminated")
+            await self.app.stop()
+
+    def run(self):
+        logging.info("Bot starting...")
+        self.app.run(self._serve())
 
 if __name__ == "__main__":
     bot = TelegramBot()
@@ -101,18 +97,21 @@ from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aria2p import API, Client as ariaClient
 import asyncio
 import logging
+from aria2_rpc import AsyncAria2
 from progress_tracker import ProgressTracker
 
 class DownloadManager:
-    def __init__(self):
+    def __init__(self, edit_scheduler):
         self.aria2 = ariaClient(
             host="http://localhost",
             port=6800,
             secret=""
         )
         self.aria_api = API(self.aria2)
+        self.aria_rpc = AsyncAria2(self.aria_api, host="http://localhost", port=6800, secret="")
         self.downloads = {}
         self.progress_tracker = ProgressTracker()
+        self.edit_scheduler = edit_scheduler
         self.active_downloads = {}
 
     async def start_download(self, client, message):
@@ -128,7 +127,8 @@ class DownloadManager:
                 ]])
             )
 
-            download = self.aria_api.add_uris([url])
+            # Torrents stop seeding once complete so the upload can start
+            download = await self.aria_rpc.add_uris([url], {'seed-time': '0'})
             self.active_downloads[message.id] = {
                 'gid': download.gid,
                 'cancelled': False
@@ -142,28 +142,36 @@ class DownloadManager:
 
     async def _monitor_download(self, download, progress_msg, msg_id):
         try:
-            while not download.is_complete and not self.active_downloads[msg_id]['cancelled']:
-                download.update()
+            while not self.active_downloads[msg_id]['cancelled']:
+                download = await self.aria_rpc.get_download(download.gid) or download
+                if download.is_complete and download.followed_by_ids:
+                    # A magnet or .torrent only fetched the metadata; follow the payload
+                    download = await self.aria_rpc.get_download(download.followed_by_ids[0]) or download
+                    self.active_downloads[msg_id]['gid'] = download.gid
+                    continue
+                if download.is_complete:
+                    break
                 progress_text = self.progress_tracker.get_download_progress(download)
                 
-                try:
-                    await progress_msg.edit_text(
-                        progress_text,
-                        reply_markup=InlineKeyboardMarkup([[
-                            InlineKeyboardButton(
-                                "❌ Cancel Download",
-                                callback_data=f"cancel_download_{msg_id}"
-                            )
-                        ]])
-                    )
-                except Exception:
-                    pass
+                self.edit_scheduler.schedule(
+                    progress_msg,
+                    progress_text,
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton(
+                            "❌ Cancel Download",
+                            callback_data=f"cancel_download_{msg_id}"
+                        )
+                    ]])
+                )
                 
-                await asyncio.sleep(3)
+                await asyncio.sleep(1)
 
             if not self.active_downloads[msg_id]['cancelled']:
+                # Every selected file of a torrent, not just the first one
+                file_paths = [str(file.path) for file in download.files if file.selected]
                 self.downloads[progress_msg.id] = {
-                    'file_path': download.files[0].path
+                    'file_path': file_paths[0],
+                    'file_paths': file_paths
                 }
                 await self._show_upload_options(progress_msg)
 
@@ -176,7 +184,8 @@ class DownloadManager:
             InlineKeyboardButton("☁️ Cloud", callback_data=f"rclone_{progress_msg.id}")
         ]]
         
-        await progress_msg.edit_text(
+        await self.edit_scheduler.edit(
+            progress_msg,
             "✅ Download complete! Choose upload destination:",
             reply_markup=InlineKeyboardMarkup(buttons)
         )
@@ -186,8 +195,8 @@ class DownloadManager:
         if msg_id in self.active_downloads:
             self.active_downloads[msg_id]['cancelled'] = True
             gid = self.active_downloads[msg_id]['gid']
-            self.aria_api.remove([gid])
-            await callback_query.message.edit_text("❌ Download cancelled")
+            await self.aria_rpc.remove(gid)
+            await self.edit_scheduler.edit(callback_query.message, "❌ Download cancelled")
             del self.active_downloads[msg_id]
 
 # upload_manager.py
@@ -199,8 +208,9 @@ from progress_tracker import ProgressTracker
 from pathlib import Path
 
 class UploadManager:
-    def __init__(self):
+    def __init__(self, edit_scheduler):
         self.progress_tracker = ProgressTracker()
+        self.edit_scheduler = edit_scheduler
         self.active_uploads = {}
         self.RCLONE_CONFIGS_DIR = Path("UserConfigs")
         self.RCLONE_CONFIGS_DIR.mkdir(exist_ok=True)
@@ -221,20 +231,19 @@ class UploadManager:
             )
 
             async def progress(current, total):
+                # Called on every chunk; the scheduler keeps only the newest frame
                 if not self.active_uploads[msg_id]['cancelled']:
                     progress_text = self.progress_tracker.get_upload_progress(current, total)
-                    try:
-                        await progress_msg.edit_text(
-                            progress_text,
-                            reply_markup=InlineKeyboardMarkup([[
-                                InlineKeyboardButton(
-                                    "❌ Cancel Upload",
-                                    callback_data=f"cancel_upload_{msg_id}"
-                                )
-                            ]])
-                        )
-                    except Exception:
-                        pass
+                    self.edit_scheduler.schedule(
+                        progress_msg,
+                        progress_text,
+                        reply_markup=InlineKeyboardMarkup([[
+                            InlineKeyboardButton(
+                                "❌ Cancel Upload",
+                                callback_data=f"cancel_upload_{msg_id}"
+                            )
+                        ]])
+                    )
 
             await callback_query.message.reply_document(
                 document=file_path,
@@ -242,7 +251,7 @@ class UploadManager:
             )
 
             if not self.active_uploads[msg_id]['cancelled']:
-                await progress_msg.edit_text("✅ Upload complete!")
+                await self.edit_scheduler.edit(progress_msg, "✅ Upload complete!")
             
             os.remove(file_path)
             del self.active_uploads[msg_id]
@@ -282,23 +291,21 @@ class UploadManager:
                 line = process.stdout.readline()
                 if "Transferred:" in line:
                     progress_text = f"⬆️ Uploading to cloud storage:\n{line}"
-                    try:
-                        await callback_query.message.edit_text(
-                            progress_text,
-                            reply_markup=InlineKeyboardMarkup([[
-                                InlineKeyboardButton(
-                                    "❌ Cancel Upload",
-                                    callback_data=f"cancel_upload_{msg_id}"
-                                )
-                            ]])
-                        )
-                    except Exception:
-                        pass
+                    self.edit_scheduler.schedule(
+                        callback_query.message,
+                        progress_text,
+                        reply_markup=InlineKeyboardMarkup([[
+                            InlineKeyboardButton(
+                                "❌ Cancel Upload",
+                                callback_data=f"cancel_upload_{msg_id}"
+                            )
+                        ]])
+                    )
 
             if not self.active_uploads[msg_id]['cancelled'] and process.returncode == 0:
-                await callback_query.message.edit_text("✅ Upload to cloud storage complete!")
+                await self.edit_scheduler.edit(callback_query.message, "✅ Upload to cloud storage complete!")
             else:
-                await callback_query.message.edit_text("❌ Upload cancelled or failed")
+                await self.edit_scheduler.edit(callback_query.message, "❌ Upload cancelled or failed")
 
             os.remove(file_path)
             del self.active_uploads[msg_id]
@@ -313,7 +320,7 @@ class UploadManager:
             self.active_uploads[msg_id]['cancelled'] = True
             if self.active_uploads[msg_id].get('process'):
                 self.active_uploads[msg_id]['process'].terminate()
-            await callback_query.message.edit_text("❌ Upload cancelled")
+            await self.edit_scheduler.edit(callback_query.message, "❌ Upload cancelled")
             del self.active_uploads[msg_id]
 
 # progress_tracker.py
@@ -1,25 +1,48 @@
-from pyrogram import Client, filters
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from pyrogram.errors import MessageNotModified
-from aria2p import API, Client as ariaClient
+from pyrogram import filters, idle, StopTransmission
+from pyrogram.types import (
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
+    InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument
+)
+from aria2p import API, Client as ariaClient, Download
 import os
 import asyncio
 import time
-import pathlib
 from pathlib import Path
 import mimetypes
 import subprocess
-import configparser
 import logging
 import re
-from yt_dlp import YoutubeDL
 from urllib.parse import urlparse
-import uuid
-import ffmpeg
 import math
 import platform
 from datetime import datetime
 import psutil
+import shutil
+import posixpath
+from contextlib import aclosing, asynccontextmanager
+from aria2_monitor import Aria2Monitor, STATUS_KEYS
+from aria2_rpc import AsyncAria2
+from aria2_supervisor import Aria2Supervisor
+from loop_lag import LoopLagMonitor
+from edit_scheduler import EditScheduler
+from job_queue import JobScheduler, JobCancelled, detached, spawn
+from ytdl_runner import YtdlRunner, YtdlJob, expected_size
+from job_store import JobStore, JobTable, JobSet
+from file_cache import FileIdCache, url_key, content_key, hash_file, sent_file_id
+from file_splitter import TELEGRAM_UPLOAD_LIMIT, iter_byte_parts, iter_video_parts, prefetch
+from tg_transfer import TurboClient, BIG_FILE_SIZE
+from rclone_stream import rcat
+from rclone_rc import RcloneRC
+from remote_browser import FolderCache
+from callback_store import CallbackStore
+from rclone_config import RcloneConfigCache
+from media_probe import MediaProber, VIDEO_EXTENSIONS
+from thumb_store import ThumbnailStore
+from disk_admission import DiskAdmission, DiskFull
+from tail_reader import GrowingFile
+from batch_upload import plan_media_groups
+from archive_tools import TarStream, ArchiveRunner, ARCHIVE_EXTENSIONS
+from bandwidth import BandwidthManager, DIRECTIONS, parse_rate
 
 
 # Simple logging setup
@@ -29,10 +52,16 @@ logging.basicConfig(
     filename='bot.log'
 )
 
-# Global storage
-downloads_db = {}
-uploads_db = {}  # New dictionary to track uploads
-pending_rclone_users = set()  # Store users waiting for rclone.conf
+# Global storage, persisted so in-flight jobs survive a restart
+job_store = JobStore("jobs.db")
+downloads_db = JobTable(job_store, 'download')
+uploads_db = JobTable(job_store, 'upload')  # New dictionary to track uploads
+pending_rclone_users = JobSet(job_store, 'pending_rclone')  # Store users waiting for rclone.conf
+file_cache = FileIdCache(job_store)  # Telegram file_ids of content we already uploaded
+auto_destinations = JobTable(job_store, 'autodest')  # Upload destination used for users who skip the choice
+
+# aria2 saves its queue here and reloads it on start, keeping GIDs
+ARIA2_SESSION_FILE = Path("aria2.session")
 
 DOWNLOAD_DIR = Path("Downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
@@ -45,19 +74,91 @@ def get_user_download_dir(user_id):
 RCLONE_CONFIGS_DIR = Path("UserConfigs")
 RCLONE_CONFIGS_DIR.mkdir(exist_ok=True)
 
-app = Client(
+# Free space kept spare on the download disk, and the most each user may hold in it
+DISK_HEADROOM = 2 * 1024 ** 3
+USER_DISK_QUOTA = 50 * 1024 ** 3
+disk_admission = DiskAdmission(DOWNLOAD_DIR, headroom=DISK_HEADROOM, user_quota=USER_DISK_QUOTA)
+
+# Maximum number of jobs running at once in each stage; extra jobs are queued
+JOB_LIMITS = {
+    'aria2': 5,
+    'ytdl': 2,
+    'tg_download': 3,
+    'tg_upload': 2,
+    'rclone': 3,
+    'archive': 2,
+}
+
+# Stalled or flaky aria2 downloads are paused and retried after a growing delay
+ARIA2_STALL_TIMEOUT = 30
+ARIA2_RETRIES = 5
+ARIA2_RETRY_DELAY = 10  # doubled on every attempt, up to ARIA2_RETRY_DELAY_MAX
+ARIA2_RETRY_DELAY_MAX = 300
+# aria2 error codes worth retrying: timeout, network problem, name resolution,
+# bad response header, server overloaded
+ARIA2_TRANSIENT_ERRORS = {'2', '6', '19', '22', '29'}
+ARIA2_CHECKSUM_ERROR = '32'
+
+# Parallel MTProto connections used for each big Telegram upload/download
+UPLOAD_CONNECTIONS = 4
+DOWNLOAD_CONNECTIONS = 4
+
+# Global bandwidth caps in bytes/s (0 for none), shared between the users
+# transferring in proportion to their weight; admins change both with /bandwidth
+BANDWIDTH_DOWNLOAD_LIMIT = 0
+BANDWIDTH_UPLOAD_LIMIT = 0
+bandwidth = BandwidthManager(BANDWIDTH_DOWNLOAD_LIMIT, BANDWIDTH_UPLOAD_LIMIT)
+
+app = TurboClient(
     "my_bot",
     api_id="2",
     api_hash="92",
-    bot_token="7"
+    bot_token="7",
+    upload_connections=UPLOAD_CONNECTIONS,
+    download_connections=DOWNLOAD_CONNECTIONS
 )
 
+# aria2c is launched with this performance profile on top of the supervisor's
+# defaults; admins can change it at runtime with /aria2
+ARIA2_PROFILE = {
+    'max-concurrent-downloads': str(JOB_LIMITS['aria2']),
+    # Auto destinations upload pieces as soon as aria2 marks them complete,
+    # which only means they are on disk without a write cache
+    'disk-cache': '0',
+}
+ADMIN_IDS = []  # Telegram user ids allowed to use /aria2 and /bandwidth
+aria2_supervisor = Aria2Supervisor(port=6800, session_file=ARIA2_SESSION_FILE, profile=ARIA2_PROFILE)
+
 aria2 = ariaClient(
     host="http://localhost",
     port=6800,
     secret=""
 )
 aria_api = API(aria2)
+aria2_rpc = AsyncAria2(aria_api, host="http://localhost", port=6800, secret="")
+aria2_monitor = Aria2Monitor(aria_api, aria2_rpc)
+loop_lag = LoopLagMonitor()
+edit_scheduler = EditScheduler(per_chat_interval=3, global_rate=20)
+job_scheduler = JobScheduler(JOB_LIMITS)
+ytdl_runner = YtdlRunner(workers=JOB_LIMITS['ytdl'])
+archive_runner = ArchiveRunner(workers=JOB_LIMITS['archive'])  # zip/7z/rar in subprocesses
+media_prober = MediaProber(DOWNLOAD_DIR / ".thumbs", workers=2)  # Video metadata and thumbnails
+thumb_store = ThumbnailStore(RCLONE_CONFIGS_DIR)  # Custom thumbnails set with /setthumb
+rclone_rc = RcloneRC(RCLONE_CONFIGS_DIR / "rcd.conf")  # One rclone daemon serves every user's remotes
+
+# Remote folder browser: cached one-level listings, shown a page at a time
+FOLDERS_PER_PAGE = 8
+callback_store = CallbackStore()  # State behind remote_/upload_/select_ buttons
+
+# Torrents and metalinks: file picker page size
+FILES_PER_PAGE = 8
+FILE_SELECTION_TIMEOUT = 300  # seconds before an unanswered picker starts what is ticked
+BATCH_UPLOAD_CONCURRENCY = 3  # cloud copies of a batch running at once
+file_selections = {}  # progress message id -> file picker waiting for the user
+
+# Copies run by the rclone daemon, which has one limiter for all of them
+rclone_copy_flows = set()
+rclone_bwlimit_lock = asyncio.Lock()
 
 def format_size(size):
     for unit in ['B', 'KB', 'MB', 'GB']:
@@ -73,32 +174,77 @@ def create_progress_bar(percentage):
     completed = int(percentage / 10)
     return "█" * completed + "░" * (10 - completed)
 
+def queue_position_notifier(progress_msg, label):
+    def on_queued(position):
+        edit_scheduler.schedule(
+            progress_msg,
+            f"⏳ **{label} queued**\n"
+            f"🔢 **Position in queue:** {position}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+            ])
+        )
+    return on_queued
+
+@asynccontextmanager
+async def telegram_flow(user_id, direction):
+    """Pace this task's parallel Telegram transfers to the user's share."""
+    with bandwidth.flow(user_id, direction) as flow, app.throttled(flow):
+        yield flow
+
+async def limit_aria2(gids, rate):
+    """Split a download share of ``rate`` bytes/s over aria2 downloads."""
+    limit = max(rate // len(gids), 1) if rate else 0
+    await aria2_rpc.multicall([
+        ("aria2.changeOption", [gid, {'max-download-limit': str(limit)}]) for gid in gids
+    ])
+
+async def update_rclone_bwlimit(rate=None):
+    """Set the rclone daemon's limit to the sum of its copies' shares."""
+    async with rclone_bwlimit_lock:
+        rates = [flow.rate for flow in rclone_copy_flows]
+        await rclone_rc.set_bwlimit(0 if 0 in rates else sum(rates))
+
+@asynccontextmanager
+async def rclone_copy_flow(user_id):
+    with bandwidth.flow(user_id, 'upload', apply=update_rclone_bwlimit) as flow:
+        rclone_copy_flows.add(flow)
+        try:
+            yield flow
+        finally:
+            rclone_copy_flows.discard(flow)
+    await update_rclone_bwlimit()
+
 def get_rclone_config_path(user_id):
     return RCLONE_CONFIGS_DIR / str(user_id) / "rclone.conf"
 
-def get_available_remotes(config_path):
-    config = configparser.ConfigParser()
-    config.read(config_path)
-    return [section for section in config.sections()]
+async def probe_remote(user_id, config, remote):
+    await rclone_rc.probe(await rclone_rc.fs(user_id, config, remote))
 
-def list_folder_contents(user_id, remote, path=""):
-    config_path = get_rclone_config_path(user_id)
-    try:
-        command = [
-            "rclone", 
-            "lsf", 
-            "--config", 
-            str(config_path),
-            f"{remote}:{path}", 
-            "-R",
-            "--dirs-only"
-        ]
-        result = subprocess.run(command, capture_output=True, text=True)
-        folders = result.stdout.strip().split('\n')
-        return [f for f in folders if f]
-    except Exception as e:
-        logging.error(f"Error listing folders: {str(e)}")
-        return []
+# Parsed rclone.conf per user; new versions get their remotes checked in the background
+rclone_configs = RcloneConfigCache(get_rclone_config_path, validator=probe_remote)
+
+def get_available_remotes(user_id):
+    config = rclone_configs.get(user_id)
+    return list(config.remotes) if config else []
+
+def remote_buttons(user_id):
+    """One button per remote, flagging the ones that failed their check."""
+    config = rclone_configs.get(user_id)
+    buttons = []
+    for remote in config.remotes:
+        label = f"⚠️ {remote}" if config.problem(remote) else f"📁 {remote}"
+        buttons.append([InlineKeyboardButton(
+            label,
+            callback_data=callback_store.data('remote', remote=remote, path="", page=0)
+        )])
+    return buttons
+
+async def list_folder_contents(user_id, remote, path=""):
+    fs = await rclone_rc.fs(user_id, rclone_configs.get(user_id), remote)
+    return sorted(await rclone_rc.list_dirs(fs, path), key=str.lower)
+
+folder_cache = FolderCache(list_folder_contents)
 
 
  
@@ -147,6 +293,7 @@ async def stats_command(client, message):
         total_disk = disk_usage.total / (1024 ** 3)  # Convert bytes to GB
         used_disk = disk_usage.used / (1024 ** 3)
         free_disk = disk_usage.free / (1024 ** 3)
+        _, disk_reserved, disk_waiting = disk_admission.stats()
         percentage_disk = disk_usage.percent
 
         # Constructing the message with system information
@@ -166,7 +313,22 @@ async def stats_command(client, message):
 
             f"💽 **DISK STORAGE:**\n"
             f"┃ [{('■' * (int(percentage_disk) // 10))}{('□' * (10 - (int(percentage_disk) // 10)))}] {percentage_disk}%\n"
-            f"┖ **Used:** {used_disk:.2f}GB | **Free:** {free_disk:.2f}GB | **Total:** {total_disk:.2f}GB"
+            f"┠ **Used:** {used_disk:.2f}GB | **Free:** {free_disk:.2f}GB | **Total:** {total_disk:.2f}GB\n"
+            f"┖ **Downloads:** {format_size(disk_reserved)} reserved, {disk_waiting} waiting for space\n\n"
+
+            f"⏱️ **BOT HEALTH:**\n"
+            f"┠ **Event Loop Lag:** {loop_lag.summary()}\n"
+            f"┠ **Telegram Transfers:** {app.transfer_stats.summary()}\n"
+            f"┠ **aria2:** {aria2_supervisor.summary()}\n"
+            + "".join(
+                f"┠ **Bandwidth {direction}:** {format_speed(limit) if limit else 'unlimited'}, {len(users)} users\n"
+                for direction in DIRECTIONS
+                for limit, users in [bandwidth.summary(direction)]
+            )
+            + "\n".join(
+                f"┠ **{stage}:** {active}/{limit} running, {queued} queued"
+                for stage, (active, limit, queued) in job_scheduler.stats().items()
+            )
         )
 
         
@@ -176,6 +338,139 @@ async def stats_command(client, message):
         logging.error(f"Error in stats command: {str(e)}")
         await message.reply_text("An error occurred while retrieving system stats.")
         
+@app.on_message(filters.command("aria2") & filters.user(ADMIN_IDS))
+async def aria2_command(client, message):
+    """Show aria2's profile, or change it: ``/aria2 split=8 max-concurrent-downloads=3``"""
+    settings = message.command[1:]
+    if not settings:
+        await message.reply_text(
+            f"⚙️ **aria2** {aria2_supervisor.summary()}\n"
+            + "\n".join(f"┠ `{name}` = `{value}`" for name, value in sorted(aria2_supervisor.profile.items()))
+        )
+        return
+    
+    options = {}
+    for setting in settings:
+        name, separator, value = setting.partition('=')
+        if not separator:
+            await message.reply_text("❌ **Usage:** `/aria2 [option=value ...]`")
+            return
+        options[name] = value
+    
+    try:
+        pending = await aria2_supervisor.tune(**options)
+    except Exception as e:
+        await message.reply_text(f"❌ **aria2 rejected the change:** {str(e)}")
+        return
+    text = "✅ **aria2 options updated**, new downloads use them"
+    if pending:
+        text += f"\n♻️ **Applies after a restart:** {', '.join(pending)}"
+    await message.reply_text(text)
+
+@app.on_message(filters.command("bandwidth") & filters.user(ADMIN_IDS))
+async def bandwidth_command(client, message):
+    """Show the bandwidth shares, or change them:
+    ``/bandwidth download 50M``, ``/bandwidth upload off``, ``/bandwidth weight <user_id> 2``"""
+    args = message.command[1:]
+    try:
+        if len(args) == 2 and args[0] in DIRECTIONS:
+            bandwidth.set_limit(args[0], parse_rate(args[1]))
+        elif len(args) == 3 and args[0] == 'weight':
+            weight = float(args[2])
+            if weight <= 0:
+                raise ValueError("The weight must be positive")
+            bandwidth.set_weight(int(args[1]), weight)
+        elif args:
+            raise ValueError("Usage: `/bandwidth [download|upload <rate>]` or `/bandwidth weight <user_id> <weight>`")
+    except ValueError as e:
+        await message.reply_text(f"❌ **{str(e)}**")
+        return
+    
+    lines = []
+    for direction in DIRECTIONS:
+        limit, users = bandwidth.summary(direction)
+        lines.append(f"📶 **{direction.capitalize()}:** {format_speed(limit) if limit else 'unlimited'}")
+        for user_id, (transfers, rate) in users.items():
+            share = format_speed(rate) if limit else 'unlimited'
+            lines.append(f"┠ `{user_id}`: {transfers} transfers, {share}")
+    if bandwidth.weights:
+        lines.append("⚖️ **Weights:** " + ", ".join(f"`{user_id}` x{weight:g}" for user_id, weight in bandwidth.weights.items()))
+    await message.reply_text("\n".join(lines))
+
+def describe_destination(destination):
+    if not destination:
+        return "off (choose after each download)"
+    if destination['type'] == 'telegram':
+        return "Telegram"
+    return f"{destination['remote']}:{destination['path'] or '/'}"
+
+@app.on_message(filters.command("autodest"))
+async def autodest_command(client, message):
+    try:
+        user_id = message.from_user.id
+        args = message.text.split(maxsplit=1)
+        
+        if len(args) == 1:
+            await message.reply_text(
+                f"🎯 **Auto destination:** {describe_destination(auto_destinations.get(user_id))}\n\n"
+                "Downloads from /l are uploaded there while they are still downloading.\n"
+                "**Usage:**\n"
+                "• `/autodest telegram`\n"
+                "• `/autodest remote:path/to/folder`\n"
+                "• `/autodest off`"
+            )
+            return
+        
+        choice = args[1].strip()
+        if choice.lower() == 'off':
+            auto_destinations.pop(user_id, None)
+        elif choice.lower() == 'telegram':
+            auto_destinations[user_id] = {'type': 'telegram'}
+        else:
+            remote, separator, path = choice.partition(':')
+            if not separator or remote not in get_available_remotes(user_id):
+                await message.reply_text("❌ **Remote not found in your rclone config!**")
+                return
+            auto_destinations[user_id] = {'type': 'rclone', 'remote': remote, 'path': path.strip('/')}
+        
+        await message.reply_text(f"✅ **Auto destination:** {describe_destination(auto_destinations.get(user_id))}")
+    except Exception as e:
+        logging.error(f"Error in autodest command: {str(e)}")
+        await message.reply_text("❌ Error updating auto destination")
+
+@app.on_message(filters.command("setthumb"))
+async def setthumb_command(client, message):
+    try:
+        source = message.reply_to_message
+        image = source and (source.photo or (
+            source.document and (source.document.mime_type or "").startswith("image/") and source.document
+        ))
+        if not image:
+            await message.reply_text(
+                "❌ **Invalid usage!**\n"
+                "Reply to a photo with `/setthumb` to use it as the thumbnail of your uploads."
+            )
+            return
+        
+        user_id = message.from_user.id
+        image_path = await source.download(file_name=str(get_user_download_dir(user_id) / f"thumb_{source.id}"))
+        try:
+            await thumb_store.set(user_id, image_path)
+        finally:
+            if image_path and os.path.exists(image_path):
+                os.remove(image_path)
+        await message.reply_text("✅ **Thumbnail saved!** It will be used for all your uploads. Use /delthumb to remove it.")
+    except Exception as e:
+        logging.error(f"Error in setthumb command: {str(e)}")
+        await message.reply_text("❌ Error saving thumbnail")
+
+@app.on_message(filters.command("delthumb"))
+async def delthumb_command(client, message):
+    if thumb_store.delete(message.from_user.id):
+        await message.reply_text("✅ **Thumbnail removed!**")
+    else:
+        await message.reply_text("❌ No thumbnail set")
+
 @app.on_message(filters.document)
 async def handle_document(client, message):
     try:
@@ -194,17 +489,13 @@ async def handle_document(client, message):
             
             # Remove user from pending list
             pending_rclone_users.remove(user_id)
+            folder_cache.invalidate(user_id)
             
             # Verify the config by listing remotes
-            remotes = get_available_remotes(config_path)
+            remotes = get_available_remotes(user_id)
             if remotes:
                 # Show available remotes
-                buttons = []
-                for remote in remotes:
-                    buttons.append([InlineKeyboardButton(
-                        f"📁 {remote}", 
-                        callback_data=f"remote_{remote}_"
-                    )])
+                buttons = remote_buttons(user_id)
                 buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel")])
                 
                 await message.reply_text(
@@ -225,149 +516,927 @@ async def handle_document(client, message):
         await message.reply_text("❌ No remotes found in config file!")
 
 @app.on_message(filters.document | filters.video | filters.audio | filters.photo)
+@detached
 async def handle_telegram_download(client, message):
     try:
         user_id = message.from_user.id
         
-        # Get file name and size based on message type
+        # Get file name, size and file_id based on message type
         if message.document:
             file_name = message.document.file_name
             file_size = message.document.file_size
+            file_id = message.document.file_id
         elif message.video:
             file_name = message.video.file_name
             file_size = message.video.file_size
+            file_id = message.video.file_id
         elif message.audio:
             file_name = message.audio.file_name
             file_size = message.audio.file_size
+            file_id = message.audio.file_id
         elif message.photo:
             file_name = f"photo_{message.photo.file_unique_id}.jpg"
             file_size = message.photo.file_size
+            file_id = message.photo.file_id
         else:
             file_name = f"file_{message.id}"
             file_size = 0
+            file_id = None
+        file_name = file_name or f"file_{message.id}"
             
         progress_msg = await message.reply_text(
-            f"🔽 **Starting download...**\n"
+            f"📥 **File received**\n"
             f"📄 **File:** {file_name}\n"
-            f"📏 **Size:** {format_size(file_size)}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-            ])
+            f"📏 **Size:** {format_size(file_size)}"
         )
-            
-        # Generate unique file path
-        user_download_dir = get_user_download_dir(user_id)
-        file_path = user_download_dir / file_name
         
-        # Track download in database
+        # Nothing is downloaded yet: a Telegram destination re-sends the file
+        # by file_id, and only cloud uploads fetch the bytes to disk
         downloads_db[progress_msg.id] = {
-            'file_path': str(file_path),
+            'file_path': None,
             'file_name': file_name,
-            'file_size': file_size
+            'file_size': file_size,
+            'file_id': file_id,
+            'source_chat_id': message.chat.id,
+            'source_message_id': message.id,
+            'chat_id': progress_msg.chat.id,
+            'user_id': user_id,
+            'stage': 'on_telegram'
         }
         
-        # Progress callback for download
-        start_time = time.time()
-        last_update_time = start_time
-        last_downloaded = 0
+        await show_upload_options(progress_msg, file_name, file_size, header="📥 **File received!**")
         
-        async def progress(current, total):
-            nonlocal last_update_time, last_downloaded
-            now = time.time()
+    except Exception as e:
+        logging.error(f"Error in telegram download: {str(e)}")
+        await message.reply_text("❌ **Download failed**")
+
+async def fetch_telegram_media(client, progress_msg, info):
+    """Download the Telegram file behind a downloads_db entry to disk, for
+    steps that need a local copy such as extracting an archive. Raises
+    StopTransmission if the job is cancelled meanwhile."""
+    source_msg = await client.get_messages(info['source_chat_id'], info['source_message_id'])
+    file_name = info['file_name']
+    
+    # Generate unique file path
+    user_download_dir = get_user_download_dir(info['user_id'])
+    file_path = user_download_dir / file_name
+    
+    info['stage'] = 'downloading'
+    downloads_db.persist(progress_msg.id)
+    
+    # Progress callback for download
+    start_time = time.time()
+    last_update_time = start_time
+    last_downloaded = 0
+    
+    async def progress(current, total):
+        nonlocal last_update_time, last_downloaded
+        # The entry disappears when the user cancels
+        if progress_msg.id not in downloads_db:
+            raise StopTransmission
+        now = time.time()
+        
+        if now - last_update_time >= 1:
+            time_diff = now - last_update_time
+            size_diff = current - last_downloaded
+            speed = size_diff / time_diff if time_diff > 0 else 0
             
-            if now - last_update_time >= 3:
-                time_diff = now - last_update_time
-                size_diff = current - last_downloaded
-                speed = size_diff / time_diff if time_diff > 0 else 0
+            percentage = (current * 100) / total
+            progress_text = (
+                f"🔽 **Downloading**\n"
+                f"📄 **File:** {file_name}\n"
+                f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
+                f"⚡ **Speed:** {format_speed(speed)}\n"
+                f"📥 **Downloaded:** {format_size(current)} / {format_size(total)}"
+            )
+            
+            edit_scheduler.schedule(progress_msg, progress_text, reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+            ]))
                 
-                percentage = (current * 100) / total
-                progress_text = (
-                    f"🔽 **Downloading**\n"
-                    f"📄 **File:** {file_name}\n"
-                    f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
-                    f"⚡ **Speed:** {format_speed(speed)}\n"
-                    f"📥 **Downloaded:** {format_size(current)} / {format_size(total)}"
+            last_update_time = now
+            last_downloaded = current
+    
+    # Make sure the file fits on disk, then download it once a Telegram download slot is free
+    reservation = await disk_admission.reserve(progress_msg.id, info['user_id'], info['file_size'] or 0)
+    reservation.paths = [str(file_path)]
+    try:
+        async with job_scheduler.slot(
+            'tg_download', info['user_id'], job_id=progress_msg.id,
+            on_queued=queue_position_notifier(progress_msg, "Download")
+        ), telegram_flow(info['user_id'], 'download'):
+            await client.download_parallel(
+                source_msg,
+                str(file_path),
+                progress=progress
+            )
+    finally:
+        disk_admission.release(reservation)
+    
+    info['file_path'] = str(file_path)
+    info['stage'] = 'downloaded'
+    downloads_db.persist(progress_msg.id)
+    return str(file_path)
+
+async def show_upload_options(progress_msg, file_name, file_size, header="✅ **Download complete!**"):
+    buttons = [
+        [
+            InlineKeyboardButton("📤 Telegram", callback_data=f"telegram_{progress_msg.id}"),
+            InlineKeyboardButton("☁️ Cloud", callback_data=f"rclone_{progress_msg.id}")
+        ],
+        [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+    ]
+    
+    # Folders can be packed into one archive, archives can be unpacked first
+    info = downloads_db.get(progress_msg.id) or {}
+    if info.get('files') and not info.get('pack'):
+        buttons.insert(1, [
+            InlineKeyboardButton("📦 Tar", callback_data=f"archive_{progress_msg.id}_tar"),
+            InlineKeyboardButton("🗜 Zip", callback_data=f"archive_{progress_msg.id}_zip")
+        ])
+    elif (info.get('file_path') or info.get('stage') == 'on_telegram') and info['file_name'].lower().endswith(ARCHIVE_EXTENSIONS):
+        buttons.insert(1, [InlineKeyboardButton("📂 Extract", callback_data=f"extract_{progress_msg.id}")])
+    
+    complete_text = (
+        f"{header}\n"
+        f"📄 **File:** {file_name}\n"
+        f"📏 **Size:** {format_size(file_size)}\n"
+        f"🔽 **Choose upload destination:**"
+    )
+    
+    await edit_scheduler.edit(
+        progress_msg,
+        complete_text,
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+def can_pipeline(download, destination):
+    """Whether a download can be uploaded while it is still running: a single
+    plain file of known size, big enough to be worth it."""
+    if download.bittorrent or len(download.files) != 1 or not download.files[0].path:
+        return False
+    if download.total_length <= BIG_FILE_SIZE:
+        return False
+    return destination['type'] != 'telegram' or download.total_length <= TELEGRAM_UPLOAD_LIMIT
+
+async def pipeline_aria2_upload(progress_msg, download, destination, state):
+    """Upload an aria2 download to the user's auto destination while it is
+    still downloading, reading pieces in order as they complete. Returns
+    True once the whole file was uploaded."""
+    info = downloads_db.get(progress_msg.id)
+    if not info:
+        return False
+    file_path = download.files[0].path
+    file_name = os.path.basename(file_path)
+    source = GrowingFile(
+        file_path,
+        download.total_length,
+        file_name,
+        lambda: aria2_rpc.completed_prefix(download.gid)
+    )
+    
+    def on_sent(sent, total=None):
+        state['sent'] = sent
+    
+    try:
+        if destination['type'] == 'telegram':
+            async with job_scheduler.slot('tg_upload', info['user_id'], job_id=progress_msg.id), \
+                    telegram_flow(info['user_id'], 'upload'):
+                sent = await progress_msg.reply_document(
+                    document=source,
+                    progress=on_sent,
+                    file_name=file_name,
+                    thumb=thumb_store.get(info['user_id']),
+                    caption=file_name
                 )
-                
+            file_id, media_type = sent_file_id(sent)
+            if file_id and info.get('url'):
+                file_cache.put(url_key(info['url']), file_id, media_type)
+        else:
+            destination_path = f"{destination['remote']}:{posixpath.join(destination['path'], file_name)}"
+            async with job_scheduler.slot('rclone', info['user_id'], job_id=progress_msg.id):
+                with bandwidth.flow(info['user_id'], 'upload') as flow:
+                    await rcat(
+                        get_rclone_config_path(info['user_id']),
+                        destination_path,
+                        source.chunks(1024 * 1024),
+                        size=download.total_length,
+                        on_chunk=on_sent,
+                        flow=flow
+                    )
+            folder_cache.invalidate(info['user_id'], destination['remote'], destination['path'])
+        return True
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Pipelined upload of {file_name} failed: {str(e)}")
+        return False
+
+async def deliver_to_destination(progress_msg, destination):
+    user_id = downloads_db[progress_msg.id]['user_id']
+    if destination['type'] == 'telegram':
+        await upload_to_telegram(app, progress_msg, progress_msg.id, user_id)
+    else:
+        await upload_to_cloud(app, progress_msg, user_id, destination['remote'], destination['path'])
+
+async def admit_aria2_download(progress_msg, gids, name, size, paths):
+    """Reserve disk space for aria2 downloads whose size is now known,
+    pausing them while they don't fit. ``paths`` are the files aria2 is
+    writing, which may already be preallocated. Returns None if the job was
+    dropped."""
+    user_id = downloads_db[progress_msg.id]['user_id']
+    try:
+        reservation = await disk_admission.try_reserve(progress_msg.id, user_id, size, paths)
+        if not reservation:
+            for gid in gids:
+                await aria2_rpc.call("aria2.pause", gid)
+            await edit_scheduler.edit(
+                progress_msg,
+                f"💾 **Waiting for disk space**\n"
+                f"📄 **File:** {name}\n"
+                f"📏 **Size:** {format_size(size)}",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+                ])
+            )
+            reservation = await disk_admission.reserve(progress_msg.id, user_id, size, paths)
+            for gid in gids:
+                await aria2_rpc.call("aria2.unpause", gid)
+    except JobCancelled:
+        return None
+    except DiskFull as e:
+        logging.error(f"Download {gids[0]} rejected: {str(e)}")
+        for gid in gids:
+            await aria2_rpc.remove(gid, force=True)
+        downloads_db.pop(progress_msg.id, None)
+        await edit_scheduler.edit(
+            progress_msg,
+            f"❌ **Not enough disk space**\n"
+            f"📏 **Size:** {format_size(size)}"
+        )
+        return None
+    return reservation
+
+def remove_job_files(info):
+    """Delete what a job left on disk: its file, or every file of a batch
+    along with the folders that leaves empty."""
+    paths = [item['path'] for item in info.get('files') or []]
+    if info.get('file_path'):
+        paths.append(info['file_path'])
+    user_dir = os.path.abspath(get_user_download_dir(info['user_id']))
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+                logging.info(f"Removed file: {path}")
+        except OSError as e:
+            logging.error(f"Error removing file {path}: {str(e)}")
+        # Prune the torrent's folders on the way up, stopping at the user's folder
+        folder = os.path.dirname(os.path.abspath(path))
+        while folder.startswith(user_dir + os.sep):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+def file_selection_menu(job_id, selection):
+    """Text and keyboard of the file picker shown before a torrent or metalink starts."""
+    entries = selection['entries']
+    selected = selection['selected']
+    pages = max(1, math.ceil(len(entries) / FILES_PER_PAGE))
+    page = min(selection['page'], pages - 1)
+    
+    buttons = []
+    for position in range(page * FILES_PER_PAGE, min((page + 1) * FILES_PER_PAGE, len(entries))):
+        entry = entries[position]
+        mark = "✅" if position in selected else "⬜"
+        name = entry['name'] if len(entry['name']) <= 40 else "…" + entry['name'][-39:]
+        buttons.append([InlineKeyboardButton(
+            f"{mark} {name} ({format_size(entry['size'])})",
+            callback_data=callback_store.data('select', job=job_id, action='toggle', index=position)
+        )])
+    
+    page_buttons = []
+    if page > 0:
+        page_buttons.append(InlineKeyboardButton(
+            "◀️ Prev",
+            callback_data=callback_store.data('select', job=job_id, action='page', index=page - 1)
+        ))
+    if page < pages - 1:
+        page_buttons.append(InlineKeyboardButton(
+            "Next ▶️",
+            callback_data=callback_store.data('select', job=job_id, action='page', index=page + 1)
+        ))
+    if page_buttons:
+        buttons.append(page_buttons)
+    
+    buttons.append([
+        InlineKeyboardButton("☑️ All", callback_data=callback_store.data('select', job=job_id, action='all', index=0)),
+        InlineKeyboardButton("⬜ None", callback_data=callback_store.data('select', job=job_id, action='none', index=0))
+    ])
+    buttons.append([
+        InlineKeyboardButton("▶️ Start", callback_data=callback_store.data('select', job=job_id, action='start', index=0)),
+        InlineKeyboardButton("❌ Cancel", callback_data="cancel")
+    ])
+    
+    selected_size = sum(entries[position]['size'] for position in selected)
+    page_info = f" (page {page + 1}/{pages})" if pages > 1 else ""
+    text = (
+        f"🗂 **Choose files to download**{page_info}\n"
+        f"📄 **Name:** {selection['name']}\n"
+        f"✅ **Selected:** {len(selected)}/{len(entries)} files, {format_size(selected_size)}\n"
+        f"⏳ Starts by itself after {FILE_SELECTION_TIMEOUT // 60} minutes"
+    )
+    return text, InlineKeyboardMarkup(buttons)
+
+async def start_aria2_followers(progress_msg, downloads, name):
+    """Let the user pick files of the paused downloads a torrent, magnet or
+    metalink turned into, drop the rest through aria2's ``select-file`` (or
+    remove downloads with nothing selected), and start what is left.
+    A picker left unanswered for FILE_SELECTION_TIMEOUT starts the files
+    ticked at that point (all of them if none are), since the job holds an
+    aria2 slot while it waits. Returns the GIDs still downloading, or None
+    if the user cancelled."""
+    entries = []
+    for download in downloads:
+        for file in download.files:
+            # Show paths inside the torrent rather than where aria2 puts them
+            path = str(file.path)
+            entries.append({
+                'gid': download.gid,
+                'index': file.index,
+                'name': os.path.relpath(path, download.dir) if len(downloads) == 1 else os.path.basename(path),
+                'size': file.length
+            })
+    
+    chosen = set(range(len(entries)))
+    if len(entries) > 1:
+        loop = asyncio.get_running_loop()
+        selection = file_selections[progress_msg.id] = {
+            'name': name,
+            'entries': entries,
+            'selected': set(chosen),
+            'page': 0,
+            'future': loop.create_future()
+        }
+        try:
+            await edit_scheduler.edit(progress_msg, *file_selection_menu(progress_msg.id, selection))
+            chosen = await asyncio.wait_for(asyncio.shield(selection['future']), FILE_SELECTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            chosen = set(selection['selected']) or chosen
+        except JobCancelled:
+            return None
+        finally:
+            file_selections.pop(progress_msg.id, None)
+    
+    gids = []
+    for download in downloads:
+        indices = [str(entry['index']) for position, entry in enumerate(entries) if position in chosen and entry['gid'] == download.gid]
+        if not indices:
+            await aria2_rpc.remove(download.gid, force=True)
+            continue
+        if len(indices) < len(download.files):
+            await aria2_rpc.call("aria2.changeOption", download.gid, {'select-file': ",".join(indices)})
+        if download.status == 'paused':
+            await aria2_rpc.call("aria2.unpause", download.gid)
+        gids.append(download.gid)
+    return gids
+
+def retry_delay(attempt):
+    return min(ARIA2_RETRY_DELAY * 2 ** (attempt - 1), ARIA2_RETRY_DELAY_MAX)
+
+async def wait_before_retry(progress_msg, download, attempt, reason):
+    """Tell the user why a download is held and sleep for the backoff delay
+    of ``attempt``."""
+    delay = retry_delay(attempt)
+    await edit_scheduler.edit(
+        progress_msg,
+        f"⏸ **Download stalled**\n"
+        f"📄 **File:** {download.name}\n"
+        f"**Reason:** {reason}\n"
+        f"📥 **Kept:** {format_size(download.completed_length)} / {format_size(download.total_length)}\n"
+        f"🔁 **Retry {attempt}/{ARIA2_RETRIES} in {delay}s**",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+        ])
+    )
+    await asyncio.sleep(delay)
+
+async def restore_mirrors(download, uris):
+    """Put every known URI back on a paused single-file download. aria2 drops
+    URIs that keep failing, which would leave no mirror to fail over to."""
+    if download.bittorrent or len(download.files) != 1 or not uris:
+        return
+    try:
+        current = [uri['uri'] for uri in download.files[0].uris]
+        await aria2_rpc.call("aria2.changeUri", download.gid, 1, current, uris)
+    except Exception as e:
+        logging.error(f"Error restoring mirrors of {download.gid}: {str(e)}")
+
+async def readd_aria2_download(download, info):
+    """Add a failed download again under the same file name, so aria2 goes on
+    from the partial file and its .aria2 control file instead of starting
+    over. Returns the new GID."""
+    options = dict(info['options'])
+    path = str(download.files[0].path) if download.files else ''
+    if path not in ('', '.'):
+        options['out'] = os.path.relpath(path, str(download.dir))
+    new_download = await aria2_rpc.add_uris(info['uris'], options)
+    try:
+        await aria2_rpc.call("aria2.removeDownloadResult", download.gid)
+    except Exception as e:
+        logging.error(f"Error removing result of {download.gid}: {str(e)}")
+    return new_download.gid
+
+async def track_aria2_download(progress_msg, gid):
+    """Follow an aria2 download until it finishes. Returns a coroutine
+    function that uploads it to the user's auto destination or offers upload
+    destinations, for the caller to await once it has left its aria2 slot, or
+    None if the job ended here."""
+    last_update = 0
+    last_progress = 0
+    last_progress_time = time.time()
+    error_count = 0  # Track consecutive errors
+    retries = 0  # Stall and failure retries since the download last moved
+    status_queue = aria2_monitor.watch(gid)
+    
+    info = downloads_db.get(progress_msg.id) or {}
+    destination = auto_destinations.get(info.get('user_id'))
+    pipeline = None
+    pipeline_state = {'sent': 0}
+    completed = False
+    started = time.time()
+    reservation = None
+    flow = None  # download bandwidth share, once aria2 is transferring
+    group = None  # GIDs a metalink expanded into, followed together
+
+    try:
+        while True:
+            try:
+                # Wait for the next status pushed by the monitor. Its sweeps
+                # fail silently while aria2 is down, so ask aria2 directly when
+                # nothing arrives; a call that fails counts as an error below.
                 try:
-                    await progress_msg.edit_text(progress_text, reply_markup=InlineKeyboardMarkup([
+                    download = await asyncio.wait_for(status_queue.get(), ARIA2_STALL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    download = await aria2_rpc.get_download(gid)
+            
+                # Check if download object is valid
+                if not download:
+                    await edit_scheduler.edit(progress_msg, "❌ **Download failed: Lost connection to download**")
+                    return
+                
+                # A magnet, .torrent or metalink only fetched the metadata; the
+                # payload comes in the downloads that follow it, created paused
+                if download.is_complete and download.followed_by_ids:
+                    followers = [await aria2_rpc.get_download(follower) for follower in download.followed_by_ids]
+                    followers = [follower for follower in followers if follower]
+                    if reservation:
+                        disk_admission.release(reservation)
+                        reservation = None
+                    name = followers[0].name if len(followers) == 1 else download.name
+                    gids = await start_aria2_followers(progress_msg, followers, name)
+                    if gids is None:
+                        return
+                    if not gids:
+                        await edit_scheduler.edit(progress_msg, "❌ **Download failed: Lost connection to download**")
+                        return
+                    
+                    aria2_monitor.unwatch(gid, status_queue)
+                    gid = gids[0]
+                    status_queue = aria2_monitor.watch(gid)
+                    if flow:
+                        flow.retarget(lambda rate, gid=gid: limit_aria2([gid], rate))
+                    if progress_msg.id in downloads_db:
+                        downloads_db[progress_msg.id]['gid'] = gid
+                        if len(gids) > 1:
+                            downloads_db[progress_msg.id]['gids'] = gids
+                            downloads_db[progress_msg.id]['file_name'] = name
+                        downloads_db.persist(progress_msg.id)
+                    if len(gids) > 1:
+                        group = gids
+                        break
+                    last_progress = 0
+                    last_progress_time = time.time()
+                    continue
+                
+                # Check download status
+                if download.is_complete:
+                    completed = True
+                    break
+                elif download.has_failed:
+                    info = downloads_db.get(progress_msg.id) or {}
+                    if (download.error_code in ARIA2_TRANSIENT_ERRORS and retries < ARIA2_RETRIES
+                            and info.get('uris') and not download.bittorrent):
+                        retries += 1
+                        await wait_before_retry(progress_msg, download, retries, download.error_message or "Connection failed")
+                        if progress_msg.id not in downloads_db:
+                            return
+                        aria2_monitor.unwatch(gid, status_queue)
+                        gid = await readd_aria2_download(download, info)
+                        status_queue = aria2_monitor.watch(gid)
+                        if flow:
+                            flow.retarget(lambda rate, gid=gid: limit_aria2([gid], rate))
+                        info['gid'] = gid
+                        downloads_db.persist(progress_msg.id)
+                        last_progress_time = time.time()
+                        continue
+                    
+                    if download.error_code == ARIA2_CHECKSUM_ERROR:
+                        error_msg = "Checksum mismatch, the downloaded file is corrupt"
+                    else:
+                        error_msg = download.error_message or "Unknown error"
+                    await edit_scheduler.edit(
+                        progress_msg,
+                        f"❌ **Download failed**\n"
+                        f"**Error:** {error_msg}"
+                    )
+                    return
+            
+                # Reserve disk space as soon as aria2 knows the size
+                if reservation is None and download.total_length:
+                    paths = [str(file.path) for file in download.files if file.selected and file.path]
+                    reservation = await admit_aria2_download(progress_msg, [download.gid], download.name, download.total_length, paths)
+                    if not reservation:
+                        return
+                    last_progress_time = time.time()
+                
+                # Queued downloads don't take a share of the bandwidth
+                if flow is None and download.status == 'active':
+                    flow = bandwidth.open(info.get('user_id'), 'download', lambda rate, gid=gid: limit_aria2([gid], rate))
+                
+                now = time.time()
+            
+                # Check if download is stuck; checking existing data counts as progress
+                verifying = download.verify_integrity_pending or download.verified_length
+                moved = (download.completed_length, download.verified_length)
+                if moved != last_progress:
+                    if last_progress:
+                        retries = 0
+                    last_progress = moved
+                    last_progress_time = now
+            
+                # Only a running download can stall; queued ones are waiting their turn
+                if download.status == 'active' and now - last_progress_time >= ARIA2_STALL_TIMEOUT:
+                    if retries >= ARIA2_RETRIES:
+                        await edit_scheduler.edit(
+                            progress_msg,
+                            "❌ **Download failed: Connection timed out**\n"
+                        )
+                        try:
+                            await aria2_rpc.remove(download.gid)
+                        except:
+                            pass
+                        return
+                    
+                    # Pausing drops the dead connections but keeps the partial
+                    # file and its control file, so the retry reuses every byte
+                    retries += 1
+                    await aria2_rpc.call("aria2.pause", download.gid)
+                    await wait_before_retry(progress_msg, download, retries, f"No data for {ARIA2_STALL_TIMEOUT}s")
+                    if progress_msg.id not in downloads_db:
+                        return
+                    await restore_mirrors(download, downloads_db[progress_msg.id].get('uris'))
+                    await aria2_rpc.call("aria2.unpause", download.gid)
+                    last_progress_time = time.time()
+                    continue
+            
+                # Start uploading completed pieces as soon as the file is known
+                if destination and not pipeline and can_pipeline(download, destination):
+                    pipeline = spawn(pipeline_aria2_upload(progress_msg, download, destination, pipeline_state))
+                
+                if now - last_update >= 1:  # Sample speed every second
+                    file_name = download.name or "Downloading..."
+                    percentage = download.progress
+                    speed = download.download_speed
+                    current = download.completed_length
+                    total = download.total_length
+                
+                    progress_text = (
+                        f"🔽 **Downloading**\n"
+                        f"📄 **File:** {file_name}\n"
+                        f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
+                        f"⚡ **Speed:** {format_speed(speed)}\n"
+                        f"📥 **Downloaded:** {format_size(current)} / {format_size(total)}"
+                    )
+                    if verifying:
+                        progress_text += f"\n🔍 **Verifying:** {format_size(download.verified_length)} / {format_size(total)}"
+                    if pipeline:
+                        progress_text += f"\n📤 **Uploaded:** {format_size(pipeline_state['sent'])} / {format_size(total)}"
+                
+                    edit_scheduler.schedule(progress_msg, progress_text, reply_markup=InlineKeyboardMarkup([
                         [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
                     ]))
-                except MessageNotModified:
-                    pass
-                    
-                last_update_time = now
-                last_downloaded = current
+                    last_update = now
+                    error_count = 0  # Reset error count on successful update
+            
+            except Exception as e:
+                error_count += 1
+                logging.error(f"Error updating progress: {str(e)}")
+            
+                # If we get too many consecutive errors, abort
+                if error_count >= 5:
+                    await edit_scheduler.edit(
+                        progress_msg,
+                        "❌ **Download failed: Too many errors**\n"
+                        "The download may continue in background."
+                    )
+                    return
+    finally:
+        aria2_monitor.unwatch(gid, status_queue)
+        if flow:
+            bandwidth.close(flow)
+        if pipeline and not completed:
+            pipeline.cancel()
+        # Once written, the file is accounted for by the free space itself
+        if reservation:
+            disk_admission.release(reservation)
+
+    # Download complete, process the file
+    if progress_msg.id not in downloads_db:
+        return None
+    
+    if group:
+        return await track_aria2_group(progress_msg, group, destination, name)
+    
+    async def finish():
+        if pipeline and await pipeline:
+            file_path = download.files[0].path
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            downloads_db.pop(progress_msg.id, None)
+            await edit_scheduler.edit(
+                progress_msg,
+                f"✅ **Upload complete!**\n"
+                f"📄 **File:** {os.path.basename(file_path)}\n"
+                f"📏 **Size:** {format_size(download.total_length)}\n"
+                f"🎯 **Sent to:** {describe_destination(destination)}\n"
+                f"⏱ **Total time:** {time.time() - started:.0f}s"
+            )
+            return
+        if progress_msg.id not in downloads_db:
+            return
         
-        # Download the file
-        await message.download(
-            file_name=str(file_path),
-            progress=progress
-        )
+        # Every selected file of a torrent or metalink, not just the first one
+        paths = [str(file.path) for file in download.files if file.selected and os.path.isfile(str(file.path))]
+        if not paths:
+            await edit_scheduler.edit(progress_msg, "❌ **Download failed: Could not locate downloaded file**")
+            return
         
-        # Show upload options with file info
-        buttons = [
-                [
-                    InlineKeyboardButton("📤 Telegram", callback_data=f"telegram_{progress_msg.id}"),
-                    InlineKeyboardButton("☁️ Cloud", callback_data=f"rclone_{progress_msg.id}")
-                ],
+        # Also covers a pipelined upload that failed part-way
+        await complete_aria2_download(progress_msg, paths, destination, download.name)
+    return finish
+
+async def complete_aria2_download(progress_msg, paths, destination, name):
+    """Record the files an aria2 job produced, then upload them to the user's
+    auto destination or offer upload destinations. Several files become one
+    batch that is uploaded together."""
+    info = downloads_db[progress_msg.id]
+    header = "✅ **Download complete!**"
+    if len(paths) == 1:
+        file_path = paths[0]
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        info['file_path'] = file_path
+        media_prober.prefetch(file_path, thumbnail=not thumb_store.get(info['user_id']))
+    else:
+        user_dir = get_user_download_dir(info['user_id'])
+        info['files'] = [
+            {'path': path, 'name': os.path.relpath(path, user_dir), 'size': os.path.getsize(path)}
+            for path in paths
+        ]
+        file_name = name
+        file_size = sum(item['size'] for item in info['files'])
+        header = f"✅ **Download complete!** ({len(paths)} files)"
+    
+    info['file_name'] = file_name
+    info['file_size'] = file_size
+    info['stage'] = 'downloaded'
+    downloads_db.persist(progress_msg.id)
+    
+    if destination:
+        await deliver_to_destination(progress_msg, destination)
+    else:
+        await show_upload_options(progress_msg, file_name, file_size, header=header)
+
+async def track_aria2_group(progress_msg, gids, destination, name):
+    """Follow the downloads a metalink expanded into until all of them have
+    stopped. Like track_aria2_download, returns the upload stage of every
+    finished file to be awaited outside the aria2 slot, or None.
+    
+    Each file gets the stall and transient-error retries of a single
+    download, with its mirrors put back, but a file waiting out its backoff
+    is only held, not slept on, so the others keep going."""
+    reservation = None
+    user_id = (downloads_db.get(progress_msg.id) or {}).get('user_id')
+    gids = list(gids)
+    flow = bandwidth.open(user_id, 'download', lambda rate: limit_aria2(gids, rate))
+    mirrors = {}  # gid -> URIs the metalink listed, before aria2 drops failing ones
+    last_progress = {}  # gid -> (bytes moved, when they last changed)
+    retries = {}  # gid -> stall and failure retries since the file last moved
+    held = {}  # gid -> (time to retry at, 'unpause' or 'readd')
+    try:
+        while True:
+            statuses = await aria2_rpc.multicall([("aria2.tellStatus", [gid, STATUS_KEYS]) for gid in gids])
+            if progress_msg.id not in downloads_db:
+                return
+            if not all(statuses):
+                await edit_scheduler.edit(progress_msg, "❌ **Download failed: Lost connection to download**")
+                return
+            downloads = [Download(aria_api, status) for status in statuses]
+            
+            total = sum(download.total_length for download in downloads)
+            current = sum(download.completed_length for download in downloads)
+            speed = sum(download.download_speed for download in downloads)
+            if reservation is None and all(download.total_length for download in downloads):
+                paths = [
+                    str(file.path) for download in downloads
+                    for file in download.files if file.selected and file.path
+                ]
+                reservation = await admit_aria2_download(progress_msg, gids, name, total, paths)
+                if not reservation:
+                    return
+            
+            now = time.time()
+            for index, download in enumerate(downloads):
+                gid = download.gid
+                moved = (download.completed_length, download.verified_length)
+                if gid not in last_progress:
+                    if len(download.files) == 1:
+                        mirrors[gid] = list(dict.fromkeys(uri['uri'] for uri in download.files[0].uris))
+                    retries[gid] = 0
+                    # Still paused from a retry that was cut short by a restart
+                    if download.status == 'paused':
+                        held[gid] = (now, 'unpause')
+                elif moved != last_progress[gid][0]:
+                    retries[gid] = 0
+                if last_progress.get(gid, (None,))[0] != moved:
+                    last_progress[gid] = (moved, now)
+                
+                try:
+                    if gid in held:
+                        retry_at, action = held[gid]
+                        if now < retry_at:
+                            continue
+                        del held[gid]
+                        if action == 'readd':
+                            new_gid = await readd_aria2_download(download, {'uris': mirrors[gid], 'options': {'dir': str(download.dir)}})
+                            gids[index] = new_gid
+                            for state in (mirrors, retries, last_progress):
+                                state[new_gid] = state.pop(gid)
+                            flow.retarget(lambda rate: limit_aria2(gids, rate))
+                            downloads_db[progress_msg.id]['gids'] = gids
+                            downloads_db.persist(progress_msg.id)
+                        else:
+                            await restore_mirrors(download, mirrors.get(gid))
+                            await aria2_rpc.call("aria2.unpause", gid)
+                            last_progress[gid] = (moved, now)
+                    elif download.has_failed:
+                        if download.error_code in ARIA2_TRANSIENT_ERRORS and retries[gid] < ARIA2_RETRIES and mirrors.get(gid):
+                            retries[gid] += 1
+                            held[gid] = (now + retry_delay(retries[gid]), 'readd')
+                    # Only a running download can stall; queued ones are waiting their turn
+                    elif download.status == 'active' and now - last_progress[gid][1] >= ARIA2_STALL_TIMEOUT:
+                        if retries[gid] >= ARIA2_RETRIES:
+                            logging.error(f"aria2 download {gid} of {name} timed out")
+                            await aria2_rpc.remove(gid)
+                        else:
+                            # Pausing drops the dead connections but keeps the partial file
+                            retries[gid] += 1
+                            await aria2_rpc.call("aria2.pause", gid)
+                            held[gid] = (now + retry_delay(retries[gid]), 'unpause')
+                except Exception as e:
+                    logging.error(f"Error retrying aria2 download {gid} of {name}: {str(e)}")
+            
+            if not held and all(download.status in ('complete', 'error', 'removed') for download in downloads):
+                break
+            
+            percentage = (current * 100) / total if total else 0
+            finished = sum(download.is_complete for download in downloads)
+            progress_text = (
+                f"🔽 **Downloading**\n"
+                f"📄 **Name:** {name}\n"
+                f"🗂 **Files:** {finished}/{len(gids)} done\n"
+                f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
+                f"⚡ **Speed:** {format_speed(speed)}\n"
+                f"📥 **Downloaded:** {format_size(current)} / {format_size(total)}"
+            )
+            if held:
+                progress_text += f"\n🔁 **Retrying:** {len(held)} file(s)"
+            edit_scheduler.schedule(progress_msg, progress_text, reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-            ]
-        
-        complete_text = (
-            f"✅ **Download complete!**\n"
-            f"📄 **File:** {file_name}\n"
-            f"📏 **Size:** {format_size(file_size)}\n"
-            f"💾 **Choose upload destination:**"
+            ]))
+            await asyncio.sleep(1)
+    finally:
+        bandwidth.close(flow)
+        if reservation:
+            disk_admission.release(reservation)
+    
+    if progress_msg.id not in downloads_db:
+        return
+    
+    paths = [
+        str(file.path)
+        for download in downloads if download.is_complete
+        for file in download.files if file.selected and os.path.isfile(file.path)
+    ]
+    for download in downloads:
+        if not download.is_complete:
+            logging.error(f"aria2 download {download.gid} of {name} failed: {download.error_message}")
+    if not paths:
+        errors = [download.error_message for download in downloads if download.error_message]
+        downloads_db.pop(progress_msg.id, None)
+        await edit_scheduler.edit(
+            progress_msg,
+            f"❌ **Download failed**\n"
+            f"**Error:** {errors[0] if errors else 'Unknown error'}"
         )
+        return
+    
+    downloads_db[progress_msg.id].pop('gids', None)
+    return lambda: complete_aria2_download(progress_msg, paths, destination, name)
+
+@app.on_callback_query(filters.regex("^select_"))
+async def handle_file_selection(client, callback_query: CallbackQuery):
+    try:
+        state = callback_store.get(callback_query.data)
+        selection = file_selections.get(state['job']) if state else None
+        if not selection or selection['future'].done():
+            await callback_query.message.edit_text("⌛ This menu has expired.")
+            return
         
-        await progress_msg.edit_text(
-            complete_text,
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
+        action = state['action']
+        if action == 'toggle':
+            selection['selected'] ^= {state['index']}
+        elif action == 'page':
+            selection['page'] = state['index']
+        elif action == 'all':
+            selection['selected'] = set(range(len(selection['entries'])))
+        elif action == 'none':
+            selection['selected'] = set()
+        elif action == 'start':
+            if not selection['selected']:
+                await callback_query.answer("Select at least one file", show_alert=True)
+                return
+            selection['future'].set_result(set(selection['selected']))
+            await edit_scheduler.edit(callback_query.message, "🚀 **Starting download...**", reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+            ]))
+            return
         
-    except Exception as e:
-        logging.error(f"Error in telegram download: {str(e)}")
-        await message.reply_text("❌ **Download failed**")
+        await edit_scheduler.edit(callback_query.message, *file_selection_menu(state['job'], selection))
         
+    except Exception as e:
+        logging.error(f"Error in file selection: {str(e)}")
+        await callback_query.message.edit_text("❌ Error selecting files")
 
 @app.on_message(filters.command("l"))
+@detached
 async def handle_url(client, message):
     try:
-        # Extract URL and filename from command
+        # Extract URLs, filename and checksum from command
         command_parts = message.text.split()
-        url = None
+        uris = []
+        positional = []
         custom_filename = None
+        checksum = None
         
         # Handle reply to URL message
-        if message.reply_to_message and message.reply_to_message.text:
+        replying = bool(message.reply_to_message and message.reply_to_message.text)
+        if replying:
             # Check if the replied message contains a URL
             urls = re.findall(r'https?://[^\s]+', message.reply_to_message.text)
             if urls:
-                url = urls[0]
-                # Check if filename was provided with command
-                if len(command_parts) > 1:
-                    if command_parts[1] == '-n' and len(command_parts) > 2:
-                        custom_filename = command_parts[2]
-                    else:
-                        custom_filename = command_parts[1]
+                uris.append(urls[0])
         
-        # Handle direct command with URL
-        else:
-            if len(command_parts) > 1:
-                url = command_parts[1]
-                # Check for filename after URL
-                if len(command_parts) > 2:
-                    if command_parts[2] == '-n' and len(command_parts) > 3:
-                        custom_filename = command_parts[3]
-                    elif '-n' not in command_parts:
-                        custom_filename = command_parts[2]
+        # Further URLs are mirrors of the same file
+        args = iter(command_parts[1:])
+        for arg in args:
+            if arg == '-n':
+                custom_filename = next(args, None)
+            elif arg in ('-c', '--checksum'):
+                checksum = next(args, None)
+            elif re.match(r'(https?|ftp|sftp)://|magnet:', arg):
+                uris.append(arg)
+            else:
+                positional.append(arg)
+        # A direct command may name any source aria2 understands
+        if not uris and positional and not replying:
+            uris.append(positional.pop(0))
+        if positional and not custom_filename:
+            custom_filename = positional[0]
+        url = uris[0] if uris else None
         
-        if not url:
+        if checksum:
+            # aria2 wants e.g. sha-256=<hex>; accept sha256=<hex> too
+            checksum = re.sub(r'^sha(\d)', r'sha-\1', checksum.lower())
+        
+        if not url or (checksum is not None and '=' not in checksum):
             await message.reply_text(
                 "❌ **Invalid usage!**\n"
                 "**Usage:**\n"
-                "• `/l <url> [-n filename.ext]`\n"
+                "• `/l <url> [mirror urls...] [-n filename.ext] [-c sha-256=<digest>]`\n"
                 "• Reply to a URL with `/l [filename.ext]`"
             )
             return
@@ -401,6 +1470,11 @@ async def handle_url(client, message):
             
         user_id = message.from_user.id
         
+        # Serve straight from Telegram if this URL was uploaded before
+        if await file_cache.send(client, message.chat.id, url_key(url), caption=custom_filename, reply_to_message_id=message.id):
+            logging.info(f"Served {url} from file_id cache for user {user_id}")
+            return
+        
         # Initial download message
         progress_msg = await message.reply_text(
             f"🚀 **Initiating download...**\n"
@@ -411,166 +1485,91 @@ async def handle_url(client, message):
         )
         logging.info(f"Starting download for user {user_id}")
         
-        # Rest of the original function remains the same
-        try:
-            # Set download options
-            options = {'dir': str(get_user_download_dir(user_id))}
-            if custom_filename:
-                options['out'] = custom_filename
-                
-            # Start download
-            download = aria_api.add_uris([url], options)
-            if not download or not download.gid:
-                raise Exception("Failed to start download")
-                
-            downloads_db[progress_msg.id] = {
-                'gid': download.gid,
-                'file_path': None
-            }
-        except Exception as aria_error:
-            error_message = str(aria_error).lower()
-            if "403" in error_message:
-                await progress_msg.edit_text(
-                    "❌ **Download failed: Access Forbidden (HTTP 403)**\n"
-                )
-            elif "400" in error_message:
-                await progress_msg.edit_text(
-                    "❌ **Download failed: Bad Request (HTTP 400)**\n"
-                )
-            else:
-                await progress_msg.edit_text(
-                    f"❌ **Download failed**\n"
-                    f"**Error:** {str(aria_error)}\n"
-                    "Please try again with a different URL."
-                )
-            logging.error(f"Aria2c error for user {user_id}: {str(aria_error)}")
-            return
-            
-        # Monitor download progress
-        last_update = 0
-        stall_count = 0
-        last_progress = 0
-        error_count = 0  # Track consecutive errors
-        
-        while True:
+        # Wait for a free aria2 slot; the user sees their place in line meanwhile
+        downloads_db[progress_msg.id] = {
+            'gid': None,
+            'file_path': None,
+            'chat_id': progress_msg.chat.id,
+            'user_id': user_id,
+            'stage': 'queued'
+        }
+        async with job_scheduler.slot(
+            'aria2', user_id, job_id=progress_msg.id,
+            on_queued=queue_position_notifier(progress_msg, "Download")
+        ):
             try:
-                # Get fresh download status
-                download = aria_api.get_download(download.gid)
-                
-                # Check if download object is valid
-                if not download:
-                    await progress_msg.edit_text("❌ **Download failed: Lost connection to download**")
-                    return
-                    
-                # Check download status
-                if download.is_complete:
-                    break
-                elif download.has_failed:
-                    error_msg = download.error_message or "Unknown error"
-                    await progress_msg.edit_text(
-                        f"❌ **Download failed**\n"
-                        f"**Error:** {error_msg}"
-                    )
-                    return
-                
-                now = time.time()
-                
-                # Check if download is stuck
-                if download.progress == last_progress:
-                    stall_count += 1
-                else:
-                    stall_count = 0
-                    last_progress = download.progress
-                
-                # If download is stuck for too long (30 seconds), abort
-                if stall_count >= 30:
-                    await progress_msg.edit_text(
-                        "❌ **Download failed: Connection timed out**\n"
-                    )
-                    try:
-                        aria_api.remove([download.gid])
-                    except:
-                        pass
-                    return
-                
-                if now - last_update >= 3:  # Update every 3 seconds
-                    file_name = download.name or "Downloading..."
-                    percentage = download.progress
-                    speed = download.download_speed
-                    current = download.completed_length
-                    total = download.total_length
-                    
-                    progress_text = (
-                        f"🔽 **Downloading**\n"
-                        f"📄 **File:** {file_name}\n"
-                        f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
-                        f"⚡ **Speed:** {format_speed(speed)}\n"
-                        f"📥 **Downloaded:** {format_size(current)} / {format_size(total)}"
-                    )
-                    
-                    await progress_msg.edit_text(progress_text, reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-                    ]))
-                    last_update = now
-                    error_count = 0  # Reset error count on successful update
-                
-                await asyncio.sleep(1)
-                
-            except MessageNotModified:
-                pass
-            except Exception as e:
-                error_count += 1
-                logging.error(f"Error updating progress: {str(e)}")
+                # Set download options
+                options = {'dir': str(get_user_download_dir(user_id))}
+                if custom_filename:
+                    options['out'] = custom_filename
+                # Verify what arrives: the given checksum, or the hashes a
+                # metalink or torrent carries, also when resuming old data
+                options['check-integrity'] = 'true'
+                if checksum:
+                    options['checksum'] = checksum
+                if len(uris) > 1:
+                    # Spread segments over the mirrors, favouring the fastest
+                    options['uri-selector'] = 'adaptive'
+                # Preallocate with fallocate: instant, and keeps the file in one piece
+                options['file-allocation'] = 'falloc'
+                # Torrents, magnets and metalinks wait paused once their file
+                # list is known so the user can pick files; they stop seeding
+                # as soon as the payload is complete
+                options['pause-metadata'] = 'true'
+                options['seed-time'] = '0'
+                if user_id in auto_destinations:
+                    # Fetch pieces in order so uploading can follow the download
+                    options['stream-piece-selector'] = 'inorder'
                 
-                # If we get too many consecutive errors, abort
-                if error_count >= 5:
+                # Start download
+                download = await aria2_rpc.add_uris(uris, options)
+                if not download or not download.gid:
+                    raise Exception("Failed to start download")
+                
+                download_gid = download.gid
+                downloads_db[progress_msg.id] = {
+                    'gid': download_gid,
+                    'url': url,
+                    'uris': uris,  # Kept to retry a failed download where it stopped
+                    'options': options,
+                    'file_path': None,
+                    'chat_id': progress_msg.chat.id,
+                    'user_id': user_id,
+                    'stage': 'downloading'
+                }
+            except Exception as aria_error:
+                error_message = str(aria_error).lower()
+                if "403" in error_message:
                     await progress_msg.edit_text(
-                        "❌ **Download failed: Too many errors**\n"
-                        "The download may continue in background."
+                        "❌ **Download failed: Access Forbidden (HTTP 403)**\n"
                     )
-                    return
-                    
-                await asyncio.sleep(1)
-        
-        # Download complete, process the file
-        if download.is_complete:
-            if not download.files or not download.files[0].path:
-                await progress_msg.edit_text("❌ **Download failed: Could not locate downloaded file**")
+                elif "400" in error_message:
+                    await progress_msg.edit_text(
+                        "❌ **Download failed: Bad Request (HTTP 400)**\n"
+                    )
+                else:
+                    await progress_msg.edit_text(
+                        f"❌ **Download failed**\n"
+                        f"**Error:** {str(aria_error)}\n"
+                        "Please try again with a different URL."
+                    )
+                logging.error(f"Aria2c error for user {user_id}: {str(aria_error)}")
                 return
-                
-            file_path = download.files[0].path
-            file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
-            
-            downloads_db[progress_msg.id]['file_path'] = file_path
-            downloads_db[progress_msg.id]['file_name'] = file_name
-            downloads_db[progress_msg.id]['file_size'] = file_size
             
-            buttons = [
-                [
-                    InlineKeyboardButton("📤 Telegram", callback_data=f"telegram_{progress_msg.id}"),
-                    InlineKeyboardButton("☁️ Cloud", callback_data=f"rclone_{progress_msg.id}")
-                ],
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-            ]
-            
-            complete_text = (
-                f"✅ **Download complete!**\n"
-                f"📄 **File:** {file_name}\n"
-                f"📏 **Size:** {format_size(file_size)}\n"
-                f"🔽 **Choose upload destination:**"
-            )
-            
-            await progress_msg.edit_text(
-                complete_text,
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
+            finish = await track_aria2_download(progress_msg, download_gid)
+        
+        # Uploads run after the aria2 slot is released
+        if finish:
+            await finish()
         
+    except JobCancelled:
+        return
     except Exception as e:
         logging.error(f"Error in handle_url: {str(e)}")
         await message.reply_text("❌ **Error processing URL**")
         
 @app.on_message(filters.command("yl"))
+@detached
 async def handle_ytdl(client, message):
     try:
         # Extract URL and filename from command
@@ -611,12 +1610,51 @@ async def handle_ytdl(client, message):
             )
             return
 
+        # Serve straight from Telegram if this URL was uploaded before
+        if await file_cache.send(client, message.chat.id, url_key(url), caption=custom_filename, reply_to_message_id=message.id):
+            logging.info(f"Served {url} from file_id cache")
+            return
+
         # Initial download message
         progress_msg = await message.reply_text(
             f"🚀 **Initiating download...**\n"
-            f"🔗 **URL:** {url[:50]}..." if len(url) > 50 else url
+            f"🔗 **URL:** {url[:50]}..." if len(url) > 50 else url,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+            ])
         )
         
+        # Track the job so the cancel button can stop it
+        ytdl_job = YtdlJob()
+        downloads_db[progress_msg.id] = {
+            'file_path': None,
+            'chat_id': progress_msg.chat.id,
+            'user_id': message.from_user.id,
+            'stage': 'downloading',
+            'ytdl_job': ytdl_job
+        }
+        
+        def on_progress(status):
+            if status['status'] != 'downloading':
+                return
+            current = status['downloaded']
+            total = status['total']
+            if reservation:
+                reservation.written = current
+            percentage = (current * 100) / total if total else 0
+            eta = f"{status['eta']}s" if status['eta'] is not None else "-"
+            progress_text = (
+                f"🔽 **Downloading**\n"
+                f"📄 **File:** {os.path.basename(status['filename'] or '')}\n"
+                f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
+                f"⚡ **Speed:** {format_speed(status['speed'])}\n"
+                f"📥 **Downloaded:** {format_size(current)} / {format_size(total)}\n"
+                f"⏳ **ETA:** {eta}"
+            )
+            edit_scheduler.schedule(progress_msg, progress_text, reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+            ]))
+        
         # Configure base yt-dlp options
         ydl_opts = {
             'quiet': True,
@@ -639,98 +1677,208 @@ async def handle_ytdl(client, message):
             else:
                 ydl_opts['outtmpl'] = os.path.join(get_user_download_dir(message.from_user.id), custom_filename)
 
-        try:
-            # Download using yt-dlp
-            with YoutubeDL(ydl_opts) as ydl:
-                await progress_msg.edit_text("⏳ **Extracting information...**")
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
+        async with job_scheduler.slot(
+            'ytdl', message.from_user.id, job_id=progress_msg.id,
+            on_queued=queue_position_notifier(progress_msg, "Download")
+        ):
+            try:
+                # Download using yt-dlp on a worker thread
+                await edit_scheduler.edit(progress_msg, "⏳ **Extracting information...**", reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+                ]))
+                async def admit(info):
+                    nonlocal reservation
+                    size = expected_size(info)
+                    reservation = await disk_admission.try_reserve(progress_msg.id, message.from_user.id, size)
+                    if not reservation:
+                        await edit_scheduler.edit(
+                            progress_msg,
+                            f"💾 **Waiting for disk space**\n"
+                            f"📏 **Size:** {format_size(size)}",
+                            reply_markup=InlineKeyboardMarkup([
+                                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+                            ])
+                        )
+                        reservation = await disk_admission.reserve(progress_msg.id, message.from_user.id, size)
                 
-            if not filename or not os.path.exists(filename):
-                await progress_msg.edit_text("❌ **Download failed: Could not locate downloaded file**")
-                return
+                reservation = None
+                try:
+                    filename = await ytdl_runner.download(url, ydl_opts, ytdl_job, on_progress=on_progress, admit=admit)
+                finally:
+                    if reservation:
+                        disk_admission.release(reservation)
                 
-            file_size = os.path.getsize(filename)
-            
-            # Store download information
-            downloads_db[progress_msg.id] = {
-                'file_path': filename,
-                'file_name': os.path.basename(filename),
-                'file_size': file_size
-            }
+                # A cancel that landed as the download finished already dropped
+                # the entry; writing it back would leave a job to resume
+                if progress_msg.id not in downloads_db or ytdl_job.cancelled:
+                    ytdl_job.cleanup()
+                    if filename and os.path.exists(filename):
+                        os.remove(filename)
+                    logging.info(f"YT-DLP download cancelled: {url}")
+                    return
+                
+                if not filename or not os.path.exists(filename):
+                    downloads_db.pop(progress_msg.id, None)
+                    await edit_scheduler.edit(progress_msg, "❌ **Download failed: Could not locate downloaded file**")
+                    return
+                
+                file_size = os.path.getsize(filename)
             
-            # Create upload buttons
-            buttons = [
-                [
-                    InlineKeyboardButton("📤 Telegram", callback_data=f"telegram_{progress_msg.id}"),
-                    InlineKeyboardButton("☁️ Cloud", callback_data=f"rclone_{progress_msg.id}")
-                ],
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-            ]
+                # Store download information
+                info = downloads_db[progress_msg.id]
+                info.pop('ytdl_job', None)
+                info.update({
+                    'url': url,
+                    'file_path': filename,
+                    'file_name': os.path.basename(filename),
+                    'file_size': file_size,
+                    'stage': 'downloaded'
+                })
+                downloads_db.persist(progress_msg.id)
+                media_prober.prefetch(filename, thumbnail=not thumb_store.get(message.from_user.id))
             
-            complete_text = (
-                f"✅ **Download complete!**\n"
-                f"📄 **File:** {os.path.basename(filename)}\n"
-                f"📏 **Size:** {format_size(file_size)}\n"
-                f"🔽 **Choose upload destination:**"
-            )
+                # Create upload buttons
+                buttons = [
+                    [
+                        InlineKeyboardButton("📤 Telegram", callback_data=f"telegram_{progress_msg.id}"),
+                        InlineKeyboardButton("☁️ Cloud", callback_data=f"rclone_{progress_msg.id}")
+                    ],
+                    [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+                ]
             
-            await progress_msg.edit_text(
-                complete_text,
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
+                complete_text = (
+                    f"✅ **Download complete!**\n"
+                    f"📄 **File:** {os.path.basename(filename)}\n"
+                    f"📏 **Size:** {format_size(file_size)}\n"
+                    f"🔽 **Choose upload destination:**"
+                )
             
-        except Exception as ydl_error:
-            error_message = str(ydl_error).lower()
-            if "copyright" in error_message:
-                await progress_msg.edit_text("❌ **Download failed: Content is copyright protected**")
-            elif "private" in error_message:
-                await progress_msg.edit_text("❌ **Download failed: Content is private or unavailable**")
-            else:
-                await progress_msg.edit_text(
-                    f"❌ **Download failed**\n"
-                    f"**Error:** {str(ydl_error)}"
+                await edit_scheduler.edit(
+                    progress_msg,
+                    complete_text,
+                    reply_markup=InlineKeyboardMarkup(buttons)
                 )
-            logging.error(f"YT-DLP error: {str(ydl_error)}")
-            return
             
+            except Exception as ydl_error:
+                if ytdl_job.cancelled:
+                    ytdl_job.cleanup()
+                    logging.info(f"YT-DLP download cancelled: {url}")
+                    return
+                downloads_db.pop(progress_msg.id, None)
+                error_message = str(ydl_error).lower()
+                if "copyright" in error_message:
+                    await edit_scheduler.edit(progress_msg, "❌ **Download failed: Content is copyright protected**")
+                elif "private" in error_message:
+                    await edit_scheduler.edit(progress_msg, "❌ **Download failed: Content is private or unavailable**")
+                else:
+                    await edit_scheduler.edit(
+                        progress_msg,
+                        f"❌ **Download failed**\n"
+                        f"**Error:** {str(ydl_error)}"
+                    )
+                logging.error(f"YT-DLP error: {str(ydl_error)}")
+                return
+            
+    except JobCancelled:
+        return
     except Exception as e:
         logging.error(f"Error in handle_ytdl: {str(e)}")
         await message.reply_text("❌ **Error processing URL**")
 
         
-def get_metadata(video_path):
-    width, height, duration = 1280, 720, 0
-    try:
-        video_streams = ffmpeg.probe(video_path, select_streams="v")
-        for item in video_streams.get("streams", []):
-            height = item["height"]
-            width = item["width"]
-        duration = int(float(video_streams["format"]["duration"]))
-    except Exception as e:
-        logging.error(e)
+async def upload_split_file(message, file_path, file_name, file_size, is_video, progress, thumb=None):
+    """Upload a file over Telegram's size limit as a series of parts, cutting
+    the next part while the current one uploads. Returns the last message sent."""
+    work_dir = f"{file_path}.parts"
+    os.makedirs(work_dir, exist_ok=True)
+    if is_video:
+        parts = iter_video_parts(file_path, file_name, work_dir)
+    else:
+        parts = iter_byte_parts(file_path, file_name)
+    
+    uploaded = 0
+    sent = None
     try:
-        thumb = pathlib.Path(video_path).parent.joinpath(f"{uuid.uuid4().hex}-thunmnail.png").as_posix()
-        ffmpeg.input(video_path, ss=duration / 2).filter("scale", width, -1).output(thumb, vframes=1).run()
-    except ffmpeg._run.Error:
-        thumb = None
-    return dict(height=height, width=width, duration=duration, thumb=thumb)
-        
+        # Closing stops the part being cut before its folder is removed
+        async with aclosing(prefetch(parts)) as stream:
+            async for part in stream:
+                async def part_progress(current, total):
+                    await progress(min(uploaded + current, file_size), file_size)
+            
+                try:
+                    if is_video:
+                        sent = await message.reply_video(
+                            video=part.source,
+                            progress=part_progress,
+                            file_name=part.name,
+                            thumb=thumb,
+                            supports_streaming=True,
+                            caption=part.name
+                        )
+                    else:
+                        sent = await message.reply_document(
+                            document=part.source,
+                            progress=part_progress,
+                            file_name=part.name,
+                            thumb=thumb,
+                            caption=part.name
+                        )
+                finally:
+                    part.cleanup()
+                uploaded += part.size
+                logging.info(f"Uploaded part {part.index} of {file_name}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return sent
+
 @app.on_callback_query(filters.regex("^telegram_"))
+@detached
 async def handle_telegram_upload(client, callback_query: CallbackQuery):
+    msg_id = int(callback_query.data.split('_')[1])
+    await upload_to_telegram(client, callback_query.message, msg_id, callback_query.from_user.id)
+
+async def upload_to_telegram(client, message, msg_id, user_id):
+    """Send the file behind a downloads_db entry to the chat of ``message``."""
     try:
-        msg_id = int(callback_query.data.split('_')[1])
         download_info = downloads_db.get(msg_id)
         
+        # A batch the user chose to receive as one tar
+        if download_info and download_info.get('pack') == 'tar':
+            await upload_tar_to_telegram(message, msg_id, user_id, download_info)
+            return
+        
+        # The files of a torrent or metalink go out together
+        if download_info and download_info.get('files'):
+            await upload_batch_to_telegram(client, message, msg_id, user_id, download_info)
+            return
+        
+        # Media that already lives on Telegram is re-sent by file_id, no transfer needed
+        if download_info and download_info.get('file_id') and not download_info['file_path']:
+            await client.send_cached_media(
+                message.chat.id,
+                download_info['file_id'],
+                caption=download_info['file_name'],
+                reply_to_message_id=message.id
+            )
+            del downloads_db[msg_id]
+            await edit_scheduler.edit(
+                message,
+                f"✅ **Upload complete!**\n"
+                f"📄 **File:** {download_info['file_name']}\n"
+                f"📏 **Size:** {format_size(download_info['file_size'])}"
+            )
+            return
+        
         if not download_info or not download_info['file_path']:
-            await callback_query.message.edit_text("❌ **Download information not found**")
+            await message.edit_text("❌ **Download information not found**")
             return
             
         file_path = download_info['file_path']
         file_name = download_info['file_name']
         file_size = download_info['file_size']
         file_type = download_info.get('file_type', 'document')
-        message = callback_query.message
+        download_info['stage'] = 'uploading'
+        downloads_db.persist(msg_id)
         
         # Initialize upload progress
         start_time = time.time()
@@ -741,7 +1889,7 @@ async def handle_telegram_upload(client, callback_query: CallbackQuery):
             nonlocal last_update_time, last_uploaded
             now = time.time()
             
-            if now - last_update_time >= 3:
+            if now - last_update_time >= 1:
                 time_diff = now - last_update_time
                 size_diff = current - last_uploaded
                 speed = size_diff / time_diff if time_diff > 0 else 0
@@ -755,12 +1903,9 @@ async def handle_telegram_upload(client, callback_query: CallbackQuery):
                     f"📤 **Uploaded:** {format_size(current)} / {format_size(total)}"
                 )
                 
-                try:
-                    await message.edit_text(progress_text, reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-                    ]))
-                except MessageNotModified:
-                    pass
+                edit_scheduler.schedule(message, progress_text, reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+                ]))
                 
                 last_update_time = now
                 last_uploaded = current
@@ -774,67 +1919,125 @@ async def handle_telegram_upload(client, callback_query: CallbackQuery):
         
         # Determine file type and use appropriate upload method
         file_ext = os.path.splitext(file_name)[1].lower()
+        is_video = file_type == 'video' or file_ext in VIDEO_EXTENSIONS
+        is_split = file_size > TELEGRAM_UPLOAD_LIMIT
         
-        try:
-            if file_type == 'video' or file_ext in ['.mp4', '.mkv', '.avi', '.mov', '.flv']:
-                # Get video metadata including thumbnail
-                meta = get_metadata(file_path)
-                thumb_path = meta.pop('thumb', None)
-                
-                # Add process to uploads_db for cancellation
-                uploads_db[message.id] = {
-                    'ffmpeg_process': None,
-                    'temp_files': [thumb_path] if thumb_path else []
-                }
-                
+        # A custom thumbnail replaces the one we would cut from the video
+        custom_thumb = thumb_store.get(user_id)
+        
+        # Identical content uploaded before can be re-sent by file_id. The
+        # URL is free to check; hashing only pays off when some cached
+        # content has this exact size.
+        sent = None
+        if download_info.get('url'):
+            sent = await file_cache.send(client, message.chat.id, url_key(download_info['url']), caption=file_name, reply_to_message_id=message.id)
+        content_hash = None
+        if not sent and file_cache.has_size(file_size):
+            content_hash = await hash_file(file_path)
+            sent = await file_cache.send(client, message.chat.id, content_key(file_size, content_hash), caption=file_name, reply_to_message_id=message.id)
+        if sent:
+            # Drop a probe started when the download finished
+            media_prober.forget(file_path)
+            os.remove(file_path)
+            del downloads_db[msg_id]
+            await edit_scheduler.edit(
+                message,
+                f"⚡ **Sent from cache!**\n"
+                f"📄 **File:** {file_name}\n"
+                f"📏 **Size:** {format_size(file_size)}"
+            )
+            logging.info(f"Telegram upload served from cache for file: {file_name}")
+            return
+        
+        # Usually already probed since the download finished
+        if is_video and not is_split:
+            metadata = media_prober.metadata(file_path, thumbnail=not custom_thumb)
+        
+        # Hash alongside the upload, which reads the same pages, to key the
+        # file_id we get back
+        hashing = None
+        if content_hash is None and not is_split:
+            async def hash_upload():
                 try:
-                    # Upload video with metadata
-                    await callback_query.message.reply_video(
-                        video=file_path,
+                    return await hash_file(file_path)
+                except OSError as e:
+                    logging.error(f"Error hashing {file_name}: {str(e)}")
+                    return None
+            hashing = spawn(hash_upload())
+        
+        async with job_scheduler.slot(
+            'tg_upload', user_id, job_id=msg_id,
+            on_queued=queue_position_notifier(message, "Upload")
+        ), telegram_flow(user_id, 'upload'):
+            upload_started = time.time()
+            try:
+                if is_split:
+                    # Too big for a single message, send it in parts
+                    sent = await upload_split_file(message, file_path, file_name, file_size, is_video, progress, thumb=custom_thumb)
+                elif is_video:
+                    # Get video metadata including thumbnail
+                    meta = dict(await metadata)
+                    thumb_path = meta.pop('thumb', None) or custom_thumb
+                
+                    try:
+                        # Upload video with metadata
+                        sent = await message.reply_video(
+                            video=file_path,
+                            progress=progress,
+                            file_name=file_name,
+                            thumb=thumb_path,
+                            supports_streaming=True,
+                            caption=file_name,
+                            **meta  # Includes height, width, duration
+                        )
+                    finally:
+                        # Clean up thumbnail if it was created
+                        media_prober.forget(file_path)
+                elif file_type == 'audio' or file_ext in ['.mp3', '.m4a', '.wav', '.ogg', '.flac']:
+                    sent = await message.reply_audio(
+                        audio=file_path,
                         progress=progress,
                         file_name=file_name,
-                        thumb=thumb_path,
-                        supports_streaming=True,
-                        caption=file_name,
-                        **meta  # Includes height, width, duration
+                        thumb=custom_thumb
                     )
-                finally:
-                    # Clean up thumbnail if it was created
-                    if thumb_path and os.path.exists(thumb_path):
-                        try:
-                            os.remove(thumb_path)
-                        except Exception as e:
-                            logging.error(f"Error removing thumbnail: {str(e)}")
-            elif file_type == 'audio' or file_ext in ['.mp3', '.m4a', '.wav', '.ogg', '.flac']:
-                await callback_query.message.reply_audio(
-                    audio=file_path,
-                    progress=progress,
-                    file_name=file_name
-                )
-            elif file_type == 'photo' or file_ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                await callback_query.message.reply_photo(
-                    photo=file_path,
-                    progress=progress,
-                    file_name=file_name
-                )
-            else:
-                await callback_query.message.reply_document(
+                elif file_type == 'photo' or file_ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                    sent = await message.reply_photo(
+                        photo=file_path,
+                        progress=progress,
+                        file_name=file_name
+                    )
+                else:
+                    sent = await message.reply_document(
+                        document=file_path,
+                        progress=progress,
+                        file_name=file_name,
+                        thumb=custom_thumb
+                    )
+            except asyncio.TimeoutError:
+                logging.error("Upload timed out")
+                await edit_scheduler.edit(message, "❌ Upload timed out")
+                return
+            except Exception as upload_error:
+                if is_split:
+                    raise
+                logging.error(f"Error during specific upload type, falling back to document: {str(upload_error)}")
+                # Fallback to document upload if specific media upload fails
+                sent = await message.reply_document(
                     document=file_path,
                     progress=progress,
-                    file_name=file_name
+                    file_name=file_name,
+                    thumb=custom_thumb
                 )
-        except asyncio.TimeoutError:
-            logging.error("Upload timed out")
-            await message.edit_text("❌ Upload timed out")
-            return
-        except Exception as upload_error:
-            logging.error(f"Error during specific upload type, falling back to document: {str(upload_error)}")
-            # Fallback to document upload if specific media upload fails
-            await callback_query.message.reply_document(
-                document=file_path,
-                progress=progress,
-                file_name=file_name
-            )
+        
+        # Remember the file_id so the same content is never uploaded twice
+        file_id, media_type = sent_file_id(sent)
+        if file_id and not is_split:
+            if hashing:
+                content_hash = await hashing
+            if content_hash:
+                file_cache.put(content_key(file_size, content_hash), file_id, media_type)
+            if download_info.get('url'):
+                file_cache.put(url_key(download_info['url']), file_id, media_type)
         
         os.remove(file_path)
         del downloads_db[msg_id]
@@ -842,14 +2045,400 @@ async def handle_telegram_upload(client, callback_query: CallbackQuery):
         complete_text = (
             f"✅ **Upload complete!**\n"
             f"📄 **File:** {file_name}\n"
-            f"📏 **Size:** {format_size(file_size)}"
+            f"📏 **Size:** {format_size(file_size)}\n"
+            f"⚡ **Average speed:** {format_speed(file_size / max(time.time() - upload_started, 0.001))}"
         )
-        await message.edit_text(complete_text)
+        await edit_scheduler.edit(message, complete_text)
         logging.info(f"Telegram upload completed for file: {file_name}")
         
+    except JobCancelled:
+        return
     except Exception as e:
         logging.error(f"Error in telegram upload: {str(e)}")
-        await callback_query.message.edit_text("❌ **Upload failed**")
+        await edit_scheduler.edit(message, "❌ **Upload failed**")
+
+async def batch_media(kind, item, custom_thumb):
+    """InputMedia for one file of a Telegram album."""
+    caption = os.path.basename(item['name'])
+    if kind == 'photo':
+        return InputMediaPhoto(item['path'], caption=caption)
+    if kind == 'video':
+        meta = dict(await media_prober.metadata(item['path'], thumbnail=not custom_thumb))
+        thumb_path = meta.pop('thumb', None) or custom_thumb
+        return InputMediaVideo(item['path'], thumb=thumb_path, caption=caption, supports_streaming=True, **meta)
+    if kind == 'audio':
+        return InputMediaAudio(item['path'], thumb=custom_thumb, caption=caption)
+    return InputMediaDocument(item['path'], thumb=custom_thumb, caption=caption)
+
+async def send_batch_group(client, message, group, custom_thumb, progress):
+    """Send one planned album: a real media group when it holds several
+    files, otherwise a single message (in parts if it is too big)."""
+    if len(group) > 1:
+        media = [await batch_media(kind, item, custom_thumb) for kind, item in group]
+        await client.send_media_group(message.chat.id, media, reply_to_message_id=message.id)
+        return
+    
+    kind, item = group[0]
+    file_name = os.path.basename(item['name'])
+    if item['size'] > TELEGRAM_UPLOAD_LIMIT:
+        await upload_split_file(message, item['path'], file_name, item['size'], kind == 'video', progress, thumb=custom_thumb)
+        return
+    media = await batch_media(kind, item, custom_thumb)
+    if kind == 'photo':
+        await message.reply_photo(photo=item['path'], progress=progress, caption=file_name)
+    elif kind == 'video':
+        await message.reply_video(
+            video=item['path'],
+            progress=progress,
+            file_name=file_name,
+            thumb=media.thumb,
+            supports_streaming=True,
+            caption=file_name,
+            width=media.width,
+            height=media.height,
+            duration=media.duration
+        )
+    elif kind == 'audio':
+        await message.reply_audio(audio=item['path'], progress=progress, file_name=file_name, thumb=custom_thumb, caption=file_name)
+    else:
+        await message.reply_document(document=item['path'], progress=progress, file_name=file_name, thumb=custom_thumb, caption=file_name)
+
+async def upload_batch_to_telegram(client, message, msg_id, user_id, download_info):
+    """Send every file of a torrent or metalink, grouped into albums where
+    Telegram allows it, one album after the other so they appear in order.
+    Files that fail stay on disk and in the job, which offers them again."""
+    files = download_info['files']
+    groups = plan_media_groups(files)
+    custom_thumb = thumb_store.get(user_id)
+    download_info['stage'] = 'uploading'
+    downloads_db.persist(msg_id)
+    
+    total_size = sum(item['size'] for item in files)
+    sent_bytes = 0
+    sent = []
+    failed = []
+    
+    def report(current=0):
+        percentage = ((sent_bytes + current) * 100) / total_size if total_size else 0
+        edit_scheduler.schedule(message, (
+            f"📤 **Uploading to Telegram**\n"
+            f"📄 **Name:** {download_info['file_name']}\n"
+            f"🗂 **Files:** {len(sent)}/{len(files)} sent\n"
+            f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
+            f"📤 **Uploaded:** {format_size(sent_bytes + current)} / {format_size(total_size)}"
+        ), reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+        ]))
+    
+    async def progress(current, total):
+        # The entry disappears when the user cancels
+        if msg_id not in downloads_db:
+            raise StopTransmission
+        report(current)
+    
+    async with job_scheduler.slot(
+        'tg_upload', user_id, job_id=msg_id,
+        on_queued=queue_position_notifier(message, "Upload")
+    ), telegram_flow(user_id, 'upload'):
+        upload_started = time.time()
+        report()
+        for position, group in enumerate(groups):
+            if msg_id not in downloads_db:
+                return
+            # Probe the next album's videos while this one uploads
+            for kind, item in groups[position + 1] if position + 1 < len(groups) else []:
+                if kind == 'video':
+                    media_prober.prefetch(item['path'], thumbnail=not custom_thumb)
+            items = [item for _, item in group]
+            try:
+                await send_batch_group(client, message, group, custom_thumb, progress)
+            except StopTransmission:
+                return
+            except Exception as e:
+                logging.error(f"Error uploading {', '.join(item['name'] for item in items)}: {str(e)}")
+                failed.extend(items)
+                continue
+            finally:
+                for kind, item in group:
+                    if kind == 'video':
+                        media_prober.forget(item['path'])
+            sent_bytes += sum(item['size'] for item in items)
+            sent.extend(items)
+            report()
+    
+    # A cancelled batch has already been cleaned up
+    if msg_id not in downloads_db:
+        return
+    remove_job_files({'user_id': user_id, 'files': sent})
+    
+    complete_text = (
+        f"✅ **Upload complete!**\n"
+        f"📄 **Name:** {download_info['file_name']}\n"
+        f"🗂 **Files:** {len(sent)}/{len(files)} sent\n"
+        f"📏 **Size:** {format_size(sent_bytes)}\n"
+        f"⚡ **Average speed:** {format_speed(sent_bytes / max(time.time() - upload_started, 0.001))}"
+    )
+    if failed:
+        # Keep what failed, so it can be sent again or elsewhere
+        download_info['files'] = failed
+        download_info['file_size'] = sum(item['size'] for item in failed)
+        download_info['stage'] = 'downloaded'
+        downloads_db.persist(msg_id)
+        names = ', '.join(item['name'] for item in failed[:5]) + (f" and {len(failed) - 5} more" if len(failed) > 5 else "")
+        await show_upload_options(
+            message, download_info['file_name'], download_info['file_size'],
+            header=f"{complete_text}\n⚠️ **Failed, still on disk:** {names}"
+        )
+    else:
+        del downloads_db[msg_id]
+        await edit_scheduler.edit(message, complete_text)
+    logging.info(f"Telegram batch upload completed for {download_info['file_name']}: {len(sent)}/{len(files)} files")
+
+def batch_tar(info):
+    """The tar a batch entry is sent as, with its files under their folders."""
+    return TarStream([(item['path'], item['name']) for item in info['files']], info['file_name'])
+
+async def upload_tar_to_telegram(message, msg_id, user_id, download_info):
+    """Send a batch as one tar generated while it uploads, in parts when it
+    is over Telegram's limit."""
+    stream = batch_tar(download_info)
+    download_info['stage'] = 'uploading'
+    downloads_db.persist(msg_id)
+    
+    uploaded = 0
+    last_update_time = 0
+    
+    async def progress(current, total):
+        nonlocal last_update_time
+        now = time.time()
+        if now - last_update_time >= 1:
+            sent = uploaded + current
+            percentage = (sent * 100) / stream.size
+            edit_scheduler.schedule(message, (
+                f"📤 **Uploading to Telegram**\n"
+                f"📦 **Archive:** {stream.name}\n"
+                f"{create_progress_bar(percentage)} {percentage:.1f}%\n"
+                f"📤 **Uploaded:** {format_size(sent)} / {format_size(stream.size)}"
+            ), reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+            ]))
+            last_update_time = now
+    
+    async with job_scheduler.slot(
+        'tg_upload', user_id, job_id=msg_id,
+        on_queued=queue_position_notifier(message, "Upload")
+    ), telegram_flow(user_id, 'upload'):
+        upload_started = time.time()
+        if stream.size <= TELEGRAM_UPLOAD_LIMIT:
+            parts = [stream]
+        else:
+            parts = [
+                stream.window(offset, min(TELEGRAM_UPLOAD_LIMIT, stream.size - offset), f"{stream.name}.{index:03d}")
+                for index, offset in enumerate(range(0, stream.size, TELEGRAM_UPLOAD_LIMIT), 1)
+            ]
+        for part in parts:
+            await message.reply_document(
+                document=part,
+                progress=progress,
+                file_name=part.name,
+                thumb=thumb_store.get(user_id),
+                caption=part.name
+            )
+            uploaded += part.size
+    
+    if msg_id not in downloads_db:
+        return
+    remove_job_files(download_info)
+    del downloads_db[msg_id]
+    await edit_scheduler.edit(
+        message,
+        f"✅ **Upload complete!**\n"
+        f"📦 **Archive:** {stream.name}\n"
+        f"📏 **Size:** {format_size(stream.size)}\n"
+        f"⚡ **Average speed:** {format_speed(stream.size / max(time.time() - upload_started, 0.001))}"
+    )
+
+async def run_archive_job(message, info, label, size, work, output):
+    """Run one zip or extract step for the downloads_db entry of ``message``:
+    reserve ``size`` bytes of disk, wait for an archive slot and report
+    progress while ``work(on_progress)`` writes ``output``. The output is
+    removed again if the step fails or is cancelled. Returns True on success."""
+    msg_id = message.id
+    user_id = info['user_id']
+    cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel")]])
+    
+    def on_progress(percent):
+        edit_scheduler.schedule(message, (
+            f"{label}\n"
+            f"📄 **File:** {info['file_name']}\n"
+            f"{create_progress_bar(percent)} {percent}%"
+        ), reply_markup=cancel_markup)
+    
+    info['archive_output'] = output
+    downloads_db.persist(msg_id)
+    reservation = None
+    succeeded = False
+    try:
+        reservation = await disk_admission.try_reserve(msg_id, user_id, size)
+        if not reservation:
+            await edit_scheduler.edit(
+                message,
+                f"💾 **Waiting for disk space**\n"
+                f"📄 **File:** {info['file_name']}\n"
+                f"📏 **Needs:** {format_size(size)}",
+                reply_markup=cancel_markup
+            )
+            reservation = await disk_admission.reserve(msg_id, user_id, size)
+        
+        async with job_scheduler.slot(
+            'archive', user_id, job_id=msg_id,
+            on_queued=queue_position_notifier(message, "Archive")
+        ):
+            on_progress(0)
+            # Cancelling this task kills the archiver
+            task = info['archive_job'] = asyncio.ensure_future(work(on_progress))
+            await task
+        succeeded = True
+    except asyncio.CancelledError:
+        # Only swallow the cancel button, not a shutdown
+        if msg_id in downloads_db:
+            raise
+    except JobCancelled:
+        pass
+    except Exception as e:
+        logging.error(f"Archive step for {info['file_name']} failed: {str(e)}")
+        if msg_id in downloads_db:
+            await show_upload_options(message, info['file_name'], info['file_size'], header=f"❌ **Failed:** {str(e)}")
+    finally:
+        info.pop('archive_job', None)
+        info.pop('archive_output', None)
+        if reservation:
+            disk_admission.release(reservation)
+        if not succeeded:
+            if os.path.isdir(output):
+                shutil.rmtree(output, ignore_errors=True)
+            elif os.path.exists(output):
+                os.remove(output)
+    return succeeded
+
+async def zip_batch(message, info):
+    """Pack a batch into one zip next to it, then offer that for upload."""
+    user_dir = str(get_user_download_dir(info['user_id']))
+    zip_name = f"{os.path.basename(info['file_name'])}.zip"
+    output = os.path.join(user_dir, zip_name)
+    names = [item['name'] for item in info['files']]
+    info['stage'] = 'archiving'
+    downloads_db.persist(message.id)
+    
+    # The zip holds a second copy of the batch until the originals are removed
+    if not await run_archive_job(
+        message, info, "🗜 **Zipping**", info['file_size'],
+        lambda on_progress: archive_runner.zip(user_dir, names, output, on_progress),
+        output
+    ):
+        return
+    
+    remove_job_files(info)
+    del info['files']
+    info['file_path'] = output
+    info['file_name'] = zip_name
+    info['file_size'] = os.path.getsize(output)
+    info['stage'] = 'downloaded'
+    downloads_db.persist(message.id)
+    await show_upload_options(message, zip_name, info['file_size'], header="🗜 **Zipped!**")
+
+async def extract_archive(message, info):
+    """Unpack a downloaded archive into a folder of the same name, then offer
+    its contents for upload."""
+    archive = info['file_path']
+    user_dir = str(get_user_download_dir(info['user_id']))
+    stem = os.path.splitext(os.path.basename(archive))[0]
+    output = os.path.join(user_dir, stem)
+    copies = 1
+    while os.path.exists(output):
+        output = os.path.join(user_dir, f"{stem} ({copies})")
+        copies += 1
+    info['stage'] = 'archiving'
+    downloads_db.persist(message.id)
+    
+    size = await archive_runner.unpacked_size(archive) or info['file_size']
+    if not await run_archive_job(
+        message, info, "📂 **Extracting**", size,
+        lambda on_progress: archive_runner.extract(archive, output, on_progress),
+        output
+    ):
+        return
+    
+    paths = sorted(
+        os.path.join(dir_path, file_name)
+        for dir_path, _, file_names in os.walk(output)
+        for file_name in file_names
+    )
+    if not paths:
+        shutil.rmtree(output, ignore_errors=True)
+        info['stage'] = 'downloaded'
+        downloads_db.persist(message.id)
+        await show_upload_options(message, info['file_name'], info['file_size'], header="❌ **The archive is empty**")
+        return
+    
+    os.remove(archive)
+    # A received archive's file_id no longer describes what is left to upload
+    info.pop('file_id', None)
+    if len(paths) == 1:
+        info['file_path'] = paths[0]
+        info['file_name'] = os.path.basename(paths[0])
+        info['file_size'] = os.path.getsize(paths[0])
+    else:
+        info['file_path'] = None
+        info['files'] = [
+            {'path': path, 'name': os.path.relpath(path, user_dir), 'size': os.path.getsize(path)}
+            for path in paths
+        ]
+        info['file_name'] = os.path.basename(output)
+        info['file_size'] = sum(item['size'] for item in info['files'])
+    info['stage'] = 'downloaded'
+    downloads_db.persist(message.id)
+    await show_upload_options(message, info['file_name'], info['file_size'], header=f"📂 **Extracted!** ({len(paths)} files)")
+
+@app.on_callback_query(filters.regex("^archive_"))
+@detached
+async def handle_archive(client, callback_query: CallbackQuery):
+    _, msg_id, archive_format = callback_query.data.split('_')
+    info = downloads_db.get(int(msg_id))
+    if not info or not info.get('files'):
+        await callback_query.message.edit_text("❌ **Download information not found**")
+        return
+    
+    if archive_format == 'tar':
+        # Nothing is written: the tar is generated while it uploads
+        info['pack'] = 'tar'
+        info['file_name'] = f"{info['file_name']}.tar"
+        info['file_size'] = batch_tar(info).size
+        downloads_db.persist(int(msg_id))
+        await show_upload_options(callback_query.message, info['file_name'], info['file_size'], header="📦 **Will be sent as one tar archive**")
+    else:
+        await zip_batch(callback_query.message, info)
+
+@app.on_callback_query(filters.regex("^extract_"))
+@detached
+async def handle_extract(client, callback_query: CallbackQuery):
+    info = downloads_db.get(int(callback_query.data.split('_')[1]))
+    if info and info.get('stage') == 'on_telegram':
+        # A received archive only exists on Telegram until it is fetched
+        try:
+            await fetch_telegram_media(client, callback_query.message, info)
+        except (JobCancelled, StopTransmission):
+            return
+        except Exception as e:
+            logging.error(f"Error downloading {info['file_name']}: {str(e)}")
+            info['stage'] = 'on_telegram'
+            downloads_db.persist(callback_query.message.id)
+            await show_upload_options(callback_query.message, info['file_name'], info['file_size'], header="❌ **Download failed**")
+            return
+    if not info or not info.get('file_path') or not os.path.exists(info['file_path']):
+        await callback_query.message.edit_text("❌ **Download information not found**")
+        return
+    await extract_archive(callback_query.message, info)
 
 @app.on_callback_query(filters.regex("^rclone_"))
 async def handle_rclone_selection(client, callback_query: CallbackQuery):
@@ -865,17 +2454,12 @@ async def handle_rclone_selection(client, callback_query: CallbackQuery):
             )
             return
             
-        remotes = get_available_remotes(config_path)
+        remotes = get_available_remotes(user_id)
         if not remotes:
             await callback_query.message.edit_text("No remotes found in your config!")
             return
             
-        buttons = []
-        for remote in remotes:
-            buttons.append([InlineKeyboardButton(
-                f"📁 {remote}", 
-                callback_data=f"remote_{remote}_"
-            )])
+        buttons = remote_buttons(user_id)
         buttons.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel")])
         
         await callback_query.message.edit_text(
@@ -891,41 +2475,68 @@ async def handle_rclone_selection(client, callback_query: CallbackQuery):
 async def handle_remote_navigation(client, callback_query: CallbackQuery):
     try:
         user_id = callback_query.from_user.id
-        data = callback_query.data.split('_')
-        remote = data[1]
-        current_path = data[2] if len(data) > 2 else ""
+        state = callback_store.get(callback_query.data)
+        if not state:
+            await callback_query.message.edit_text("⌛ This menu has expired, please choose the destination again.")
+            return
+        remote, current_path, page = state['remote'], state['path'], state['page']
+        config = rclone_configs.get(user_id)
+        if not config or remote not in config.remotes:
+            await callback_query.message.edit_text("❌ Remote not found in your rclone config!")
+            return
+        
+        folders = await folder_cache.list(user_id, remote, current_path)
+        pages = max(1, math.ceil(len(folders) / FOLDERS_PER_PAGE))
+        page = min(page, pages - 1)
+        shown = folders[page * FOLDERS_PER_PAGE:(page + 1) * FOLDERS_PER_PAGE]
+        
+        # The next click is most likely one of these, list them ahead of time
+        folder_cache.prefetch(user_id, remote, shown)
         
-        folders = list_folder_contents(user_id, remote, current_path)
         buttons = []
         
         # Add folder buttons
-        for folder in folders:
-            folder_name = os.path.basename(folder.rstrip('/'))
-            folder_path = folder.rstrip('/')
+        for folder_path in shown:
             buttons.append([InlineKeyboardButton(
-                f"📁 {folder_name}",
-                callback_data=f"remote_{remote}_{folder_path}"
+                f"📁 {posixpath.basename(folder_path)}",
+                callback_data=callback_store.data('remote', remote=remote, path=folder_path, page=0)
             )])
         
+        # Add page buttons
+        page_buttons = []
+        if page > 0:
+            page_buttons.append(InlineKeyboardButton(
+                "◀️ Prev",
+                callback_data=callback_store.data('remote', remote=remote, path=current_path, page=page - 1)
+            ))
+        if page < pages - 1:
+            page_buttons.append(InlineKeyboardButton(
+                "Next ▶️",
+                callback_data=callback_store.data('remote', remote=remote, path=current_path, page=page + 1)
+            ))
+        if page_buttons:
+            buttons.append(page_buttons)
+        
         # Add upload here button
         buttons.append([InlineKeyboardButton(
             "📤 Upload Here",
-            callback_data=f"upload_{remote}_{current_path}"
+            callback_data=callback_store.data('upload', remote=remote, path=current_path)
         )])
         
         # Add navigation buttons
         nav_buttons = []
         if current_path:  # Add back button if not in root
-            parent_path = str(Path(current_path).parent)
             nav_buttons.append(InlineKeyboardButton(
                 "⬅️ Back",
-                callback_data=f"remote_{remote}_{parent_path}"
+                callback_data=callback_store.data('remote', remote=remote, path=posixpath.dirname(current_path), page=0)
             ))
         nav_buttons.append(InlineKeyboardButton("❌ Cancel", callback_data="cancel"))
         buttons.append(nav_buttons)
         
+        page_info = f" (page {page + 1}/{pages})" if pages > 1 else ""
+        warning = f"⚠️ This remote failed its last check: {config.problem(remote)}\n" if config.problem(remote) else ""
         await callback_query.message.edit_text(
-            f"Current location: {remote}:{current_path or '/'}\nSelect a folder:",
+            f"{warning}Current location: {remote}:{current_path or '/'}{page_info}\nSelect a folder:",
             reply_markup=InlineKeyboardMarkup(buttons)
         )
         
@@ -934,163 +2545,364 @@ async def handle_remote_navigation(client, callback_query: CallbackQuery):
         await callback_query.message.edit_text("❌ Error browsing folders")
 
 @app.on_callback_query(filters.regex("^upload_"))
+@detached
 async def handle_rclone_upload(client, callback_query: CallbackQuery):
-    try:
-        # Extract callback data
-        data = callback_query.data.split('_')
-        remote = data[1]
-        path = data[2] if len(data) > 2 else ""
-        user_id = callback_query.from_user.id
-        message = callback_query.message
+    state = callback_store.get(callback_query.data)
+    if not state:
+        await callback_query.message.edit_text("⌛ This menu has expired, please choose the destination again.")
+        return
+    await upload_to_cloud(client, callback_query.message, callback_query.from_user.id, state['remote'], state['path'])
 
+async def upload_to_cloud(client, message, user_id, remote, path):
+    """Copy the file behind the downloads_db entry of ``message`` to ``remote:path``."""
+    try:
         # Get download information
         msg_id = message.id
-        if msg_id not in downloads_db or not downloads_db[msg_id]['file_path']:
+        download_info = downloads_db.get(msg_id)
+        if not download_info or not (download_info['file_path'] or download_info.get('file_id') or download_info.get('files')):
             await message.edit_text("❌ Download information not found")
             return
 
-        file_path = downloads_db[msg_id]['file_path']
         config_path = get_rclone_config_path(user_id)
 
         # Validate config exists
-        if not config_path.exists():
+        config = rclone_configs.get(user_id)
+        if not config or remote not in config.remotes:
             await message.edit_text("❌ Rclone config not found. Please upload your config first.")
             return
+        
+        # A remote flagged as broken is checked again before we commit to the upload
+        if config.problem(remote) and await rclone_configs.check(user_id, config, remote):
+            await message.edit_text(
+                f"❌ **Remote {remote} is not working**\n"
+                f"**Error:** {config.problem(remote)}\n"
+                "Please fix your rclone.conf and send it again."
+            )
+            return
+
+        # A tar of a batch is piped into rclone as it is generated
+        if download_info.get('pack') == 'tar':
+            stream = batch_tar(download_info)
+            await stream_to_cloud(message, download_info, config_path, remote, path, stream.chunks(1024 * 1024), "📦 Streaming archive to cloud")
+            return
+
+        # The files of a torrent or metalink are copied side by side
+        if download_info.get('files'):
+            await upload_batch_to_cloud(message, user_id, config, remote, path, download_info)
+            return
+
+        # Telegram media is piped straight into rclone, never touching disk
+        if not download_info['file_path']:
+            await stream_telegram_to_cloud(client, message, download_info, config_path, remote, path)
+            return
+
+        file_path = download_info['file_path']
+        download_info['stage'] = 'uploading'
+        downloads_db.persist(msg_id)
 
         await message.edit_text("⬆️ Starting upload to cloud storage...", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
         ]))
 
-        # Upload progress variables
-        transferred_size = '0 B'
-        percentage = '0%'
-        speed = '0 B/s'
-        eta = '-'
-        process = None
-        is_cancelled = False
-
-        async def update_progress():
-            nonlocal transferred_size, percentage, speed, eta, process, is_cancelled
-            while not (process is None or is_cancelled):
-                try:
-                    data = (await process.stdout.readline()).decode()
-                except:
-                    continue
-                if not data:
-                    break
-                if "Transferred:" in data:
-                    match = re.search(
-                        r"Transferred:\s+([\d.]+\s*\w+)\s+/\s+([\d.]+\s*\w+),\s+([\d.]+%)\s*,\s+([\d.]+\s*\w+/s),\s+ETA\s+([\dwdhms]+)",
-                        data
-                    )
-                    if match:
-                        transferred, total, percentage, speed, eta = match.groups()
-                        progress_value = float(percentage[:-1])
-                        progress_text = "\n".join([
-                            f"📄 **File:** {os.path.basename(file_path)}",
-                            f"{create_progress_bar(progress_value)} {progress_value:.1f}%",
-                            f"⚡ **Speed:** {speed}",
-                            f"📤 **Uploaded:** {transferred} / {total}",
-                            f"⏳ **ETA:** {eta}"
-                        ])
-                        
-                        try:
-                            await message.edit_text(progress_text, reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-                            ]))
-                        except MessageNotModified:
-                            pass
+        file_name = os.path.basename(file_path)
+        async with job_scheduler.slot(
+            'rclone', user_id, job_id=msg_id,
+            on_queued=queue_position_notifier(message, "Upload")
+        ), rclone_copy_flow(user_id):
+            try:
+                # Hand the copy to the rclone daemon and poll its job stats
+                fs = await rclone_rc.fs(user_id, config, remote)
+                job_id = await rclone_rc.copy_file(file_path, fs, posixpath.join(path, file_name))
+                download_info['rclone_job'] = job_id
+                downloads_db.persist(msg_id)
 
-        try:
-            # Start rclone process
-            process = await asyncio.create_subprocess_exec(
-                "rclone",
-                "copy",
-                "--progress",
-                "--config",
-                str(config_path),
-                file_path,
-                f"{remote}:{path}",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+                while True:
+                    status = await rclone_rc.job_status(job_id)
+                    if status.get('finished'):
+                        break
+                    stats = await rclone_rc.job_stats(job_id)
+                    transferred = stats.get('bytes', 0)
+                    total = stats.get('totalBytes') or download_info.get('file_size') or 0
+                    progress_value = (transferred * 100) / total if total else 0
+                    eta = stats.get('eta')
+                    progress_text = "\n".join([
+                        f"📄 **File:** {file_name}",
+                        f"{create_progress_bar(progress_value)} {progress_value:.1f}%",
+                        f"⚡ **Speed:** {format_speed(stats.get('speed', 0))}",
+                        f"📤 **Uploaded:** {format_size(transferred)} / {format_size(total)}",
+                        f"⏳ **ETA:** {f'{eta}s' if eta is not None else '-'}"
+                    ])
+                    edit_scheduler.schedule(message, progress_text, reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+                    ]))
+                    await asyncio.sleep(1)
 
-            # Monitor progress and wait for completion
-            await asyncio.gather(
-                update_progress(),
-                process.wait()
-            )
+                # A cancelled upload has already been cleaned up
+                if msg_id not in downloads_db:
+                    return
 
-            if is_cancelled:
-                return False
+                success = status.get('success', False)
+                if not success:
+                    logging.error(f"Rclone upload failed: {status.get('error')}")
 
-            # Check upload result
-            if process.returncode == 0:
-                success = True
-            else:
-                error = (await process.stderr.read()).decode().strip()
-                logging.error(f"Rclone upload failed: {error}")
+            except Exception as e:
+                logging.error(f"Error during rclone upload: {str(e)}")
                 success = False
 
-        except Exception as e:
-            logging.error(f"Error during rclone upload: {str(e)}")
-            success = False
-
         # Final message and cleanup
         if success:
-            await message.edit_text("✅ Upload to cloud storage complete!")
+            folder_cache.invalidate(user_id, remote, path)
+            await edit_scheduler.edit(message, "✅ Upload to cloud storage complete!")
         else:
-            await message.edit_text("❌ Upload to cloud storage failed!")
+            await edit_scheduler.edit(message, "❌ Upload to cloud storage failed!")
 
         if os.path.exists(file_path):
             os.remove(file_path)
         if msg_id in downloads_db:
             del downloads_db[msg_id]
 
+    except JobCancelled:
+        return
     except Exception as e:
         logging.error(f"Error during rclone upload: {str(e)}")
-        await message.edit_text("❌ Error during upload to cloud storage")
+        await edit_scheduler.edit(message, "❌ Error during upload to cloud storage")
+
+async def stream_telegram_to_cloud(client, message, info, config_path, remote, path):
+    """Upload a Telegram file to ``remote:path`` with ``rclone rcat`` while it
+    is still being fetched from Telegram."""
+    async def chunks():
+        source_msg = await client.get_messages(info['source_chat_id'], info['source_message_id'])
+        async with aclosing(client.stream_parallel(source_msg)) as stream:
+            async for chunk in stream:
+                yield chunk
+    
+    await stream_to_cloud(message, info, config_path, remote, path, chunks(), "☁️ Streaming to cloud")
+
+async def stream_to_cloud(message, info, config_path, remote, path, chunks, label):
+    """Pipe the async iterable ``chunks`` into ``remote:path`` under the
+    entry's file name with ``rclone rcat``, so nothing is staged on disk."""
+    msg_id = message.id
+    file_name = info['file_name']
+    file_size = info['file_size']
+    destination = f"{remote}:{posixpath.join(path, file_name)}"
+
+    start_time = time.time()
+    last_update_time = start_time
+    last_sent = 0
+
+    def on_chunk(sent):
+        nonlocal last_update_time, last_sent
+        # The entry disappears when the user cancels
+        if msg_id not in downloads_db:
+            raise JobCancelled()
+
+        now = time.time()
+        if now - last_update_time >= 1:
+            speed = (sent - last_sent) / (now - last_update_time)
+            percentage = (sent * 100) / file_size if file_size else 0
+            progress_text = "\n".join([
+                f"**{label}**",
+                f"📄 **File:** {file_name}",
+                f"{create_progress_bar(percentage)} {percentage:.1f}%",
+                f"⚡ **Speed:** {format_speed(speed)}",
+                f"📤 **Uploaded:** {format_size(sent)} / {format_size(file_size)}"
+            ])
+            edit_scheduler.schedule(message, progress_text, reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+            ]))
+            last_update_time = now
+            last_sent = sent
+
+    info['stage'] = 'uploading'
+    downloads_db.persist(msg_id)
+
+    async with job_scheduler.slot(
+        'rclone', info['user_id'], job_id=msg_id,
+        on_queued=queue_position_notifier(message, "Upload")
+    ):
+        await edit_scheduler.edit(message, "⬆️ Streaming to cloud storage...", reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+        ]))
+        try:
+            with bandwidth.flow(info['user_id'], 'upload') as flow:
+                await rcat(config_path, destination, chunks, size=file_size, on_chunk=on_chunk, flow=flow)
+        except JobCancelled:
+            return
+        except Exception as e:
+            logging.error(f"Error streaming {file_name} to {destination}: {str(e)}")
+            if info.get('files'):
+                # The batch is still on disk, let the user try again
+                info['stage'] = 'downloaded'
+                downloads_db.persist(msg_id)
+                await show_upload_options(message, file_name, file_size, header="❌ **Upload to cloud storage failed!**")
+                return
+            await edit_scheduler.edit(message, "❌ Upload to cloud storage failed!")
+            downloads_db.pop(msg_id, None)
+            return
+
+    folder_cache.invalidate(info['user_id'], remote, path)
+    elapsed = max(time.time() - start_time, 0.001)
+    await edit_scheduler.edit(
+        message,
+        f"✅ Upload to cloud storage complete!\n"
+        f"⚡ **Average speed:** {format_speed(file_size / elapsed)}"
+    )
+    remove_job_files(info)
+    downloads_db.pop(msg_id, None)
+
+async def upload_batch_to_cloud(message, user_id, config, remote, path, download_info):
+    """Copy every file of a torrent or metalink to ``remote:path``, keeping
+    its folder layout, with a few rclone jobs running at once."""
+    msg_id = message.id
+    files = download_info['files']
+    total_size = download_info['file_size']
+    download_info['stage'] = 'uploading'
+    download_info['rclone_jobs'] = []
+    downloads_db.persist(msg_id)
+    
+    done_bytes = 0
+    done_files = 0
+    running = {}  # rclone job id -> bytes transferred so far
+    speeds = {}  # rclone job id -> current speed
+    failed = []
+    
+    def report():
+        transferred = done_bytes + sum(running.values())
+        percentage = (transferred * 100) / total_size if total_size else 0
+        edit_scheduler.schedule(message, "\n".join([
+            f"☁️ **Uploading to cloud**",
+            f"📄 **Name:** {download_info['file_name']}",
+            f"🗂 **Files:** {done_files}/{len(files)} done",
+            f"{create_progress_bar(percentage)} {percentage:.1f}%",
+            f"⚡ **Speed:** {format_speed(sum(speeds.values()))}",
+            f"📤 **Uploaded:** {format_size(transferred)} / {format_size(total_size)}"
+        ]), reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+        ]))
+    
+    slots = asyncio.Semaphore(BATCH_UPLOAD_CONCURRENCY)
+    
+    async def copy(item, fs):
+        nonlocal done_bytes, done_files
+        async with slots:
+            # The entry disappears when the user cancels
+            if msg_id not in downloads_db:
+                return
+            try:
+                job_id = await rclone_rc.copy_file(item['path'], fs, posixpath.join(path, item['name']))
+                running[job_id] = 0
+                download_info['rclone_jobs'] = list(running)
+                downloads_db.persist(msg_id)
+                try:
+                    while True:
+                        status = await rclone_rc.job_status(job_id)
+                        if status.get('finished'):
+                            break
+                        stats = await rclone_rc.job_stats(job_id)
+                        running[job_id] = stats.get('bytes', 0)
+                        speeds[job_id] = stats.get('speed', 0)
+                        report()
+                        await asyncio.sleep(1)
+                finally:
+                    running.pop(job_id, None)
+                    speeds.pop(job_id, None)
+                success = status.get('success', False)
+                if not success:
+                    logging.error(f"Rclone upload of {item['name']} failed: {status.get('error')}")
+            except Exception as e:
+                logging.error(f"Error during rclone upload of {item['name']}: {str(e)}")
+                success = False
+            if success:
+                done_bytes += item['size']
+                done_files += 1
+            else:
+                failed.append(item['name'])
+            report()
+    
+    await edit_scheduler.edit(message, "⬆️ Starting upload to cloud storage...", reply_markup=InlineKeyboardMarkup([
+        [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+    ]))
+    async with job_scheduler.slot(
+        'rclone', user_id, job_id=msg_id,
+        on_queued=queue_position_notifier(message, "Upload")
+    ), rclone_copy_flow(user_id):
+        fs = await rclone_rc.fs(user_id, config, remote)
+        await asyncio.gather(*(copy(item, fs) for item in files))
+    
+    # A cancelled batch has already been cleaned up
+    if msg_id not in downloads_db:
+        return
+    folder_cache.invalidate(user_id, remote)
+    remove_job_files(download_info)
+    del downloads_db[msg_id]
+    
+    if failed:
+        await edit_scheduler.edit(
+            message,
+            f"⚠️ **Uploaded {done_files}/{len(files)} files to cloud storage**\n"
+            f"**Failed:** {', '.join(failed[:5])}" + (f" and {len(failed) - 5} more" if len(failed) > 5 else "")
+        )
+    else:
+        await edit_scheduler.edit(message, f"✅ Upload to cloud storage complete! ({done_files} files)")
 
 @app.on_callback_query(filters.regex("^cancel"))
 async def handle_cancel(client, callback_query: CallbackQuery):
     try:
         msg_id = callback_query.message.id
         
+        # Drop the job from its queue if it hasn't started yet
+        job_scheduler.cancel(msg_id)
+        disk_admission.cancel(msg_id)
+        
+        # Kill a running zip or extract; its job removes the partial output
+        if msg_id in downloads_db and downloads_db[msg_id].get('archive_job'):
+            downloads_db[msg_id]['archive_job'].cancel()
+        
+        # Close a file picker that is still open, with the paused downloads behind it
+        selection = file_selections.pop(msg_id, None)
+        if selection and not selection['future'].done():
+            selection['future'].set_exception(JobCancelled())
+            for gid in {entry['gid'] for entry in selection['entries']}:
+                try:
+                    await aria2_rpc.remove(gid, force=True)
+                except Exception as e:
+                    logging.error(f"Error removing paused download {gid}: {str(e)}")
+        
+        # Stop a running cloud upload; /l jobs keep their gid after aria2
+        # finishes, so this has to happen before the aria2 branch returns
+        if msg_id in downloads_db and downloads_db[msg_id].get('rclone_job') is not None:
+            await rclone_rc.stop_job(downloads_db[msg_id]['rclone_job'])
+        if msg_id in downloads_db:
+            for job_id in downloads_db[msg_id].get('rclone_jobs', []):
+                await rclone_rc.stop_job(job_id)
+        
         # Handle Aria2c download cancellation
         if msg_id in downloads_db and downloads_db[msg_id].get('gid'):
-            gid = downloads_db[msg_id]['gid']
             try:
-                download = aria_api.get_download(gid)
-                if download and download.is_active:
-                    aria_api.remove([gid], force=True)
-                    logging.info(f"Aria2c download cancelled: {gid}")
+                for gid in downloads_db[msg_id].get('gids') or [downloads_db[msg_id]['gid']]:
+                    download = await aria2_rpc.get_download(gid)
+                    if download and download.status in ('active', 'waiting', 'paused'):
+                        await aria2_rpc.remove(gid, force=True)
+                        logging.info(f"Aria2c download cancelled: {gid}")
                 
                 # Clean up partial files
-                file_path = downloads_db[msg_id].get('file_path')
-                if file_path and os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                        logging.info(f"Removed partial file: {file_path}")
-                    except OSError as e:
-                        logging.error(f"Error removing partial file: {str(e)}")
+                remove_job_files(downloads_db[msg_id])
                 
                 del downloads_db[msg_id]
-                await callback_query.message.edit_text("❌ Download cancelled")
+                await edit_scheduler.edit(callback_query.message, "❌ Download cancelled")
                 return
             except Exception as e:
                 logging.error(f"Error cancelling Aria2c download: {str(e)}")
         
+        # Stop a running yt-dlp download; its worker cleans up partial files
+        if msg_id in downloads_db and downloads_db[msg_id].get('ytdl_job'):
+            downloads_db[msg_id]['ytdl_job'].cancel()
+        
         # Handle download cancellation
         if msg_id in downloads_db:
-            file_path = downloads_db[msg_id].get('file_path')
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    logging.info(f"Download cancelled and file removed: {file_path}")
-                except OSError as e:
-                    logging.error(f"Error removing download file: {str(e)}")
+            remove_job_files(downloads_db[msg_id])
             del downloads_db[msg_id]
-            await callback_query.message.edit_text("❌ Download cancelled")
+            await edit_scheduler.edit(callback_query.message, "❌ Download cancelled")
             return
         
         # Handle upload cancellation
@@ -1103,7 +2915,7 @@ async def handle_cancel(client, callback_query: CallbackQuery):
                 except Exception as e:
                     logging.error(f"Error terminating upload process: {str(e)}")
             del uploads_db[msg_id]
-            await callback_query.message.edit_text("❌ Upload cancelled")
+            await edit_scheduler.edit(callback_query.message, "❌ Upload cancelled")
             return
         
         # Handle FFmpeg process termination
@@ -1130,21 +2942,116 @@ async def handle_cancel(client, callback_query: CallbackQuery):
             except Exception as e:
                 logging.error(f"Error terminating FFmpeg process: {str(e)}")
         
-        await callback_query.message.edit_text("❌ No active operation to cancel")
+        await edit_scheduler.edit(callback_query.message, "❌ No active operation to cancel")
     except Exception as e:
         logging.error(f"Error in cancel handler: {str(e)}")
-        await callback_query.message.edit_text("❌ Error cancelling operation")
+        await edit_scheduler.edit(callback_query.message, "❌ Error cancelling operation")
+
+async def resume_aria2_download(progress_msg, info):
+    try:
+        async with job_scheduler.slot(
+            'aria2', info['user_id'], job_id=progress_msg.id,
+            on_queued=queue_position_notifier(progress_msg, "Download")
+        ):
+            if info.get('gids'):
+                destination = auto_destinations.get(info['user_id'])
+                finish = await track_aria2_group(progress_msg, info['gids'], destination, info['file_name'])
+            else:
+                finish = await track_aria2_download(progress_msg, info['gid'])
+        if finish:
+            await finish()
+    except JobCancelled:
+        return
+    except Exception as e:
+        logging.error(f"Error resuming download {info['gid']}: {str(e)}")
+
+async def resume_jobs():
+    """Reattach to work that was in flight when the bot last stopped."""
+    for msg_id, info in list(downloads_db.items()):
+        progress_msg = None
+        if info.get('chat_id'):
+            try:
+                progress_msg = await app.get_messages(info['chat_id'], msg_id)
+            except Exception as e:
+                logging.error(f"Error fetching progress message {msg_id}: {str(e)}")
+        if not progress_msg or progress_msg.empty:
+            del downloads_db[msg_id]
+            continue
+        
+        stage = info.get('stage')
+        file_path = info.get('file_path')
+        
+        # A zip or extract cut short leaves a partial output behind
+        if info.get('archive_output'):
+            output = info.pop('archive_output')
+            if os.path.isdir(output):
+                shutil.rmtree(output, ignore_errors=True)
+            elif os.path.exists(output):
+                os.remove(output)
+            stage = 'downloaded'
+        
+        if stage == 'downloading' and info.get('gid') and await aria2_rpc.get_download(info['gid']):
+            # aria2 restored the transfer from its session file
+            logging.info(f"Reattaching to aria2 download {info['gid']}")
+            spawn(resume_aria2_download(progress_msg, info))
+        elif info.get('file_id') and not file_path:
+            # Nothing on disk to lose; the file can still be sent by file_id
+            info['stage'] = 'on_telegram'
+            info['file_path'] = None
+            downloads_db.persist(msg_id)
+            await show_upload_options(progress_msg, info['file_name'], info['file_size'], header="📥 **File received!**")
+        elif stage in ('downloaded', 'uploading') and info.get('files'):
+            # Whatever of the batch is still on disk can be uploaded again
+            info['files'] = [item for item in info['files'] if os.path.exists(item['path'])]
+            if not info['files']:
+                del downloads_db[msg_id]
+                await edit_scheduler.edit(progress_msg, "❌ **Interrupted by a restart, please send it again**")
+                continue
+            info['file_size'] = batch_tar(info).size if info.get('pack') == 'tar' else sum(item['size'] for item in info['files'])
+            info['stage'] = 'downloaded'
+            info.pop('rclone_jobs', None)
+            downloads_db.persist(msg_id)
+            header = "♻️ **Upload interrupted by a restart.**" if stage == 'uploading' else "✅ **Download complete!**"
+            await show_upload_options(progress_msg, info['file_name'], info['file_size'], header=f"{header} ({len(info['files'])} files)")
+        elif stage in ('downloaded', 'uploading') and file_path and os.path.exists(file_path):
+            info['stage'] = 'downloaded'
+            downloads_db.persist(msg_id)
+            header = "♻️ **Upload interrupted by a restart.**" if stage == 'uploading' else "✅ **Download complete!**"
+            await show_upload_options(progress_msg, info['file_name'], info['file_size'], header=header)
+        else:
+            del downloads_db[msg_id]
+            await edit_scheduler.edit(progress_msg, "❌ **Interrupted by a restart, please send it again**")
+    
+    # Remove temporary files left behind by interrupted uploads
+    for msg_id, info in list(uploads_db.items()):
+        for temp_file in info.get('temp_files', []):
+            if temp_file and os.path.exists(temp_file):
+                os.remove(temp_file)
+        del uploads_db[msg_id]
+
+async def main():
+    await app.start()
+    await rclone_rc.start()
+    loop_lag.start()
+    await resume_jobs()
+    aria2_supervisor.watch()
+    logging.info("Bot started")
+    try:
+        await idle()
+    finally:
+        # aria2c keeps downloading; the next start adopts it
+        await aria2_supervisor.stop()
+        loop_lag.stop()
+        await aria2_monitor.stop()
+        await app.stop()
+        await aria2_rpc.close()
+        await rclone_rc.close()
+        job_store.close()
 
 if __name__ == "__main__":
     logging.info("Bot starting...")
-    # Start aria2
-    subprocess.Popen([
-        "aria2c",
-        "--enable-rpc",
-        "--rpc-listen-all=true",
-        "--rpc-allow-origin-all",
-        "--rpc-listen-port=6800",
-        "--disable-ipv6"
-    ])
+    # Start aria2, restoring unfinished downloads from the last session, and
+    # wait until it answers RPC
+    aria2_supervisor.start()
     # Start bot
-    app.run()
+    app.run(main())
@@ -0,0 +1,163 @@
+import asyncio
+import copy
+import logging
+import os
+import re
+import shutil
+import tarfile
+
+from file_splitter import _run
+
+ARCHIVE_EXTENSIONS = ('.zip', '.7z', '.rar', '.tar')
+_PERCENT = re.compile(rb'(\d{1,3})%')
+_ENTRY_SIZE = re.compile(r'^Size = (\d+)$', re.MULTILINE)
+
+
+class TarStream:
+    """Uncompressed tar of ``files`` (``(path, arcname)`` pairs) generated as
+    it is read, so a batch can be uploaded as one archive without writing it
+    to disk.
+
+    The layout is fixed up front, which gives the exact ``size`` Telegram and
+    ``rclone rcat --size`` need, and lets ``window`` serve any byte range of
+    the archive as a stream of its own, e.g. one part of a split upload.
+    """
+
+    def __init__(self, files, name):
+        self.name = name
+        self.segments = []  # (offset, length, header/padding bytes or file path)
+        offset = 0
+        for path, arcname in files:
+            st = os.stat(path)
+            info = tarfile.TarInfo(arcname)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0o644
+            header = info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+            padding = b"\0" * (-st.st_size % tarfile.BLOCKSIZE)
+            for data, length in ((header, len(header)), (path, st.st_size), (padding, len(padding))):
+                if length:
+                    self.segments.append((offset, length, data))
+                    offset += length
+        end = b"\0" * (2 * tarfile.BLOCKSIZE)
+        self.segments.append((offset, len(end), end))
+        self.start = 0
+        self.size = offset + len(end)
+
+    def window(self, offset, length, name):
+        """The bytes ``[offset, offset + length)`` of this archive."""
+        window = copy.copy(self)
+        window.start = self.start + offset
+        window.size = length
+        window.name = name
+        return window
+
+    async def _pieces(self, chunk_size):
+        loop = asyncio.get_running_loop()
+        position = self.start
+        end = self.start + self.size
+        for offset, length, data in self.segments:
+            if offset + length <= position:
+                continue
+            if offset >= end:
+                return
+            stop = min(offset + length, end)
+            if isinstance(data, bytes):
+                yield data[position - offset:stop - offset]
+                position = stop
+                continue
+            fd = os.open(data, os.O_RDONLY)
+            try:
+                while position < stop:
+                    want = min(chunk_size, stop - position)
+                    chunk = await loop.run_in_executor(None, os.pread, fd, want, position - offset)
+                    if len(chunk) < want:
+                        raise IOError(f"{data} changed while it was being archived")
+                    position += want
+                    yield chunk
+            finally:
+                os.close(fd)
+
+    async def chunks(self, chunk_size):
+        """Yield ``chunk_size`` pieces of the stream (the last may be shorter)."""
+        buffer = bytearray()
+        async for piece in self._pieces(chunk_size):
+            buffer += piece
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+        if buffer:
+            yield bytes(buffer)
+
+
+class ArchiveRunner:
+    """Runs 7z and unrar as asyncio subprocesses, at most ``workers`` at a
+    time, turning the percentages they print into ``on_progress(percent)``
+    calls. Cancelling a call kills its process."""
+
+    def __init__(self, workers=2):
+        self.slots = asyncio.Semaphore(workers)
+
+    async def _run(self, command, on_progress=None, cwd=None):
+        async with self.slots:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                cwd=cwd,
+                stdin=asyncio.subprocess.DEVNULL,  # an encrypted archive fails instead of prompting
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT
+            )
+            tail = b""
+            try:
+                while True:
+                    data = await process.stdout.read(4096)
+                    if not data:
+                        break
+                    percents = _PERCENT.findall(data)
+                    if percents and on_progress:
+                        on_progress(min(int(percents[-1]), 100))
+                    tail = (tail + data)[-2000:]
+                await process.wait()
+            except BaseException:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+        if process.returncode != 0:
+            error = tail.decode(errors='ignore').replace('\b', '').strip().splitlines()
+            raise RuntimeError(f"{command[0]} failed: {error[-1] if error else process.returncode}")
+
+    async def unpacked_size(self, archive):
+        """Total size of the files in ``archive``, or None if it can't be listed."""
+        try:
+            listing = await _run("7z", "l", "-slt", "-y", archive)
+        except (RuntimeError, OSError) as e:
+            logging.error(f"Could not list {archive}: {str(e)}")
+            return None
+        return sum(int(size) for size in _ENTRY_SIZE.findall(listing))
+
+    async def zip(self, root, names, output, on_progress=None):
+        """Write ``names`` (paths relative to ``root``) into the zip ``output``,
+        keeping their folders. Media is rarely worth more than the fastest
+        compression level."""
+        list_path = f"{output}.list"
+        with open(list_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(names))
+        try:
+            await self._run(
+                ["7z", "a", "-tzip", "-mx=1", "-bsp1", "-bb0", "-y", "-scsUTF-8", output, f"@{list_path}"],
+                on_progress,
+                cwd=root
+            )
+        finally:
+            os.remove(list_path)
+
+    async def extract(self, archive, output_dir, on_progress=None):
+        """Unpack a zip, 7z or rar (with unrar, when 7z lacks the codec) into
+        ``output_dir``."""
+        os.makedirs(output_dir, exist_ok=True)
+        if archive.lower().endswith('.rar') and shutil.which("unrar"):
+            command = ["unrar", "x", "-o+", "-y", archive, output_dir + os.sep]
+        else:
+            command = ["7z", "x", "-bsp1", "-bb0", "-y", f"-o{output_dir}", archive]
+        await self._run(command, on_progress)
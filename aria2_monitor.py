@@ -0,0 +1,115 @@
+import asyncio
+import logging
+
+from aria2p import Download
+
+# Everything the trackers read from a Download. Leaving out the rest, the
+# piece bitfield above all, keeps each tick small on large downloads.
+STATUS_KEYS = [
+    "gid", "status", "totalLength", "completedLength", "downloadSpeed",
+    "verifiedLength", "verifyIntegrityPending", "errorCode", "errorMessage",
+    "followedBy", "dir", "files", "bittorrent",
+]
+
+
+class Aria2Monitor:
+    """Single shared aria2 status feed.
+
+    One batched ``system.multicall`` of ``tellStatus`` for the watched GIDs,
+    limited to ``STATUS_KEYS``, is made per tick, and aria2's WebSocket notifications wake the
+    sweep up immediately so completion is seen without waiting for the next tick.
+    """
+
+    def __init__(self, api, rpc, interval=1):
+        self.api = api
+        self.rpc = rpc
+        self.interval = interval
+        self.watchers = {}  # gid -> set of asyncio.Queue
+        self.loop = None
+        self.task = None
+        self.wakeup = None
+
+    def watch(self, gid):
+        """Return a queue that always holds the freshest Download for ``gid``
+        (or None once aria2 no longer knows about it)."""
+        self._ensure_started()
+        queue = asyncio.Queue(maxsize=1)
+        self.watchers.setdefault(gid, set()).add(queue)
+        self.wakeup.set()
+        return queue
+
+    def unwatch(self, gid, queue):
+        queues = self.watchers.get(gid)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.watchers[gid]
+
+    def _ensure_started(self):
+        if self.task is not None and not self.task.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.task = self.loop.create_task(self._run())
+        try:
+            self.api.listen_to_notifications(
+                threaded=True,
+                on_download_start=self._on_notification,
+                on_download_pause=self._on_notification,
+                on_download_stop=self._on_notification,
+                on_download_complete=self._on_notification,
+                on_download_error=self._on_notification,
+                on_bt_download_complete=self._on_notification,
+                handle_signals=False
+            )
+        except Exception as e:
+            # Polling alone still works, just with up to one tick of latency
+            logging.error(f"aria2 notifications unavailable: {str(e)}")
+
+    def _on_notification(self, api, gid):
+        # Called from aria2p's listener thread
+        if gid in self.watchers:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def stop(self):
+        try:
+            self.api.stop_listening()
+        except Exception:
+            pass
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            if self.watchers:
+                try:
+                    await self._sweep()
+                except Exception as e:
+                    logging.error(f"aria2 sweep failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def _fetch_statuses(self, gids):
+        # aria2 answers an unknown GID with an error, which comes back as None
+        results = await self.rpc.multicall([
+            ("aria2.tellStatus", [gid, STATUS_KEYS]) for gid in gids
+        ])
+        return dict(zip(gids, results))
+
+    async def _sweep(self):
+        gids = list(self.watchers)
+        statuses = await self._fetch_statuses(gids)
+        for gid, queues in list(self.watchers.items()):
+            if gid not in statuses:
+                continue  # started watching during the call, picked up next tick
+            struct = statuses[gid]
+            download = Download(self.api, struct) if struct else None
+            for queue in queues:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(download)
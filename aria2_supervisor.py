@@ -0,0 +1,177 @@
+import asyncio
+import itertools
+import logging
+import subprocess
+import time
+
+import requests
+
+# Defaults tuned for a handful of big HTTP/torrent downloads on a server link.
+# disk-cache batches small writes, but pieces are reported complete before the
+# cache is flushed; whoever reads files while they download (the bitfield
+# prefix used for pipelined uploads) must run with disk-cache=0.
+DEFAULT_PROFILE = {
+    'max-connection-per-server': '16',
+    'split': '16',
+    'min-split-size': '4M',
+    'file-allocation': 'falloc',
+    'disk-cache': '64M',
+    'max-concurrent-downloads': '5',
+    'optimize-concurrent-downloads': 'true',
+}
+
+# aria2 reads these only at startup; changing them takes a restart
+STARTUP_ONLY_OPTIONS = {'disk-cache', 'rpc-listen-port', 'enable-rpc', 'input-file', 'save-session-interval'}
+
+
+class Aria2Supervisor:
+    """Owns the aria2c daemon: launches it with a performance ``profile``,
+    waits until it answers ``aria2.getVersion`` instead of sleeping, and
+    relaunches it from the session file if it dies or stops answering.
+
+    An aria2c that is already listening on the port is adopted as is and
+    only has the runtime-changeable part of the profile applied. ``tune``
+    changes options on the running daemon through ``changeGlobalOption``
+    and records them in the profile, so a relaunched daemon keeps them.
+    """
+
+    def __init__(self, port=6800, secret="", session_file=None, profile=None,
+                 check_interval=5, max_failures=3):
+        self.port = port
+        self.url = f"http://localhost:{port}/jsonrpc"
+        self.secret = secret
+        self.session_file = session_file
+        self.profile = dict(DEFAULT_PROFILE, **(profile or {}))
+        self.check_interval = check_interval
+        self.max_failures = max_failures
+        self.process = None  # None while an adopted daemon is in use
+        self.version = None
+        self.restarts = 0
+        self.task = None
+        self.request_ids = itertools.count(1)
+
+    def command(self):
+        command = [
+            "aria2c",
+            "--enable-rpc",
+            "--rpc-listen-all=true",
+            "--rpc-allow-origin-all",
+            f"--rpc-listen-port={self.port}",
+            "--disable-ipv6",
+            "--continue=true",
+        ]
+        if self.secret:
+            command.append(f"--rpc-secret={self.secret}")
+        if self.session_file:
+            # Restore unfinished downloads, GIDs included
+            command += [
+                f"--input-file={self.session_file}",
+                f"--save-session={self.session_file}",
+                "--save-session-interval=10",
+            ]
+        command += [f"--{name}={value}" for name, value in self.profile.items()]
+        return command
+
+    def _call(self, method, *params, timeout=2):
+        params = list(params)
+        if self.secret:
+            params.insert(0, f"token:{self.secret}")
+        payload = {"jsonrpc": "2.0", "id": next(self.request_ids), "method": method, "params": params}
+        response = requests.post(self.url, json=payload, timeout=timeout).json()
+        if "error" in response:
+            raise RuntimeError(response["error"]["message"])
+        return response["result"]
+
+    def _answering(self):
+        try:
+            self.version = self._call("aria2.getVersion")["version"]
+            return True
+        except (requests.RequestException, RuntimeError, ValueError):
+            self.version = None
+            return False
+
+    def _launch(self, ready_timeout):
+        if self.session_file:
+            self.session_file.touch(exist_ok=True)
+        self.process = subprocess.Popen(self.command())
+        deadline = time.time() + ready_timeout
+        while not self._answering():
+            if self.process.poll() is not None:
+                raise RuntimeError(f"aria2c exited with code {self.process.returncode}")
+            if time.time() > deadline:
+                raise RuntimeError("aria2c did not answer in time")
+            time.sleep(0.1)
+        logging.info(f"aria2c {self.version} ready")
+
+    def start(self, ready_timeout=15):
+        """Make sure an aria2c is answering, launching one if needed. Blocks
+        until it is ready."""
+        if self._answering():
+            logging.info(f"Adopting running aria2c {self.version}")
+            runtime = {name: value for name, value in self.profile.items() if name not in STARTUP_ONLY_OPTIONS}
+            try:
+                self._call("aria2.changeGlobalOption", runtime)
+            except (requests.RequestException, RuntimeError) as e:
+                logging.error(f"Error applying aria2 profile: {str(e)}")
+            return
+        self._launch(ready_timeout)
+
+    def _restart(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.restarts += 1
+        self._launch(ready_timeout=30)
+
+    async def _watch(self):
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while True:
+            await asyncio.sleep(self.check_interval)
+            crashed = self.process is not None and self.process.poll() is not None
+            if not crashed:
+                failures = 0 if await loop.run_in_executor(None, self._answering) else failures + 1
+                if failures < self.max_failures:
+                    continue
+            logging.error("aria2c crashed" if crashed else f"aria2c stopped answering ({failures} checks)")
+            try:
+                await loop.run_in_executor(None, self._restart)
+                failures = 0
+            except Exception as e:
+                logging.error(f"Error restarting aria2c: {str(e)}")
+
+    def watch(self):
+        """Start the background health check that relaunches a dead daemon."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def tune(self, **options):
+        """Change options of the running daemon. New downloads pick up the
+        per-download ones. Returns the options that only apply after a
+        restart."""
+        options = {name.replace('_', '-'): str(value) for name, value in options.items()}
+        runtime = {name: value for name, value in options.items() if name not in STARTUP_ONLY_OPTIONS}
+        if runtime:
+            # aria2 rejects unknown options and bad values before anything is kept
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, lambda: self._call("aria2.changeGlobalOption", runtime))
+        self.profile.update(options)
+        return sorted(set(options) - set(runtime))
+
+    async def stop(self, shutdown=False):
+        """Stop watching. With ``shutdown`` the daemon is also asked to save
+        its session and exit; otherwise it keeps downloading on its own."""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if shutdown and self.process and self.process.poll() is None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._call, "aria2.shutdown")
+                await asyncio.get_running_loop().run_in_executor(None, self.process.wait, 10)
+            except Exception:
+                self.process.terminate()
+
+    def summary(self):
+        state = "running" if self.version else "not answering"
+        owner = "managed" if self.process else "adopted"
+        return f"{self.version or '-'} ({state}, {owner}, {self.restarts} restarts)"
@@ -0,0 +1,180 @@
+import asyncio
+import inspect
+import logging
+import re
+import time
+from contextlib import contextmanager
+
+DIRECTIONS = ('download', 'upload')
+_RATE = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?$', re.IGNORECASE)
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(text):
+    """Bytes per second from ``50M``, ``512K``, ``1.5GB/s`` or ``off`` (0)."""
+    if text.lower() in ('off', 'none', 'unlimited'):
+        return 0
+    match = _RATE.match(text.strip())
+    if not match:
+        raise ValueError(f"Not a rate: {text}")
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+class TokenBucket:
+    """Paces a byte stream to ``rate`` bytes/s (0 lets everything through).
+
+    Callers take tokens before sending a chunk and sleep off any debt, so
+    concurrent workers sharing a bucket queue up behind each other. At most
+    one second of unused rate is saved up as burst. The rate can be changed
+    while transfers are running.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        self.tokens = 0.0  # debt taken at the old rate doesn't carry over
+
+    async def consume(self, size):
+        self._refill()
+        if not self.rate:
+            return
+        self.tokens -= size
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Flow:
+    """One job's transfer in one direction, holding its current share.
+
+    ``apply(rate)`` pushes the share to whatever does the transfer (e.g. an
+    aria2 GID); it may be a coroutine function and is re-run with the latest
+    rate whenever the share changes. Transfers we move ourselves call
+    ``throttle`` before every chunk instead.
+    """
+
+    def __init__(self, user_id, direction, apply=None):
+        self.user_id = user_id
+        self.direction = direction
+        self.apply = apply
+        self.rate = 0  # bytes/s, 0 for unlimited
+        self.bucket = TokenBucket()
+        self.applied = None  # (apply, rate) last pushed
+        self.pushing = None
+
+    async def throttle(self, size):
+        await self.bucket.consume(size)
+
+    def retarget(self, apply):
+        """Push the share to a new target, e.g. after aria2 replaced the GID."""
+        self.apply = apply
+        self._push()
+
+    def _set_rate(self, rate):
+        if rate == self.rate:
+            return
+        self.rate = rate
+        self.bucket.set_rate(rate)
+        self._push()
+
+    def _push(self):
+        if self.apply and (self.pushing is None or self.pushing.done()):
+            self.pushing = asyncio.ensure_future(self._apply())
+
+    async def _apply(self):
+        # Changes that arrive while a push is under way are sent after it, so
+        # the target always ends up with the latest rate
+        while self.apply and self.applied != (self.apply, self.rate):
+            apply, rate = self.apply, self.rate
+            try:
+                result = apply(rate)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logging.error(f"Error applying a {self.direction} limit of {rate} B/s: {str(e)}")
+            self.applied = (apply, rate)
+
+
+class BandwidthManager:
+    """Weighted fair sharing of a global download and upload cap.
+
+    Each direction's cap is divided between the users with a transfer in
+    that direction in proportion to their weight (1 unless set), and each
+    user's part is split evenly between their transfers. Shares are
+    recomputed whenever a transfer starts or ends, or a cap or weight
+    changes, and are pushed to the running transfers, so nothing has to be
+    restarted. A cap of 0 leaves that direction unlimited.
+    """
+
+    def __init__(self, download_limit=0, upload_limit=0):
+        self.limits = {'download': download_limit, 'upload': upload_limit}
+        self.weights = {}  # user_id -> weight
+        self.flows = {direction: [] for direction in DIRECTIONS}
+
+    def open(self, user_id, direction, apply=None):
+        flow = Flow(user_id, direction, apply)
+        self.flows[direction].append(flow)
+        self._rebalance(direction)
+        flow._push()  # an unlimited share that didn't change still reaches the target
+        return flow
+
+    def close(self, flow):
+        flows = self.flows[flow.direction]
+        if flow in flows:
+            flows.remove(flow)
+            self._rebalance(flow.direction)
+
+    @contextmanager
+    def flow(self, user_id, direction, apply=None):
+        flow = self.open(user_id, direction, apply)
+        try:
+            yield flow
+        finally:
+            self.close(flow)
+
+    def set_limit(self, direction, rate):
+        self.limits[direction] = rate
+        self._rebalance(direction)
+
+    def set_weight(self, user_id, weight):
+        if weight == 1:
+            self.weights.pop(user_id, None)
+        else:
+            self.weights[user_id] = weight
+        for direction in DIRECTIONS:
+            self._rebalance(direction)
+
+    def _rebalance(self, direction):
+        flows = self.flows[direction]
+        limit = self.limits[direction]
+        per_user = {}
+        for flow in flows:
+            per_user.setdefault(flow.user_id, []).append(flow)
+        total_weight = sum(self.weights.get(user_id, 1) for user_id in per_user)
+        for user_id, user_flows in per_user.items():
+            if not limit:
+                share = 0
+            else:
+                # Never round a share down to 0, which would mean unlimited
+                user_share = limit * self.weights.get(user_id, 1) / total_weight
+                share = max(1, int(user_share / len(user_flows)))
+            for flow in user_flows:
+                flow._set_rate(share)
+
+    def summary(self, direction):
+        """``(cap, {user_id: (transfers, bytes/s share)})`` for a direction."""
+        users = {}
+        for flow in self.flows[direction]:
+            count, rate = users.get(flow.user_id, (0, 0))
+            users[flow.user_id] = (count + 1, rate + flow.rate)
+        return self.limits[direction], users
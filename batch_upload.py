@@ -0,0 +1,45 @@
+import os
+
+from file_splitter import TELEGRAM_UPLOAD_LIMIT
+from media_probe import VIDEO_EXTENSIONS
+
+MEDIA_GROUP_SIZE = 10  # Telegram's limit per album
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.wav', '.ogg', '.flac')
+PHOTO_SIZE_LIMIT = 10 * 1024 * 1024  # Bigger images are only accepted as documents
+
+
+def media_kind(name, size):
+    """How a file of a batch is sent: 'photo', 'video', 'audio' or 'document'."""
+    ext = os.path.splitext(name)[1].lower()
+    if ext in PHOTO_EXTENSIONS and size <= PHOTO_SIZE_LIMIT:
+        return 'photo'
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    if ext in AUDIO_EXTENSIONS:
+        return 'audio'
+    return 'document'
+
+
+def plan_media_groups(files):
+    """Split the files of a batch (dicts with 'path', 'name' and 'size') into
+    Telegram albums of ``(kind, file)`` pairs, keeping their order.
+
+    Photos and videos may share an album, while audio and documents can only
+    be grouped with their own kind. Files over the upload limit are sent in
+    parts, so each comes back as an album of its own.
+    """
+    groups = []
+    open_groups = {}  # album family -> album still being filled
+    for item in files:
+        kind = media_kind(item['name'], item['size'])
+        if item['size'] > TELEGRAM_UPLOAD_LIMIT:
+            groups.append([(kind, item)])
+            continue
+        family = 'visual' if kind in ('photo', 'video') else kind
+        group = open_groups.get(family)
+        if group is None or len(group) >= MEDIA_GROUP_SIZE:
+            group = open_groups[family] = []
+            groups.append(group)
+        group.append((kind, item))
+    return groups
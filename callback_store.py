@@ -0,0 +1,59 @@
+import secrets
+import time
+from collections import OrderedDict
+
+
+class CallbackStore:
+    """Short tokens for inline keyboard state.
+
+    Telegram caps ``callback_data`` at 64 bytes, so buttons carry only
+    ``{prefix}_{token}`` and the state behind them (remote, path, page...)
+    lives here. Tokens expire ``ttl`` seconds after they were last handed
+    out and the oldest are dropped past ``max_entries``. A button with the
+    same prefix and state reuses its existing token.
+    """
+
+    def __init__(self, ttl=6 * 3600, max_entries=20000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # token -> (expires, key, state)
+        self.tokens = {}  # (prefix, state items) -> token
+
+    def data(self, prefix, **state):
+        """Callback data for a button that resolves to ``state``."""
+        key = (prefix, tuple(sorted(state.items())))
+        token = self.tokens.get(key)
+        if token is None:
+            token = secrets.token_urlsafe(6)
+            while token in self.entries:
+                token = secrets.token_urlsafe(6)
+            self.tokens[key] = token
+        self.entries[token] = (time.time() + self.ttl, key, state)
+        self.entries.move_to_end(token)
+        self._evict()
+        return f"{prefix}_{token}"
+
+    def get(self, data):
+        """State for the callback data of a pressed button, or None once the
+        token has expired."""
+        token = data.split('_', 1)[-1]
+        entry = self.entries.get(token)
+        if not entry:
+            return None
+        if entry[0] < time.time():
+            self._drop(token)
+            return None
+        return entry[2]
+
+    def _drop(self, token):
+        _, key, _ = self.entries.pop(token)
+        self.tokens.pop(key, None)
+
+    def _evict(self):
+        # Entries are kept in expiry order, so stale ones sit at the front
+        now = time.time()
+        while self.entries:
+            token, (expires, _, _) = next(iter(self.entries.items()))
+            if expires >= now and len(self.entries) <= self.max_entries:
+                return
+            self._drop(token)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import shutil
+
+from job_queue import JobCancelled
+
+
+class DiskFull(Exception):
+    """Raised when a job can never fit: bigger than the disk or the user's quota."""
+
+
+def _allocated(path):
+    """Bytes the filesystem has already allocated to ``path``."""
+    try:
+        return os.stat(path).st_blocks * 512
+    except (FileNotFoundError, AttributeError):
+        return 0
+
+
+class Reservation:
+    def __init__(self, job_id, user_id, size):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.size = size
+        self.paths = []  # files being written, once known
+        self.written = 0  # bytes the job reports as written
+
+    @property
+    def outstanding(self):
+        """Reserved bytes that are not on disk yet."""
+        allocated = sum(_allocated(path) for path in self.paths)
+        return max(0, self.size - max(self.written, allocated))
+
+
+class DiskAdmission:
+    """Admission control for jobs that write into ``root``.
+
+    A job reserves its expected size before it starts writing. It is admitted
+    when free space minus everything other jobs still have to write leaves
+    ``headroom`` spare, and the user stays within ``user_quota`` (files already
+    in their folder plus their reservations). Jobs that don't fit wait, and
+    are re-checked whenever a reservation is released or every
+    ``poll_interval`` seconds, since uploads free space too.
+
+    A job that has already started writing, e.g. an aria2 download whose file
+    is preallocated, passes its ``paths``: what is allocated to them is
+    already missing from the free space and counted in the user's folder, so
+    only the remainder has to fit.
+    """
+
+    def __init__(self, root, headroom=2 * 1024 ** 3, user_quota=None, poll_interval=5):
+        self.root = str(root)
+        self.headroom = headroom
+        self.user_quota = user_quota
+        self.poll_interval = poll_interval
+        self.reservations = {}  # job_id -> Reservation
+        self.waiters = {}  # job_id -> Future woken on release or cancel
+
+    def _outstanding(self, user_id=None):
+        return sum(
+            r.outstanding for r in self.reservations.values()
+            if user_id is None or r.user_id == user_id
+        )
+
+    def _user_usage(self, user_id):
+        total = 0
+        for dir_path, _, file_names in os.walk(os.path.join(self.root, str(user_id))):
+            for file_name in file_names:
+                try:
+                    total += os.path.getsize(os.path.join(dir_path, file_name))
+                except OSError:
+                    pass
+        return total
+
+    async def _check(self, user_id, size, paths):
+        """True if the job fits now, False if it has to wait."""
+        usage = shutil.disk_usage(self.root)
+        if size > usage.total - self.headroom:
+            raise DiskFull(f"needs {size} bytes, more than the disk can hold")
+        if self.user_quota and size > self.user_quota:
+            raise DiskFull(f"needs {size} bytes, more than the per-user quota")
+        missing = max(0, size - sum(_allocated(path) for path in paths))
+        if usage.free - self._outstanding() - self.headroom < missing:
+            return False
+        if self.user_quota:
+            # Walking the user's folder can take a while on a big tree
+            used = await asyncio.get_running_loop().run_in_executor(None, self._user_usage, user_id)
+            if used + self._outstanding(user_id) + missing > self.user_quota:
+                return False
+        return True
+
+    async def try_reserve(self, job_id, user_id, size, paths=()):
+        """Reserve ``size`` bytes now, or return None if the job has to wait."""
+        if not await self._check(user_id, size, paths):
+            return None
+        reservation = Reservation(job_id, user_id, size)
+        reservation.paths = list(paths)
+        self.reservations[job_id] = reservation
+        return reservation
+
+    async def reserve(self, job_id, user_id, size, paths=()):
+        """Wait until ``size`` bytes can be reserved. Raises DiskFull if they
+        never can, and JobCancelled if ``cancel(job_id)`` is called meanwhile."""
+        loop = asyncio.get_running_loop()
+        while True:
+            reservation = await self.try_reserve(job_id, user_id, size, paths)
+            if reservation:
+                return reservation
+            waiter = loop.create_future()
+            self.waiters[job_id] = waiter
+            try:
+                await asyncio.wait_for(waiter, self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiters.pop(job_id, None)
+
+    def release(self, reservation):
+        if self.reservations.pop(reservation.job_id, None) is None:
+            return
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def cancel(self, job_id):
+        """Stop a job that is waiting for space. Returns True if it was waiting."""
+        waiter = self.waiters.pop(job_id, None)
+        if not waiter or waiter.done():
+            return False
+        waiter.set_exception(JobCancelled())
+        return True
+
+    def stats(self):
+        """``(free bytes, bytes reserved but not yet written, jobs waiting)``"""
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError as e:
+            logging.error(f"Error reading disk usage: {str(e)}")
+            free = 0
+        return free, self._outstanding(), len(self.waiters)
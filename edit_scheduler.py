@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from pyrogram.errors import FloodWait, MessageNotModified
+
+
+class EditScheduler:
+    """Central renderer for progress messages.
+
+    Handlers hand over the latest text for a message with ``schedule()`` and
+    return immediately. Only the newest frame per message is kept, and frames
+    are sent oldest-first while respecting a minimum interval per chat, a
+    global edits-per-second budget and any FloodWait Telegram hands back.
+    Final states (complete, failed, cancelled) go through ``edit()``, which
+    drops the pending frame so a stale progress bar can never overwrite them,
+    keeps retrying through FloodWaits until the text is shown, and forgets
+    the message. Chats whose pacing delay has passed are dropped while idle,
+    and at most ``max_tracked`` sent texts are remembered.
+    """
+
+    def __init__(self, per_chat_interval=3, global_rate=20, max_tracked=1000):
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = 1 / global_rate
+        self.pending = OrderedDict()  # (chat_id, message_id) -> (message, text, reply_markup)
+        self.inflight = {}  # (chat_id, message_id) -> asyncio.Task
+        self.last_text = OrderedDict()  # (chat_id, message_id) -> last text sent, oldest first
+        self.max_tracked = max_tracked
+        self.final = {}  # (chat_id, message_id) -> the edit() currently retrying
+        self.chat_ready_at = {}  # chat_id -> loop time of the next allowed edit
+        self.global_ready_at = 0
+        self.wakeup = None
+        self.task = None
+
+    @staticmethod
+    def _key(message):
+        return (message.chat.id, message.id)
+
+    def _ensure_started(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def schedule(self, message, text, reply_markup=None):
+        """Queue ``text`` as the next frame for ``message``, replacing any
+        frame that has not been sent yet."""
+        self._ensure_started()
+        key = self._key(message)
+        if key not in self.pending and self.last_text.get(key) == text:
+            return
+        self.pending[key] = (message, text, reply_markup)
+        self.wakeup.set()
+
+    def discard(self, message):
+        """Forget any pending frame for ``message``."""
+        key = self._key(message)
+        self.pending.pop(key, None)
+        self.last_text.pop(key, None)
+
+    async def edit(self, message, text, reply_markup=None):
+        """Edit ``message`` right away, after dropping its pending frame and
+        waiting for a frame that is already on the wire."""
+        key = self._key(message)
+        self.pending.pop(key, None)
+        inflight = self.inflight.get(key)
+        if inflight:
+            await asyncio.wait([inflight])
+        self.last_text.pop(key, None)
+        token = self.final[key] = object()
+        try:
+            while True:
+                try:
+                    return await message.edit_text(text, reply_markup=reply_markup)
+                except MessageNotModified:
+                    return message
+                except FloodWait as e:
+                    logging.warning(f"FloodWait of {e.value}s on final edit in chat {key[0]}")
+                    self._penalise(key[0], e.value)
+                    await asyncio.sleep(e.value)
+                    if self.final.get(key) is not token:
+                        return None  # a newer edit of this message took over
+        finally:
+            if self.final.get(key) is token:
+                del self.final[key]
+
+    def _remember(self, key, text):
+        self.last_text[key] = text
+        self.last_text.move_to_end(key)
+        while len(self.last_text) > self.max_tracked:
+            self.last_text.popitem(last=False)
+
+    def _prune(self, now):
+        """Drop chats that are free to be edited again."""
+        for chat_id in [chat_id for chat_id, ready_at in self.chat_ready_at.items() if ready_at <= now]:
+            del self.chat_ready_at[chat_id]
+
+    def _penalise(self, chat_id, seconds):
+        loop = asyncio.get_running_loop()
+        self.chat_ready_at[chat_id] = max(self.chat_ready_at.get(chat_id, 0), loop.time() + seconds)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pending:
+                self._prune(loop.time())
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = loop.time()
+            chosen = None
+            delay = None
+            for key in self.pending:
+                if key in self.inflight:
+                    continue
+                ready_at = max(self.chat_ready_at.get(key[0], 0), self.global_ready_at)
+                if ready_at <= now:
+                    chosen = key
+                    break
+                delay = ready_at - now if delay is None else min(delay, ready_at - now)
+
+            if chosen is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay or self.per_chat_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            frame = self.pending.pop(chosen)
+            self.chat_ready_at[chosen[0]] = now + self.per_chat_interval
+            self.global_ready_at = now + self.global_interval
+            self.inflight[chosen] = loop.create_task(self._send(chosen, *frame))
+
+    async def _send(self, key, message, text, reply_markup):
+        try:
+            await message.edit_text(text, reply_markup=reply_markup)
+            self._remember(key, text)
+        except MessageNotModified:
+            self._remember(key, text)
+        except FloodWait as e:
+            logging.warning(f"FloodWait of {e.value}s while editing progress in chat {key[0]}")
+            self._penalise(key[0], e.value)
+            # Retry this frame later unless a newer one arrived meanwhile
+            self.pending.setdefault(key, (message, text, reply_markup))
+        except Exception as e:
+            logging.error(f"Error editing progress message: {str(e)}")
+        finally:
+            self.inflight.pop(key, None)
+            if self.wakeup:
+                self.wakeup.set()
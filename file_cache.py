@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import Counter, OrderedDict
+
+
+def url_key(url):
+    return f"url:{url}"
+
+
+def content_key(size, digest):
+    return f"sha256:{size}:{digest}"
+
+
+def _key_size(key):
+    """The size part of a content key, None for URL keys."""
+    if key.startswith("sha256:"):
+        return int(key.split(":")[1])
+    return None
+
+
+def _hash_file(path, chunk_size=4 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+async def hash_file(path):
+    """SHA-256 of ``path``, computed off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, _hash_file, path)
+
+
+def sent_file_id(sent):
+    """Return ``(file_id, media_type)`` for a message we just sent."""
+    for media_type in ('video', 'audio', 'photo', 'animation', 'voice', 'document'):
+        media = getattr(sent, media_type, None)
+        if media:
+            return media.file_id, media_type
+    return None, None
+
+
+class FileIdCache:
+    """Maps content keys (source URL, or size plus SHA-256) to the Telegram
+    file_id we got back after uploading that content, so repeats can be served
+    with ``send_cached_media``. Entries expire after ``ttl`` seconds and the
+    least recently used ones are evicted past ``max_entries``. Entries are kept
+    in the job store so the cache survives restarts. Content keys are also
+    counted by size, so a file only needs hashing when some cached content
+    has the same size."""
+
+    def __init__(self, store, kind='file_cache', max_entries=5000, ttl=7 * 24 * 3600, url_ttl=24 * 3600):
+        self.store = store
+        self.kind = kind
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.url_ttl = url_ttl
+        self.entries = OrderedDict(store.load(kind))
+        self.sizes = Counter(_key_size(key) for key in self.entries)
+
+    def has_size(self, size):
+        """Whether any cached content is ``size`` bytes long."""
+        return self.sizes[size] > 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if entry['expires'] < time.time():
+            self.discard(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, file_id, media_type):
+        ttl = self.url_ttl if key.startswith("url:") else self.ttl
+        entry = {'file_id': file_id, 'media': media_type, 'expires': time.time() + ttl}
+        if key not in self.entries:
+            self.sizes[_key_size(key)] += 1
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.store.save(self.kind, key, entry)
+        while len(self.entries) > self.max_entries:
+            old_key, _ = self.entries.popitem(last=False)
+            self.sizes[_key_size(old_key)] -= 1
+            self.store.delete(self.kind, old_key)
+
+    def discard(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.sizes[_key_size(key)] -= 1
+            self.store.delete(self.kind, key)
+
+    async def send(self, client, chat_id, key, caption=None, reply_to_message_id=None):
+        """Send the cached media for ``key``. Returns the sent message, or None
+        on a miss or when Telegram no longer accepts the file_id."""
+        entry = self.get(key)
+        if not entry:
+            return None
+        try:
+            return await client.send_cached_media(
+                chat_id,
+                entry['file_id'],
+                caption=caption,
+                reply_to_message_id=reply_to_message_id
+            )
+        except Exception as e:
+            logging.error(f"Cached file_id rejected, dropping it: {str(e)}")
+            self.discard(key)
+            return None
@@ -0,0 +1,180 @@
+import asyncio
+import io
+import logging
+import math
+import os
+
+# Largest single file a bot may upload
+TELEGRAM_UPLOAD_LIMIT = 2000 * 1024 * 1024
+
+
+class FileSlice(io.RawIOBase):
+    """Read-only window ``[offset, offset + length)`` of a file that looks like a
+    file of its own, so a part can be uploaded straight from the original
+    without copying it to disk."""
+
+    def __init__(self, path, offset, length, name):
+        super().__init__()
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.name = name
+        self._fp = open(path, 'rb')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self.length
+        self._pos = max(0, min(pos, self.length))
+        return self._pos
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.length - self._pos)
+        if size <= 0:
+            return 0
+        self._fp.seek(self.offset + self._pos)
+        data = self._fp.read(size)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        self._fp.close()
+        super().close()
+
+
+class Part:
+    def __init__(self, index, name, size, source, on_disk=False):
+        self.index = index
+        self.name = name
+        self.size = size
+        self.source = source  # path of a prepared part file, or a FileSlice
+        self.on_disk = on_disk
+
+    def cleanup(self):
+        if isinstance(self.source, FileSlice):
+            self.source.close()
+        elif self.on_disk and os.path.exists(self.source):
+            os.remove(self.source)
+
+
+async def iter_byte_parts(path, name, limit=TELEGRAM_UPLOAD_LIMIT):
+    """Split any file into ``name.001``, ``name.002``... windows of at most
+    ``limit`` bytes. Nothing is written to disk; join them again with ``cat``."""
+    size = os.path.getsize(path)
+    count = math.ceil(size / limit)
+    for index in range(count):
+        offset = index * limit
+        length = min(limit, size - offset)
+        part_name = f"{name}.{index + 1:03d}"
+        yield Part(index + 1, part_name, length, FileSlice(path, offset, length, part_name))
+
+
+async def _run(*command):
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"{command[0]} failed: {stderr.decode(errors='ignore').strip()}")
+    return stdout.decode(errors='ignore')
+
+
+async def probe_duration(path):
+    output = await _run(
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        path
+    )
+    return float(output.strip() or 0)
+
+
+async def iter_video_parts(path, name, work_dir, limit=TELEGRAM_UPLOAD_LIMIT):
+    """Cut a video into playable parts of at most ``limit`` bytes with ffmpeg
+    stream copy. Seeking before the input makes every cut start on the
+    keyframe before ``start``; the next cut begins where this one was asked to
+    end, so parts overlap by that pre-roll instead of skipping footage.
+    Parts are produced one at a time in ``work_dir``."""
+    size = os.path.getsize(path)
+    duration = await probe_duration(path)
+    if not duration:
+        raise RuntimeError("Could not read video duration")
+
+    base, ext = os.path.splitext(name)
+    # Leave headroom for container overhead and uneven bitrate
+    target_duration = duration * (limit / size) * 0.9
+    start = 0.0
+    index = 1
+    while start < duration - 0.5:
+        part_name = f"{base}.part{index:03d}{ext}"
+        part_path = os.path.join(work_dir, part_name)
+        part_duration = target_duration
+        while True:
+            try:
+                await _run(
+                    "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                    "-ss", f"{start:.3f}", "-i", path,
+                    "-t", f"{part_duration:.3f}",
+                    "-map", "0", "-c", "copy",
+                    "-avoid_negative_ts", "make_zero",
+                    part_path
+                )
+            except BaseException:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            part_size = os.path.getsize(part_path)
+            if part_size <= limit:
+                break
+            # A bitrate spike pushed this part over the limit; cut shorter
+            part_duration *= (limit / part_size) * 0.95
+            logging.info(f"Part {index} of {name} too large, retrying with {part_duration:.0f}s")
+
+        yield Part(index, part_name, part_size, part_path, on_disk=True)
+        start += part_duration
+        index += 1
+
+
+async def prefetch(parts):
+    """Yield from ``parts`` while the next part is already being prepared, so
+    part N+1 is cut while part N uploads. At most one part is held ahead.
+
+    Closing this generator (use ``aclosing``) stops the part being prepared,
+    deletes a prepared part nobody took, and closes ``parts``."""
+    iterator = parts.__aiter__()
+    pending = asyncio.ensure_future(anext(iterator))
+    try:
+        while True:
+            try:
+                part = await pending
+            except StopAsyncIteration:
+                return
+            pending = asyncio.ensure_future(anext(iterator))
+            yield part
+    finally:
+        pending.cancel()
+        try:
+            await pending
+        except BaseException:
+            pass
+        else:
+            pending.result().cleanup()
+        await iterator.aclose()
@@ -0,0 +1,162 @@
+import asyncio
+import functools
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+
+class JobCancelled(Exception):
+    """Raised to a job that was cancelled while still waiting in a queue."""
+
+
+class _Waiter:
+    def __init__(self, job_id, future, on_queued):
+        self.job_id = job_id
+        self.future = future
+        self.on_queued = on_queued
+        self.position = None
+
+
+class _Stage:
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.waiting = OrderedDict()  # user_id -> deque of _Waiter, in round-robin order
+
+    def order(self):
+        """Waiters in the order they will be started: one per user per round."""
+        queues = [list(queue) for queue in self.waiting.values()]
+        ordered = []
+        depth = 0
+        while True:
+            row = [queue[depth] for queue in queues if depth < len(queue)]
+            if not row:
+                return ordered
+            ordered.extend(row)
+            depth += 1
+
+
+class JobScheduler:
+    """Bounded worker pools for each pipeline stage.
+
+    Every stage (aria2, ytdl, tg_download, tg_upload, rclone) has its own
+    concurrency limit. When a stage is full, jobs wait in per-user queues that
+    are served round-robin, so one user queueing fifty links can't starve
+    everyone else. ``on_queued(position)`` is called whenever a waiting job's
+    place in line changes.
+    """
+
+    def __init__(self, limits):
+        self.stages = {name: _Stage(name, limit) for name, limit in limits.items()}
+        self.waiters = {}  # job_id -> (stage, user_id, _Waiter)
+
+    def set_limit(self, stage, limit):
+        self.stages[stage].limit = limit
+        self._grant(self.stages[stage])
+
+    @asynccontextmanager
+    async def slot(self, stage, user_id, job_id=None, on_queued=None):
+        await self.acquire(stage, user_id, job_id, on_queued)
+        try:
+            yield
+        finally:
+            self.release(stage)
+
+    async def acquire(self, stage, user_id, job_id=None, on_queued=None):
+        st = self.stages[stage]
+        if st.active < st.limit and not st.waiting:
+            st.active += 1
+            return
+
+        waiter = _Waiter(job_id, asyncio.get_running_loop().create_future(), on_queued)
+        st.waiting.setdefault(user_id, deque()).append(waiter)
+        if job_id is not None:
+            self.waiters[job_id] = (st, user_id, waiter)
+        self._announce(st)
+        try:
+            await waiter.future
+        except (asyncio.CancelledError, JobCancelled):
+            self._remove(st, user_id, waiter)
+            raise
+        finally:
+            if job_id is not None:
+                self.waiters.pop(job_id, None)
+
+    def release(self, stage):
+        st = self.stages[stage]
+        st.active -= 1
+        self._grant(st)
+
+    def cancel(self, job_id):
+        """Cancel a job that is still queued. Returns True if it was waiting."""
+        entry = self.waiters.pop(job_id, None)
+        if not entry:
+            return False
+        st, user_id, waiter = entry
+        if not waiter.future.done():
+            waiter.future.set_exception(JobCancelled())
+        return True
+
+    def is_queued(self, job_id):
+        return job_id in self.waiters
+
+    def stats(self):
+        return {
+            name: (st.active, st.limit, sum(len(queue) for queue in st.waiting.values()))
+            for name, st in self.stages.items()
+        }
+
+    def _remove(self, st, user_id, waiter):
+        queue = st.waiting.get(user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del st.waiting[user_id]
+        elif waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+            # The slot was granted just as the job went away
+            st.active -= 1
+        self._grant(st)
+
+    def _grant(self, st):
+        while st.active < st.limit and st.waiting:
+            user_id, queue = next(iter(st.waiting.items()))
+            waiter = queue.popleft()
+            if queue:
+                st.waiting.move_to_end(user_id)
+            else:
+                del st.waiting[user_id]
+            if waiter.future.done():
+                continue
+            st.active += 1
+            waiter.future.set_result(None)
+        self._announce(st)
+
+    def _announce(self, st):
+        for position, waiter in enumerate(st.order(), start=1):
+            if waiter.on_queued and waiter.position != position:
+                waiter.position = position
+                try:
+                    waiter.on_queued(position)
+                except Exception as e:
+                    logging.error(f"Error reporting queue position: {str(e)}")
+
+
+background_tasks = set()
+
+
+def spawn(coro):
+    """Start ``coro`` as a task that is kept alive until it finishes."""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def detached(handler):
+    """Run a Pyrogram handler as its own task so long jobs waiting in a queue
+    don't hold one of the dispatcher's worker slots."""
+    @functools.wraps(handler)
+    async def wrapper(client, update):
+        spawn(handler(client, update))
+    return wrapper
@@ -0,0 +1,107 @@
+import json
+import logging
+import sqlite3
+import time
+
+
+class JobStore:
+    """Crash-safe key/value store for job bookkeeping, backed by SQLite in WAL
+    mode. Records are stored as JSON under a ``(kind, key)`` pair."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " kind TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (kind, key))"
+        )
+
+    def save(self, kind, key, record):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO jobs (kind, key, data, updated_at) VALUES (?, ?, ?, ?)",
+            (kind, str(key), json.dumps(record), time.time())
+        )
+
+    def delete(self, kind, key):
+        self.conn.execute("DELETE FROM jobs WHERE kind = ? AND key = ?", (kind, str(key)))
+
+    def load(self, kind):
+        rows = self.conn.execute("SELECT key, data FROM jobs WHERE kind = ? ORDER BY updated_at", (kind,))
+        return {key: json.loads(data) for key, data in rows}
+
+    def close(self):
+        self.conn.close()
+
+
+def _serialisable(record):
+    """Drop live objects (tasks, processes, job handles) that can't survive a
+    restart anyway."""
+    clean = {}
+    for name, value in record.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        clean[name] = value
+    return clean
+
+
+class JobTable(dict):
+    """dict of job records keyed by message id that writes through to a
+    JobStore. Assigning or deleting an entry is persisted automatically;
+    after changing a record in place call ``persist(key)``."""
+
+    def __init__(self, store, kind):
+        super().__init__()
+        self.store = store
+        self.kind = kind
+        for key, record in store.load(kind).items():
+            super().__setitem__(int(key), record)
+
+    def persist(self, key):
+        if key in self:
+            try:
+                self.store.save(self.kind, key, _serialisable(self[key]))
+            except sqlite3.Error as e:
+                logging.error(f"Error saving {self.kind} job {key}: {str(e)}")
+
+    def __setitem__(self, key, record):
+        super().__setitem__(key, record)
+        self.persist(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.store.delete(self.kind, key)
+
+    def pop(self, key, *default):
+        had_key = key in self
+        value = super().pop(key, *default)
+        if had_key:
+            self.store.delete(self.kind, key)
+        return value
+
+
+class JobSet(set):
+    """set of user ids that writes through to a JobStore."""
+
+    def __init__(self, store, kind):
+        super().__init__(int(key) for key in store.load(kind))
+        self.store = store
+        self.kind = kind
+
+    def add(self, item):
+        super().add(item)
+        self.store.save(self.kind, item, True)
+
+    def remove(self, item):
+        super().remove(item)
+        self.store.delete(self.kind, item)
+
+    def discard(self, item):
+        super().discard(item)
+        self.store.delete(self.kind, item)
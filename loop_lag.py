@@ -0,0 +1,46 @@
+import asyncio
+import logging
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task.
+
+    Any handler that blocks the loop shows up here as lag, so this is the
+    number to watch when something synchronous sneaks back into a coroutine.
+    """
+
+    def __init__(self, interval=0.5, warn_threshold=0.5):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.current = 0.0
+        self.average = 0.0
+        self.maximum = 0.0
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.current = lag
+            self.average = lag if not self.average else self.average * 0.9 + lag * 0.1
+            self.maximum = max(self.maximum, lag)
+            if lag >= self.warn_threshold:
+                logging.warning(f"Event loop stalled for {lag * 1000:.0f} ms")
+
+    def summary(self):
+        return (
+            f"{self.current * 1000:.1f} ms now | "
+            f"{self.average * 1000:.1f} ms avg | "
+            f"{self.maximum * 1000:.1f} ms max"
+        )
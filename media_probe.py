@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+
+from file_splitter import _run
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.flv', '.webm')
+
+
+class MediaProber:
+    """Video metadata and thumbnails from ffprobe/ffmpeg run as asyncio
+    subprocesses, at most ``workers`` at a time.
+
+    Results are cached by file identity (path, size, mtime) so a probe started
+    early with ``prefetch`` is reused by the upload. Thumbnails take the
+    keyframe at or before the seek point (``-noaccurate_seek`` and
+    ``-skip_frame nokey``) instead of decoding up to the exact timestamp, and
+    are written to ``work_dir`` as 320px JPEGs.
+    """
+
+    def __init__(self, work_dir, workers=2, max_entries=128):
+        self.work_dir = str(work_dir)
+        # Thumbnails from a previous run are never reused
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self.slots = asyncio.Semaphore(workers)
+        self.entries = OrderedDict()  # (path, size, mtime_ns, thumbnail) -> Future of metadata dict
+
+    @staticmethod
+    def _identity(path):
+        st = os.stat(path)
+        return (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+    def metadata(self, path, thumbnail=True):
+        """Future of ``dict(width, height, duration, thumb)`` for ``path``.
+        With ``thumbnail=False`` only ffprobe runs and ``thumb`` is None."""
+        key = self._identity(path) + (thumbnail,)
+        future = self.entries.get(key)
+        if future is None or (future.done() and future.exception()):
+            future = asyncio.ensure_future(self._probe(path, thumbnail))
+            self.entries[key] = future
+            while len(self.entries) > self.max_entries:
+                _, old = self.entries.popitem(last=False)
+                self._remove_thumb(old)
+        self.entries.move_to_end(key)
+        return future
+
+    def prefetch(self, path, thumbnail=True):
+        """Start probing a finished video in the background."""
+        if path and path.lower().endswith(VIDEO_EXTENSIONS) and os.path.exists(path):
+            self.metadata(path, thumbnail).add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def forget(self, path):
+        """Drop every cached entry for ``path`` and delete its thumbnail."""
+        path = os.path.realpath(path)
+        for key in [key for key in self.entries if key[0] == path]:
+            self._remove_thumb(self.entries.pop(key))
+
+    @staticmethod
+    def _remove_thumb(future):
+        if future.done() and not future.cancelled() and not future.exception():
+            thumb = future.result().get('thumb')
+            if thumb and os.path.exists(thumb):
+                os.remove(thumb)
+        elif not future.done():
+            future.cancel()
+
+    async def _probe(self, path, thumbnail):
+        width, height, duration = 1280, 720, 0
+        async with self.slots:
+            try:
+                output = json.loads(await _run(
+                    "ffprobe", "-v", "error",
+                    "-select_streams", "v:0",
+                    "-show_entries", "stream=width,height:format=duration",
+                    "-of", "json",
+                    path
+                ))
+                for stream in output.get("streams", []):
+                    width = stream.get("width", width)
+                    height = stream.get("height", height)
+                duration = int(float(output.get("format", {}).get("duration", 0)))
+            except (RuntimeError, ValueError) as e:
+                logging.error(f"ffprobe failed for {path}: {str(e)}")
+
+            if not thumbnail:
+                return dict(height=height, width=width, duration=duration, thumb=None)
+            thumb = os.path.join(self.work_dir, f"{uuid.uuid4().hex}.jpg")
+            try:
+                await _run(
+                    "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                    "-skip_frame", "nokey", "-noaccurate_seek",
+                    "-ss", f"{min(duration * 0.1, 30):.3f}", "-i", path,
+                    "-frames:v", "1",
+                    "-vf", "scale=320:320:force_original_aspect_ratio=decrease",
+                    "-q:v", "5",
+                    thumb
+                )
+            except RuntimeError as e:
+                logging.error(f"Thumbnail extraction failed for {path}: {str(e)}")
+                thumb = None
+        return dict(height=height, width=width, duration=duration, thumb=thumb)
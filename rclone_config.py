@@ -0,0 +1,76 @@
+import asyncio
+import configparser
+import hashlib
+import logging
+import os
+
+
+class UserConfig:
+    """One parsed version of a user's rclone.conf."""
+
+    def __init__(self, stamp, digest, remotes):
+        self.stamp = stamp  # (mtime_ns, size) of the file this was read from
+        self.digest = digest
+        self.remotes = remotes  # remote name -> {option: value}
+        self.health = {}  # remote name -> "" when it answered, else the error
+
+    def problem(self, remote):
+        """Why ``remote`` failed its check, or None if it passed or is unchecked."""
+        return self.health.get(remote) or None
+
+
+class RcloneConfigCache:
+    """Parsed rclone.conf per user, re-read only when the file changes.
+
+    A cheap stat is enough while mtime and size are unchanged; otherwise the
+    file is hashed and parsed again only if its content actually differs.
+    Every new version has its remotes checked once in the background with
+    ``validator(user_id, config, remote)``, which raises for a broken remote.
+    """
+
+    def __init__(self, path_for, validator=None):
+        self.path_for = path_for
+        self.validator = validator
+        self.configs = {}  # user_id -> UserConfig
+
+    def get(self, user_id):
+        path = self.path_for(user_id)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.configs.pop(user_id, None)
+            return None
+
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = self.configs.get(user_id)
+        if cached and cached.stamp == stamp:
+            return cached
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if cached and cached.digest == digest:
+            cached.stamp = stamp
+            return cached
+
+        # rclone values may contain '%', which configparser would try to expand
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read_string(data.decode(errors='replace'))
+        config = UserConfig(stamp, digest, {name: dict(parser[name]) for name in parser.sections()})
+        self.configs[user_id] = config
+        if self.validator:
+            asyncio.ensure_future(self.validate(user_id, config))
+        return config
+
+    async def check(self, user_id, config, remote):
+        """Probe one remote now. Returns the error message, or None if it works."""
+        try:
+            await self.validator(user_id, config, remote)
+            config.health[remote] = ""
+        except Exception as e:
+            config.health[remote] = str(e) or type(e).__name__
+            logging.warning(f"rclone remote {remote} of user {user_id} failed its check: {config.health[remote]}")
+        return config.problem(remote)
+
+    async def validate(self, user_id, config):
+        await asyncio.gather(*(self.check(user_id, config, remote) for remote in config.remotes))
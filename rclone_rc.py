@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import re
+import secrets
+import shlex
+import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class RcloneError(Exception):
+    """An rclone rc call failed."""
+
+
+# Options through which wrapping backends (crypt, alias, chunker, union,
+# combine, ...) name the remote they sit on
+REFERENCE_OPTIONS = ('remote', 'upstreams')
+_REMOTE_NAME = re.compile(r'^[\w.+@ -]+$')
+
+
+class RcloneRC:
+    """Awaitable client for one long-lived ``rclone rcd`` daemon.
+
+    Calls go over rclone's HTTP remote-control API through a keep-alive
+    ``requests.Session`` on a small thread pool, like ``AsyncAria2``. Each
+    user's remotes are registered in the daemon as ``u{user_id}_{remote}``
+    from their parsed rclone.conf, and re-registered when its content changes.
+    References between a user's remotes are rewritten to the prefixed names.
+
+    The API is only reachable with a user name and password generated for
+    each run, handed to the daemon through its environment rather than its
+    command line, so other local processes can't read everyone's remotes.
+    """
+
+    def __init__(self, config_path, host="127.0.0.1", port=5572, timeout=60, workers=8):
+        self.config_path = str(config_path)  # the daemon's own config, holds the registered remotes
+        self.addr = f"{host}:{port}"
+        self.url = f"http://{self.addr}"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = ("bot", secrets.token_urlsafe(24))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rclone-rc")
+        self.process = None
+        self.synced = {}  # user_id -> (config digest, registered remote names)
+        self.sync_locks = defaultdict(asyncio.Lock)
+
+    def _post(self, command, params):
+        response = self.session.post(f"{self.url}/{command}", json=params, timeout=self.timeout)
+        result = response.json() if response.content else {}
+        if response.status_code != 200:
+            raise RcloneError(result.get("error") or f"{command} returned HTTP {response.status_code}")
+        return result
+
+    async def call(self, command, **params):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._post, command, params)
+
+    async def start(self, ready_timeout=15):
+        """Launch the daemon and wait until it answers."""
+        user, password = self.session.auth
+        self.process = subprocess.Popen([
+            "rclone", "rcd",
+            "--rc-addr", self.addr,
+            "--config", self.config_path
+        ], env=dict(os.environ, RCLONE_RC_USER=user, RCLONE_RC_PASS=password))
+        deadline = time.time() + ready_timeout
+        while True:
+            try:
+                await self.call("rc/noop")
+                return
+            except (requests.RequestException, RcloneError):
+                if time.time() > deadline or self.process.poll() is not None:
+                    raise RcloneError("rclone rcd did not start")
+                await asyncio.sleep(0.2)
+
+    async def close(self):
+        if self.process and self.process.poll() is None:
+            try:
+                await self.call("core/quit")
+            except Exception:
+                self.process.terminate()
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    @staticmethod
+    def remote_name(user_id, remote):
+        return f"u{user_id}_{remote}"
+
+    def _prefix_reference(self, user_id, remotes, reference):
+        """``remote:path`` with ``remote`` renamed to its prefixed name. Local
+        paths and on-the-fly ``:backend:`` remotes are kept as they are."""
+        name, separator, rest = reference.partition(':')
+        if not separator or not name or not _REMOTE_NAME.match(name):
+            return reference
+        if name not in remotes:
+            # Would resolve to whatever another user registered under that name
+            raise RcloneError(f"refers to unknown remote {name}")
+        return f"{self.remote_name(user_id, name)}:{rest}"
+
+    def _prefix_references(self, user_id, remotes, option, value):
+        if option == 'remote':
+            return self._prefix_reference(user_id, remotes, value)
+        # union: "remote:path[:ro] ...", combine: "dir=remote:path ..."
+        upstreams = []
+        for upstream in shlex.split(value):
+            label, equals, reference = upstream.partition('=') if '=' in upstream.split(':')[0] else ('', '', upstream)
+            upstream = f"{label}{equals}{self._prefix_reference(user_id, remotes, reference)}"
+            upstreams.append(f'"{upstream}"' if ' ' in upstream else upstream)
+        return " ".join(upstreams)
+
+    async def sync_user(self, user_id, config):
+        """Register the remotes of a parsed ``UserConfig`` with the daemon
+        unless that version is already loaded."""
+        async with self.sync_locks[user_id]:
+            loaded = self.synced.get(user_id)
+            if loaded and loaded[0] == config.digest:
+                return
+
+            if loaded:
+                for name in loaded[1]:
+                    try:
+                        await self.call("config/delete", name=name)
+                    except RcloneError as e:
+                        logging.error(f"Error removing rclone remote {name}: {str(e)}")
+
+            names = []
+            for remote, options in config.remotes.items():
+                parameters = dict(options)
+                remote_type = parameters.pop("type", None)
+                if not remote_type:
+                    continue
+                try:
+                    for option in REFERENCE_OPTIONS:
+                        if option in parameters:
+                            parameters[option] = self._prefix_references(user_id, config.remotes, option, parameters[option])
+                except RcloneError as e:
+                    logging.error(f"Skipping rclone remote {remote} of user {user_id}: {str(e)}")
+                    continue
+                name = self.remote_name(user_id, remote)
+                await self.call(
+                    "config/create",
+                    name=name,
+                    type=remote_type,
+                    parameters=parameters,
+                    opt={"nonInteractive": True, "noObscure": True}
+                )
+                names.append(name)
+            self.synced[user_id] = (config.digest, names)
+
+    async def fs(self, user_id, config, remote):
+        await self.sync_user(user_id, config)
+        return f"{self.remote_name(user_id, remote)}:"
+
+    async def probe(self, fs):
+        """Cheap check that a remote answers: ``about``, or a root listing for
+        backends that don't support it."""
+        try:
+            await self.call("operations/about", fs=fs)
+        except RcloneError as e:
+            if "support" not in str(e).lower():
+                raise
+            await self.call("operations/list", fs=fs, remote="", opt={"dirsOnly": True})
+
+    async def list_dirs(self, fs, path="", recurse=False):
+        result = await self.call("operations/list", fs=fs, remote=path, opt={"dirsOnly": True, "recurse": recurse})
+        return [item["Path"] for item in result.get("list", [])]
+
+    async def copy_file(self, source_path, fs, destination):
+        """Start copying a local file to ``fs`` + ``destination`` in the
+        background. Returns the rc job id."""
+        source_path = os.path.abspath(source_path)
+        result = await self.call(
+            "operations/copyfile",
+            srcFs=os.path.dirname(source_path),
+            srcRemote=os.path.basename(source_path),
+            dstFs=fs,
+            dstRemote=destination,
+            _async=True
+        )
+        return result["jobid"]
+
+    async def job_status(self, job_id):
+        return await self.call("job/status", jobid=job_id)
+
+    async def job_stats(self, job_id):
+        return await self.call("core/stats", group=f"job/{job_id}")
+
+    async def set_bwlimit(self, rate):
+        """Cap the daemon's total transfer rate at ``rate`` bytes/s, 0 for none.
+        rcd has a single limiter shared by all of its jobs."""
+        await self.call("core/bwlimit", rate=f"{max(rate // 1024, 1)}K" if rate else "off")
+
+    async def stop_job(self, job_id):
+        try:
+            await self.call("job/stop", jobid=job_id)
+        except RcloneError as e:
+            logging.error(f"Error stopping rclone job {job_id}: {str(e)}")
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+from contextlib import aclosing
+
+
+async def rcat(config_path, destination, chunks, size=None, on_chunk=None, flow=None):
+    """Pipe the async iterable ``chunks`` into ``rclone rcat`` so the upload
+    starts with the first chunk and nothing is staged on disk.
+
+    ``on_chunk(sent_bytes)`` is called after each chunk is handed to rclone;
+    it may raise to abort the transfer, which kills rclone. With a bandwidth
+    ``flow`` the chunks are paced to its share, which unlike ``--bwlimit``
+    follows changes while rclone runs. Raises RuntimeError if rclone fails.
+    """
+    command = ["rclone", "rcat", "--config", str(config_path)]
+    if size:
+        command += ["--size", str(size)]
+    command.append(destination)
+
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    sent = 0
+    try:
+        async with aclosing(chunks.__aiter__()) as stream:
+            async for chunk in stream:
+                if flow:
+                    await flow.throttle(len(chunk))
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+                sent += len(chunk)
+                if on_chunk:
+                    on_chunk(sent)
+        process.stdin.close()
+        stderr = await process.stderr.read()
+        await process.wait()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        error = stderr.decode(errors='ignore').strip()
+        logging.error(f"rclone rcat to {destination} failed: {error}")
+        raise RuntimeError(f"rclone rcat failed: {error}")
+    return sent
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import posixpath
+import time
+from collections import OrderedDict
+
+
+class FolderCache:
+    """Per-user, per-remote cache of one-level folder listings.
+
+    ``lister(user_id, remote, path)`` is an async callable returning the
+    folders directly under ``path``. Listings are kept for ``ttl`` seconds,
+    the least recently used ones are dropped past ``max_entries``, and
+    concurrent requests for the same folder share a single listing. After
+    showing a folder, its children can be prefetched so the next click is
+    served from memory.
+    """
+
+    def __init__(self, lister, ttl=300, max_entries=2000):
+        self.lister = lister
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (user_id, remote, path) -> (expires, folders)
+        self.loading = {}  # (user_id, remote, path) -> Future
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    async def list(self, user_id, remote, path=""):
+        key = (user_id, remote, path.strip('/'))
+        folders = self._fresh(key)
+        if folders is not None:
+            self.entries.move_to_end(key)
+            return folders
+
+        future = self.loading.get(key)
+        if not future:
+            future = asyncio.ensure_future(self._load(key))
+            self.loading[key] = future
+            future.add_done_callback(lambda _: self.loading.pop(key, None))
+        # A listing shared with other callers keeps going if this one is cancelled
+        return await asyncio.shield(future)
+
+    async def _load(self, key):
+        folders = await self.lister(*key)
+        self.entries[key] = (time.time() + self.ttl, folders)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return folders
+
+    def prefetch(self, user_id, remote, paths, limit=8):
+        """Start listing up to ``limit`` of ``paths`` in the background."""
+        for path in paths[:limit]:
+            key = (user_id, remote, path.strip('/'))
+            if self._fresh(key) is None and key not in self.loading:
+                task = asyncio.ensure_future(self.list(user_id, remote, path))
+                task.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception():
+            logging.warning(f"Folder prefetch failed: {str(task.exception())}")
+
+    def invalidate(self, user_id, remote=None, path=None):
+        """Forget listings after our own writes: a folder and its parents, a
+        whole remote, or everything a user has cached."""
+        if path is not None:
+            path = path.strip('/')
+            while True:
+                self.entries.pop((user_id, remote, path), None)
+                if not path:
+                    return
+                path = posixpath.dirname(path)
+        for key in [key for key in self.entries if key[0] == user_id and remote in (None, key[1])]:
+            del self.entries[key]
@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+
+class GrowingFile:
+    """A file that is still being written, read back in order as its
+    complete prefix grows, so an upload can start before the download ends.
+
+    ``available()`` is an async callable returning how many bytes from the
+    start of the file are final. It may raise to abort the reader, e.g. when
+    the download failed. ``name`` and ``size`` describe the finished file.
+    """
+
+    def __init__(self, path, size, name, available, poll_interval=1):
+        self.path = path
+        self.size = size
+        self.name = name
+        self.available = available
+        self.poll_interval = poll_interval
+
+    async def chunks(self, chunk_size):
+        """Yield ``chunk_size`` pieces of the file (the last may be shorter),
+        waiting for each to be complete before reading it."""
+        loop = asyncio.get_running_loop()
+        offset = 0
+        ready = 0
+        fd = None
+        try:
+            while offset < self.size:
+                want = min(chunk_size, self.size - offset)
+                if ready < offset + want:
+                    ready = await self.available()
+                    if ready < offset + want:
+                        await asyncio.sleep(self.poll_interval)
+                        continue
+                if fd is None:
+                    fd = os.open(self.path, os.O_RDONLY)
+                chunk = await loop.run_in_executor(None, os.pread, fd, want, offset)
+                if len(chunk) < want:
+                    raise IOError(f"Short read from {self.path} at {offset}")
+                offset += want
+                yield chunk
+        finally:
+            if fd is not None:
+                os.close(fd)
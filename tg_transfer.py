@@ -0,0 +1,437 @@
+import asyncio
+import contextvars
+import inspect
+import io
+import logging
+import mmap
+import os
+import time
+from collections import deque
+from contextlib import aclosing, contextmanager
+from pathlib import PurePath
+
+from pyrogram import Client, raw, StopTransmission
+from pyrogram.errors import AuthBytesInvalid
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Session
+from pyrogram.session.auth import Auth
+
+from archive_tools import TarStream
+from file_splitter import FileSlice
+from tail_reader import GrowingFile
+
+PART_SIZE = 512 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+# Bandwidth flow paced by the transfers of the current task. send_document and
+# friends reach save_file without a way to pass it along, hence a context var.
+_flow = contextvars.ContextVar('flow', default=None)
+
+
+class TransferStats:
+    """Running MB/s figures per transfer mode, for comparing the parallel
+    engine against Pyrogram's single-session path. Only files big enough for
+    the parallel engine are recorded; thumbnails and other small files are
+    bound by per-request latency and would drown out the comparison."""
+
+    def __init__(self):
+        self.totals = {}  # mode -> [bytes, seconds, count]
+
+    def record(self, mode, size, seconds):
+        total = self.totals.setdefault(mode, [0, 0.0, 0])
+        total[0] += size
+        total[1] += seconds
+        total[2] += 1
+        logging.info(f"{mode}: {size / 1024 / 1024:.1f} MB in {seconds:.1f}s ({size / 1024 / 1024 / max(seconds, 0.001):.2f} MB/s)")
+
+    def rate(self, mode):
+        size, seconds, _ = self.totals.get(mode, (0, 0, 0))
+        return size / 1024 / 1024 / seconds if seconds else 0
+
+    def summary(self):
+        return " | ".join(
+            f"{mode}: {self.rate(mode):.2f} MB/s ({count} files)"
+            for mode, (_, _, count) in self.totals.items()
+        ) or "no transfers yet"
+
+
+def _source_window(path):
+    """``(path, offset, length, name)`` for sources we can read positionally."""
+    if isinstance(path, (str, PurePath)) and os.path.isfile(path):
+        return str(path), 0, os.path.getsize(path), os.path.basename(path)
+    if isinstance(path, FileSlice):
+        return path.path, path.offset, path.length, path.name
+    return None
+
+
+async def aenumerate(iterable):
+    async with aclosing(iterable.__aiter__()) as items:
+        index = 0
+        async for item in items:
+            yield index, item
+            index += 1
+
+
+def _file_location(file_id):
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+
+
+async def _get_range(session, location, offset):
+    for attempt in range(3):
+        try:
+            result = await session.invoke(raw.functions.upload.GetFile(
+                location=location,
+                offset=offset,
+                limit=DOWNLOAD_CHUNK_SIZE
+            ))
+            break
+        except Exception as e:
+            if attempt == 2:
+                raise
+            logging.warning(f"Retrying range at {offset}: {str(e)}")
+            await asyncio.sleep(1)
+
+    if not isinstance(result, raw.types.upload.File):
+        raise RuntimeError("File is served from a CDN")
+    return result.bytes
+
+
+def _message_media(message):
+    for media_type in ('document', 'video', 'audio', 'animation', 'voice', 'video_note', 'photo'):
+        media = getattr(message, media_type, None)
+        if media:
+            return media
+    return None
+
+
+class TurboClient(Client):
+    """Pyrogram client that moves big files over several MTProto media
+    sessions at once.
+
+    Uploads read parts from a memory map of the source file and hand them out
+    to ``upload_connections`` sessions; downloads fetch 1 MiB ranges over
+    ``download_connections`` sessions into a preallocated file with positional
+    writes. Each session keeps ``requests_per_connection`` requests in flight.
+    Download sessions are opened once per DC and reused, so a foreign DC
+    costs one key exchange and authorization import for the client's life.
+    Progress callbacks get the same ``(current, total)`` arguments as with
+    Pyrogram's own methods, and raising StopTransmission from one still
+    cancels the transfer. Small files fall back to Pyrogram's own path.
+
+    Inside ``with client.throttled(flow)`` the parallel transfers of that
+    task are paced to the flow's bandwidth share.
+    """
+
+    def __init__(self, *args, upload_connections=4, download_connections=4, requests_per_connection=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_connections = upload_connections
+        self.download_connections = download_connections
+        self.requests_per_connection = requests_per_connection
+        self.transfer_stats = TransferStats()
+        self.media_auth_keys = {}  # dc_id -> auth key imported on a foreign DC
+        self.media_sessions = {}  # dc_id -> started download sessions
+        self.media_locks = {}  # dc_id -> asyncio.Lock
+
+    @contextmanager
+    def throttled(self, flow):
+        token = _flow.set(flow)
+        try:
+            yield
+        finally:
+            _flow.reset(token)
+
+    async def _media_auth_key(self, dc_id):
+        """Auth key authorized on ``dc_id``: ours for the home DC, otherwise
+        one made with a single handshake and import, then kept for good."""
+        if dc_id == await self.storage.dc_id():
+            return await self.storage.auth_key()
+        if dc_id in self.media_auth_keys:
+            return self.media_auth_keys[dc_id]
+
+        test_mode = await self.storage.test_mode()
+        auth_key = await Auth(self, dc_id, test_mode).create()
+        session = Session(self, dc_id, auth_key, test_mode, is_media=True)
+        await session.start()
+        try:
+            for _ in range(3):
+                exported = await self.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                try:
+                    await session.invoke(raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+                    break
+                except AuthBytesInvalid:
+                    continue
+            else:
+                raise AuthBytesInvalid()
+        except BaseException:
+            await session.stop()
+            raise
+        self.media_auth_keys[dc_id] = auth_key
+        self.media_sessions.setdefault(dc_id, []).append(session)
+        return auth_key
+
+    async def _media_sessions(self, dc_id, count):
+        """``count`` started media sessions on ``dc_id``. They are kept on the
+        client and shared by every transfer from that DC; if any new one
+        fails to start, the others started with it are stopped again."""
+        async with self.media_locks.setdefault(dc_id, asyncio.Lock()):
+            auth_key = await self._media_auth_key(dc_id)
+            pool = self.media_sessions.setdefault(dc_id, [])
+            if len(pool) < count:
+                test_mode = await self.storage.test_mode()
+                new = [Session(self, dc_id, auth_key, test_mode, is_media=True) for _ in range(count - len(pool))]
+                results = await asyncio.gather(*(session.start() for session in new), return_exceptions=True)
+                failures = [result for result in results if isinstance(result, BaseException)]
+                if failures:
+                    await asyncio.gather(*(
+                        session.stop() for session, result in zip(new, results)
+                        if not isinstance(result, BaseException)
+                    ), return_exceptions=True)
+                    raise failures[0]
+                pool.extend(new)
+            return pool[:count]
+
+    async def stop(self, *args, **kwargs):
+        sessions = [session for pool in self.media_sessions.values() for session in pool]
+        self.media_sessions.clear()
+        await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+        return await super().stop(*args, **kwargs)
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        started = time.time()
+        if isinstance(path, TarStream) and path.size <= BIG_FILE_SIZE:
+            # Small enough to build in memory and send the usual way
+            buffer = io.BytesIO(b"".join([chunk async for chunk in path.chunks(PART_SIZE)]))
+            buffer.name = path.name
+            return await super().save_file(buffer, file_id, file_part, progress, progress_args)
+        if isinstance(path, (GrowingFile, TarStream)):
+            # Upload a file that is still downloading, or an archive that is
+            # generated on the fly, as its parts become ready
+            total_parts = (path.size + PART_SIZE - 1) // PART_SIZE
+            parts = aenumerate(path.chunks(PART_SIZE))
+            result = await self._save_parts(parts, total_parts, path.size, path.name, progress, progress_args)
+            self.transfer_stats.record(f"pipelined upload (x{self.upload_connections})", path.size, time.time() - started)
+            return result
+
+        window = _source_window(path) if file_id is None else None
+        if not window or window[2] <= BIG_FILE_SIZE or self.upload_connections <= 1:
+            result = await super().save_file(path, file_id, file_part, progress, progress_args)
+            if window and window[2] > BIG_FILE_SIZE and result is not None:
+                self.transfer_stats.record("upload (single)", window[2], time.time() - started)
+            return result
+
+        result = await self._save_big_file(*window, progress, progress_args)
+        self.transfer_stats.record(f"upload (x{self.upload_connections})", window[2], time.time() - started)
+        return result
+
+    async def _save_big_file(self, source_path, offset, length, name, progress, progress_args):
+        total_parts = (length + PART_SIZE - 1) // PART_SIZE
+        with open(source_path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+            async def parts():
+                for part in range(total_parts):
+                    start = offset + part * PART_SIZE
+                    yield part, mm[start:min(start + PART_SIZE, offset + length)]
+
+            return await self._save_parts(parts(), total_parts, length, name, progress, progress_args)
+
+    async def _save_parts(self, parts, total_parts, length, name, progress, progress_args):
+        """Send ``(index, bytes)`` pairs from the async iterator ``parts`` as
+        SaveBigFilePart requests spread over the upload sessions."""
+        if length <= BIG_FILE_SIZE:
+            raise ValueError("Parallel uploads are only used for big files")
+        file_id = self.rnd_id()
+        flow = _flow.get()
+        next_lock = asyncio.Lock()
+        done = 0
+        failure = None
+
+        dc_id = await self.storage.dc_id()
+        auth_key = await self.storage.auth_key()
+        test_mode = await self.storage.test_mode()
+        sessions = [
+            Session(self, dc_id, auth_key, test_mode, is_media=True)
+            for _ in range(self.upload_connections)
+        ]
+
+        async def worker(session):
+            nonlocal done, failure
+            while not failure:
+                try:
+                    async with next_lock:
+                        part, chunk = await anext(parts)
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    failure = failure or e
+                    return
+                if flow:
+                    await flow.throttle(len(chunk))
+                rpc = raw.functions.upload.SaveBigFilePart(
+                    file_id=file_id,
+                    file_part=part,
+                    file_total_parts=total_parts,
+                    bytes=chunk
+                )
+                for attempt in range(3):
+                    try:
+                        await session.invoke(rpc)
+                        break
+                    except Exception as e:
+                        if attempt == 2:
+                            failure = e
+                            return
+                        logging.warning(f"Retrying part {part} of {name}: {str(e)}")
+                        await asyncio.sleep(1)
+
+                done += len(chunk)
+                if progress:
+                    try:
+                        result = progress(done, length, *progress_args)
+                        if inspect.isawaitable(result):
+                            await result
+                    except StopTransmission as e:
+                        failure = e
+                        return
+
+        try:
+            await asyncio.gather(*(session.start() for session in sessions))
+            await asyncio.gather(*(
+                worker(session)
+                for session in sessions
+                for _ in range(self.requests_per_connection)
+            ))
+        finally:
+            await parts.aclose()
+            await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+
+        if failure:
+            raise failure
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=name)
+
+    async def download_parallel(self, message, file_path, progress=None, progress_args=()):
+        """Download the media of ``message`` to ``file_path`` over several
+        connections. Falls back to ``message.download`` for small files or if
+        the parallel path fails (e.g. a CDN redirect)."""
+        media = _message_media(message)
+        file_size = getattr(media, 'file_size', 0) or 0
+        started = time.time()
+        if file_size > BIG_FILE_SIZE and self.download_connections > 1:
+            try:
+                await self._download_ranges(media.file_id, file_size, file_path, progress, progress_args)
+                self.transfer_stats.record(f"download (x{self.download_connections})", file_size, time.time() - started)
+                return file_path
+            except StopTransmission:
+                raise
+            except Exception as e:
+                logging.error(f"Parallel download failed, falling back to a single connection: {str(e)}")
+
+        result = await message.download(file_name=file_path, progress=progress, progress_args=progress_args)
+        if file_size > BIG_FILE_SIZE:
+            self.transfer_stats.record("download (single)", file_size, time.time() - started)
+        return result
+
+    async def _download_ranges(self, file_id_str, file_size, file_path, progress, progress_args):
+        file_id = FileId.decode(file_id_str)
+        location = _file_location(file_id)
+
+        next_offset = iter(range(0, file_size, DOWNLOAD_CHUNK_SIZE))
+        flow = _flow.get()
+        done = 0
+        failure = None
+        sessions = await self._media_sessions(file_id.dc_id, self.download_connections)
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Reserve the whole file up front so ranges can land in any order
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, file_size)
+            else:
+                os.ftruncate(fd, file_size)
+
+            async def worker(session):
+                nonlocal done, failure
+                for offset in next_offset:
+                    if failure:
+                        return
+                    if flow:
+                        await flow.throttle(DOWNLOAD_CHUNK_SIZE)
+                    try:
+                        chunk = await _get_range(session, location, offset)
+                    except Exception as e:
+                        failure = e
+                        return
+                    os.pwrite(fd, chunk, offset)
+
+                    done += len(chunk)
+                    if progress:
+                        try:
+                            callback = progress(min(done, file_size), file_size, *progress_args)
+                            if inspect.isawaitable(callback):
+                                await callback
+                        except StopTransmission as e:
+                            failure = e
+                            return
+
+            await asyncio.gather(*(
+                worker(session)
+                for session in sessions
+                for _ in range(self.requests_per_connection)
+            ))
+        finally:
+            os.close(fd)
+
+        if failure:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise failure
+
+    async def stream_parallel(self, message):
+        """Yield the media of ``message`` as in-order chunks without writing it
+        to disk. Big files are fetched over several connections with at most
+        ``download_connections * requests_per_connection`` chunks held ahead;
+        small ones go through ``stream_media``."""
+        media = _message_media(message)
+        file_size = getattr(media, 'file_size', 0) or 0
+        if file_size <= BIG_FILE_SIZE or self.download_connections <= 1:
+            async for chunk in self.stream_media(message):
+                yield chunk
+            return
+
+        file_id = FileId.decode(media.file_id)
+        location = _file_location(file_id)
+        sessions = await self._media_sessions(file_id.dc_id, self.download_connections)
+        offsets = enumerate(range(0, file_size, DOWNLOAD_CHUNK_SIZE))
+        flow = _flow.get()
+        pending = deque()
+
+        def fetch_next():
+            index, offset = next(offsets, (None, None))
+            if offset is not None:
+                session = sessions[index % len(sessions)]
+                pending.append(asyncio.ensure_future(_get_range(session, location, offset)))
+
+        try:
+            for _ in range(len(sessions) * self.requests_per_connection):
+                fetch_next()
+            while pending:
+                chunk = await pending.popleft()
+                if flow:
+                    await flow.throttle(len(chunk))
+                fetch_next()
+                yield chunk
+        finally:
+            for future in pending:
+                future.cancel()
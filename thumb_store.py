@@ -0,0 +1,58 @@
+import logging
+import os
+
+from file_splitter import _run
+
+# Telegram ignores thumbnails larger than this
+THUMB_MAX_SIDE = 320
+THUMB_MAX_BYTES = 200 * 1024
+
+
+class ThumbnailStore:
+    """Custom upload thumbnails, one per user.
+
+    Images are scaled to fit ``THUMB_MAX_SIDE`` and re-encoded as JPEG at the
+    best quality that stays under ``THUMB_MAX_BYTES`` once, when they are set,
+    so every later upload can attach them without running ffmpeg.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, user_id):
+        return os.path.join(str(self.root), str(user_id), "thumb.jpg")
+
+    def get(self, user_id):
+        path = self.path(user_id)
+        return path if os.path.exists(path) else None
+
+    async def set(self, user_id, image_path):
+        """Store ``image_path`` as the user's thumbnail. Raises RuntimeError if
+        ffmpeg can't read the image or no quality fits the size limit."""
+        path = self.path(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.new.jpg"
+        try:
+            for quality in (2, 4, 7, 12, 20, 31):
+                await _run(
+                    "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                    "-i", image_path,
+                    "-frames:v", "1",
+                    "-vf", f"scale={THUMB_MAX_SIDE}:{THUMB_MAX_SIDE}:force_original_aspect_ratio=decrease",
+                    "-q:v", str(quality),
+                    temp_path
+                )
+                if os.path.getsize(temp_path) <= THUMB_MAX_BYTES:
+                    os.replace(temp_path, path)
+                    logging.info(f"Thumbnail saved for user {user_id} at quality {quality}")
+                    return path
+            raise RuntimeError("Thumbnail is too large even at the lowest quality")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def delete(self, user_id):
+        path = self.get(user_id)
+        if path:
+            os.remove(path)
+        return bool(path)
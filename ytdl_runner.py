@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadCancelled
+
+
+class YtdlJob:
+    """Handle for one running yt-dlp download, used to cancel it and to find
+    its partial files afterwards."""
+
+    def __init__(self):
+        self.cancel_event = threading.Event()
+        self.tmp_files = set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cleanup(self):
+        for path in self.tmp_files:
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.error(f"Error removing partial file: {str(e)}")
+
+
+class YtdlRunner:
+    """Runs yt-dlp extraction and download on worker threads.
+
+    Progress hooks fire on the worker thread; they are bridged back onto the
+    event loop with ``call_soon_threadsafe`` so ``on_progress`` can touch
+    messages and the edit scheduler safely.
+    """
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdl")
+
+    async def download(self, url, ydl_opts, job, on_progress=None, admit=None):
+        """Download ``url`` and return the final file name.
+
+        ``admit(info)`` is awaited on the loop between extraction and download,
+        e.g. to wait for disk space; the worker thread waits with it.
+        """
+        loop = asyncio.get_running_loop()
+
+        def hook(status):
+            if job.cancelled:
+                raise DownloadCancelled()
+            if status.get('tmpfilename'):
+                job.tmp_files.add(status['tmpfilename'])
+            if on_progress:
+                loop.call_soon_threadsafe(on_progress, {
+                    'status': status.get('status'),
+                    'filename': status.get('filename'),
+                    'downloaded': status.get('downloaded_bytes') or 0,
+                    'total': status.get('total_bytes') or status.get('total_bytes_estimate') or 0,
+                    'speed': status.get('speed') or 0,
+                    'eta': status.get('eta'),
+                })
+
+        def run():
+            opts = dict(ydl_opts, progress_hooks=[hook])
+            with YoutubeDL(opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+                if admit:
+                    asyncio.run_coroutine_threadsafe(admit(info), loop).result()
+                if job.cancelled:
+                    raise DownloadCancelled()
+                info = ydl.process_ie_result(info, download=True)
+                return ydl.prepare_filename(info)
+
+        return await loop.run_in_executor(self.executor, run)
+
+
+def expected_size(info):
+    """Best guess of the bytes a yt-dlp download will write, or 0 if unknown."""
+    formats = info.get('requested_formats') or [info]
+    return sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats)